@@ -2,53 +2,35 @@ from parsl import python_app
 
 
 @python_app
-def create_galaxy_lib(zphot_para, lephare_dir, lephare_sandbox, stdout=None):
+def create_galaxy_lib(zphot_para, lephare_dir, lephare_sandbox, stdout=None, options=None):
     """ LePhare step 1: creating SED library
 
     Args:
         zphot_para (str): zphot_para path
         lephare_dir (str): the LePhare installation directory path
         lephare_sandbox (str): working directory path
+        options (dict, optional): zphot.para keys given on the command line,
+            e.g. GAL_SED and GAL_LIB of a SED subset. Defaults to None.
     """
     import os
-    import subprocess
-    import shlex
     from utils import get_logger
-    
+    from lephare_run import run_program
+
     logger = get_logger(
-        name='sedtolib', debug=True,
+        name=os.path.splitext(stdout)[0], debug=True,
         stdout=os.path.join(lephare_sandbox, stdout)
     )
 
-    # import logging
-
-    # logger = logging.getLogger('sedtolib')
-    # if stdout:
-    #     handler = logging.FileHandler(os.path.join(lephare_sandbox, stdout))
-    #     formatter = logging.Formatter(
-    #         '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
-    #     )
-    #     handler.setFormatter(formatter)
-    #     logger.addHandler(handler)
-
-    # logger.setLevel(logging.DEBUG)
-
     logger.info('Creating SED library')
-
-    origin_path = os.getcwd()
-    os.chdir(lephare_sandbox)
-
-    os.environ['LEPHAREWORK'] = os.getcwd()
-    logger.info('LEPHAREWORK: {}'.format(os.environ['LEPHAREWORK']))
+    logger.info('LEPHAREWORK: {}'.format(lephare_sandbox))
 
     cmd_phz = f'{lephare_dir}/sedtolib -t G -c {zphot_para}'
-    subplog = open('sedtolib.run', 'w+')
+    cmd_phz += ''.join(f' -{key} {value}' for key, value in (options or {}).items())
     logger.info(f"Executing {cmd_phz}")
-    proc = subprocess.Popen(shlex.split(cmd_phz), stdout=subplog, stderr=subplog, universal_newlines=True)
-    proc.wait()
-    logger.info(f"Return code = {proc.returncode}")
-
-    os.chdir(origin_path)
+    returncode = run_program(
+        cmd_phz, lephare_sandbox, os.path.join(lephare_sandbox, os.path.splitext(stdout)[0] + '.run')
+    )
+    logger.info(f"Return code = {returncode}")
 
 
 @python_app
@@ -61,160 +43,301 @@ def create_filter_set(zphot_para, lephare_dir, lephare_sandbox, stdout=None):
         lephare_sandbox (str): working directory path
     """
     import os
-    import subprocess
-    import shlex
     from utils import get_logger
-    
+    from lephare_run import run_program
+
     logger = get_logger(
         name='filter', debug=True,
         stdout=os.path.join(lephare_sandbox, stdout)
     )
 
-    origin_path = os.getcwd()
-    os.chdir(lephare_sandbox)
     logger.info('Creating filter transmission files')
-
-    os.environ['LEPHAREWORK'] = os.getcwd()
-    logger.info('LEPHAREWORK: {}'.format(os.environ['LEPHAREWORK']))
+    logger.info('LEPHAREWORK: {}'.format(lephare_sandbox))
 
     cmd_phz = f'{lephare_dir}/filter -c {zphot_para} '
-    subplog = open('filter.run', 'w+')
     logger.info(f"Executing {cmd_phz}")
-    proc = subprocess.Popen(shlex.split(cmd_phz), stdout=subplog, stderr=subplog, universal_newlines=True)
-    proc.wait()
-    logger.info(f"Return code = {proc.returncode}")
-
-    os.chdir(origin_path)
+    returncode = run_program(cmd_phz, lephare_sandbox, os.path.join(lephare_sandbox, 'filter.run'))
+    logger.info(f"Return code = {returncode}")
 
 
 @python_app
-def compute_galaxy_mag(zphot_para, lephare_dir, lephare_sandbox, stdout=None):
+def compute_galaxy_mag(zphot_para, lephare_dir, lephare_sandbox, stdout=None, options=None, inputs=[]):
     """ LePhare step 3: theoretical magnitudes library
 
     Args:
         zphot_para (str): zphot_para path
         lephare_dir (str): the LePhare installation directory path
         lephare_sandbox (str): working directory path
+        options (dict, optional): zphot.para keys given on the command line,
+            e.g. GAL_LIB_IN, GAL_LIB_OUT and MOD_EXTINC of a SED subset.
+            Defaults to None.
+        inputs (list, optional): steps 1 and 2 futures. Defaults to [].
     """
     import os
-    import subprocess
-    import shlex
     from utils import get_logger
-    
+    from lephare_run import run_program
+
     logger = get_logger(
-        name='mag_gal', debug=True,
+        name=os.path.splitext(stdout)[0], debug=True,
         stdout=os.path.join(lephare_sandbox, stdout)
     )
 
-    origin_path = os.getcwd()
-    os.chdir(lephare_sandbox)
     logger.info('Computing theoretical magnitudes')
-
-    os.environ['LEPHAREWORK'] = os.getcwd()
-    logger.info('LEPHAREWORK: {}'.format(os.environ['LEPHAREWORK']))
+    logger.info('LEPHAREWORK: {}'.format(lephare_sandbox))
 
     cmd_phz = f'{lephare_dir}/mag_gal -t G -c {zphot_para} '
-    subplog = open('mag_gal.run', 'w+')
+    cmd_phz += ''.join(f' -{key} {value}' for key, value in (options or {}).items())
     logger.info(f"Executing {cmd_phz}")
-    proc = subprocess.Popen(shlex.split(cmd_phz), stdout=subplog, stderr=subplog, universal_newlines=True)
-    proc.wait()
-    logger.info(f"Return code = {proc.returncode}")
+    returncode = run_program(
+        cmd_phz, lephare_sandbox, os.path.join(lephare_sandbox, os.path.splitext(stdout)[0] + '.run')
+    )
+    logger.info(f"Return code = {returncode}")
+
 
-    os.chdir(origin_path)
+@python_app
+def merge_galaxy_mag(library_dir, plan, name, restore, inputs=[]):
+    """ LePhare step 3 by SED subsets: merges the lib_mag libraries of the
+    subsets and removes them with their lib_bin libraries and SED lists
+
+    Args:
+        library_dir (str): directory of filt, lib_bin and lib_mag
+        plan (list): SED subsets, see libshards.plan_shards
+        name (str): GAL_LIB_OUT of the merged library
+        restore (dict): zphot.para values of the keys given to the subsets
+        inputs (list, optional): mag_gal futures of the subsets. Defaults to [].
+    """
+    import os
+    from libshards import merge_libraries, remove_library
+
+    merge_libraries(os.path.join(library_dir, 'lib_mag'), plan, name, restore)
+
+    for shard in plan:
+        remove_library(os.path.join(library_dir, 'lib_mag'), shard['mag_gal']['GAL_LIB_OUT'])
+        remove_library(os.path.join(library_dir, 'lib_bin'), shard['sedtolib']['GAL_LIB'])
+        os.remove(shard['sedtolib']['GAL_SED'])
 
 
 @python_app
 def run_zphot(key, filename, interval, shifts, zphot_output, photo_type, err_type, apply_corr,
-        bands, zphot, col_index, cat_fmt, idxs, namephotoz, lephare_dir, lephare_sandbox, stdout=None):
-    """  Runs LePhare for each input data (fits) """
+        bands, zphot, col_index, cat_fmt, idxs, namephotoz, lephare_dir, lephare_sandbox, stdout=None,
+        scratch_dir=None, stream=False, pdz=None, selection=None, incremental=None, timeout=None,
+        variants=None, coordinates=None):
+    """  Runs LePhare for each input data (fits)
+
+    With scratch_dir, the task works in a node-local directory and only the
+    parquet output and the compressed logs are copied to the sandbox. With
+    stream, the catalogs are exchanged with zphota through named pipes. With
+    pdz, the PDFs are added to the parquet output. With selection, only the
+    selected objects are fitted, the others get sentinel values. With
+    incremental, the objects unchanged since the previous run are not fitted.
+    With variants, the same catalog is also fitted by the zphota of each
+    variant (see sweep.py). With coordinates, the right ascension and
+    declination are copied to the outputs. Failures (zphota exit code,
+    timeout, missing rows) raise, so the task is retried by Parsl.
+    """
 
-    import shutil
-    import shlex
-    import subprocess
-    import pyarrow as pa
-    import pyarrow.parquet as parq
-    import pandas as pd
     import os
-    from numpy import loadtxt
-    from utils import (
-        create_dir, get_photometric_columns, format_input, create_inputs_symbolic_link
-    )
-    from utils import get_logger
+    from utils import get_logger, close_logger
+    from lephare_run import run_partition
+    from scratch import create_run_dir, copy_back, archive_run_dir
 
-    lephare_run_path = os.path.join(lephare_sandbox, f'zphot-{key}')
-    create_dir(lephare_run_path)
+    lephare_run_path = create_run_dir(lephare_sandbox, f'zphot-{key}', scratch_dir)
 
     logger = get_logger(
-        name='mag_gal', debug=True,
+        name=f'zphot-{key}', debug=True,
         stdout=os.path.join(lephare_run_path, stdout)
     )
 
-    logger.info('Running zphot ID: {}'.format(key))
-    logger.info('Input file: {}'.format(filename))
-    logger.info('Interval: {}'.format(interval))
+    output = os.path.join(lephare_run_path, os.path.basename(zphot_output)) if scratch_dir else zphot_output
+    local_variants = [
+        dict(variant, output=os.path.join(lephare_run_path, f"{variant['name']}-{os.path.basename(variant['output'])}"))
+        for variant in variants or []
+    ] if scratch_dir else variants
+
+    try:
+        result = run_partition(
+            key, filename, interval, shifts, output, photo_type, err_type, apply_corr,
+            bands, zphot, col_index, cat_fmt, idxs, namephotoz, lephare_dir, lephare_run_path,
+            logger, stream=stream, pdz=pdz, selection=selection, incremental=incremental,
+            timeout=timeout, variants=local_variants, coordinates=coordinates
+        )
+
+        if scratch_dir:
+            copy_back(output, zphot_output)
+            result["file"] = zphot_output
+
+            for variant, local in zip(variants or [], local_variants):
+                os.makedirs(os.path.dirname(variant['output']), exist_ok=True)
+                copy_back(local['output'], variant['output'])
+                result["variants"][variant['name']]["file"] = variant['output']
+    finally:
+        close_logger(logger)
+
+        if scratch_dir:
+            archive_run_dir(lephare_run_path, lephare_sandbox, logs=(stdout, 'zphot.run'))
 
-    origin_path = os.getcwd()
-    os.chdir(lephare_sandbox)  
+    return result
 
-    # Gets the list of columns used by LePhare to filter photometric data
-    columns_list = get_photometric_columns(bands, photo_type, err_type, col_index, apply_corr)
 
-    # Loading in memory only the range of selected rows
-    table = parq.read_table(filename, columns=columns_list)[interval[0]:interval[1]]
-    tb = table.to_pandas()
+@python_app
+def run_zphot_batch(batch, shifts, photo_type, err_type, apply_corr, bands, zphot, col_index,
+        cat_fmt, idxs, namephotoz, lephare_dir, lephare_sandbox, stdout=None, scratch_dir=None,
+        stream=False, pdz=None, selection=None, incremental=None, timeout=None, coordinates=None,
+        retries=0):
+    """ Runs LePhare for a batch of partitions in a single task, sharing the
+    run directory, the library links and the opened input files
+
+    The failures of a partition are caught, so that the other ones are
+    computed: each partition is retried here (Parsl retries apply to the
+    whole task only).
+
+    Args:
+        batch (list): partitions, dicts with key, file, interval, output and
+            variants (optional, see run_zphot)
+        retries (int, optional): retries of a failed partition. Defaults to 0.
+        (the other arguments are the same as run_zphot)
 
-    # Gets the index column to be added to the final result
-    col_index_values = tb.get(col_index).to_numpy()
+    Returns:
+        dict: run_partition result (or error message) by partition key
+    """
+
+    import os
+    import pyarrow.parquet as parq
+    from utils import get_logger, close_logger
+    from lephare_run import run_partition
+    from scratch import create_run_dir, copy_back, archive_run_dir
 
-    # Create txt input expected by Lephare
-    lephare_input = format_input(
-        key, tb, bands, photo_type, err_type, col_index, apply_corr, cat_fmt
+    lephare_run_path = create_run_dir(lephare_sandbox, f'zphot-batch-{batch[0]["key"]}', scratch_dir)
+
+    logger = get_logger(
+        name=f'zphot-batch-{batch[0]["key"]}', debug=True,
+        stdout=os.path.join(lephare_run_path, stdout)
     )
 
-    shutil.move(lephare_input, lephare_run_path)
-    create_inputs_symbolic_link(lephare_sandbox, lephare_run_path)
+    results, parquet_files = dict(), dict()
+
+    for task in batch:
+        key, filename = task['key'], task['file']
+        output, variants = task['output'], task.get('variants')
+
+        if scratch_dir:
+            output = os.path.join(lephare_run_path, os.path.basename(output))
+            variants = [
+                dict(variant, output=os.path.join(lephare_run_path, f"{variant['name']}-{os.path.basename(variant['output'])}"))
+                for variant in variants or []
+            ]
+
+        if filename not in parquet_files:
+            parquet_files[filename] = parq.ParquetFile(filename)
+
+        for attempt in range(retries + 1):
+            try:
+                results[key] = run_partition(
+                    key, filename, task['interval'], shifts, output, photo_type, err_type,
+                    apply_corr, bands, zphot, col_index, cat_fmt, idxs, namephotoz, lephare_dir,
+                    lephare_run_path, logger, parquet_files[filename], stream, pdz,
+                    selection, incremental, timeout, variants, coordinates
+                )
 
-    os.chdir(lephare_run_path)
-    os.environ['LEPHAREWORK'] = os.getcwd()
-    # os.environ['LEPHAREDIR'] = os.path.dirname(os.path.normpath(lephare_dir))
+                if scratch_dir:
+                    copy_back(output, task['output'])
+                    results[key]["file"] = task['output']
 
-    shifts = f'-APPLY_SYSSHIFT {shifts}' if shifts else str()
-    phzout = 'lephare.out'
+                    for variant, local in zip(task.get('variants') or [], variants):
+                        os.makedirs(os.path.dirname(variant['output']), exist_ok=True)
+                        copy_back(local['output'], variant['output'])
+                        results[key]["variants"][variant['name']]["file"] = variant['output']
+                break
+            except Exception as err:
+                logger.exception(f'zphot ID {key} failed (attempt {attempt + 1} of {retries + 1})')
+                results[key] = {"name": os.path.basename(filename), "error": repr(err)}
 
-    logger.info(f'LEPHAREWORK: {os.getcwd()}')
-    logger.info(f'LEPHAREDIR: {os.getenv("LEPHAREDIR")}')
+        if results[key].get("error"):
+            continue
 
-    cmd_phz = f'{lephare_dir}/zphota -c {zphot} -CAT_IN {lephare_input} -CAT_OUT {phzout} {shifts}'
+        # ASCII files (and the node-local parquet) are no longer needed once the parquet is written
+        leftovers = [
+            os.path.join(lephare_run_path, f'lephare_{key}.input'),
+            os.path.join(lephare_run_path, f'lephare_{key}.out')
+        ]
+        if scratch_dir:
+            leftovers += [output] + [variant['output'] for variant in variants]
 
-    logger.info(f"Run zphot cmd: {cmd_phz}")
+        for path in leftovers:
+            if os.path.isfile(path):
+                os.remove(path)
 
-    subplog = open('zphot.run', 'w+')
+    close_logger(logger)
 
-    proc = subprocess.Popen(shlex.split(cmd_phz), stdout=subplog, stderr=subplog, universal_newlines=True)
-    proc.wait()
-    logger.info(f"Return code = {proc.returncode}")
+    if scratch_dir:
+        archive_run_dir(lephare_run_path, lephare_sandbox, logs=(stdout, 'zphot.run'))
 
-    # Loading lePhare output only with selected columns (idxs)
-    zphotoz = loadtxt(phzout, comments='#', usecols=(idxs), unpack=True)
+    return results
 
-    # Calculating the photoz error as the mean of Z_BEST68_LOW and Z_BEST68_HIGH
-    ihigh, ilow = namephotoz.index('Z_BEST68_HIGH'), namephotoz.index('Z_BEST68_LOW')
 
-    photozerr = abs(zphotoz[ihigh]-zphotoz[ilow])/2. #The name of the column on file must be ERR_Z
+@python_app
+def compact_outputs(partials, output_path, index_column, row_group_size, remove=True, inputs=[]):
+    """ Merges the partial outputs of an input file, once all its partitions
+    (inputs) are completed, into a single file sorted by the index column
+
+    Args:
+        partials (list): partial parquet paths
+        output_path (str): compacted file path
+        index_column (str): index column name (as in the outputs)
+        row_group_size (int): rows per row group
+        remove (bool, optional): removes the partial outputs. Defaults to True.
+        inputs (list, optional): run_zphot futures of the input file. Defaults to [].
+    """
+    import os
+    from compaction import compact_partials, remove_partials
+    from utils import file_checksum
 
-    _parquet = {}
+    rows = compact_partials(partials, output_path, index_column, row_group_size)
 
-    for value, name in zip(zphotoz, namephotoz):
-        _parquet[name.lower()] = value
+    if remove:
+        remove_partials(partials, os.path.dirname(partials[0]))
 
-    _parquet[col_index.lower()] = col_index_values
-    _parquet['err_z'] = photozerr
+    return {"file": output_path, "rows": rows, "checksum": file_checksum(output_path)}
 
-    df = pd.DataFrame(_parquet)
-    table = pa.Table.from_pandas(df, preserve_index=False)
 
-    parq.write_table(table, zphot_output)
+@python_app
+def write_healpix(paths, dataset_dir, name, nside, ra, dec, inputs=[]):
+    """ Writes the outputs of an input file, once all its partitions (or its
+    compaction) are completed, in the HEALPix dataset (hpix=<pixel>/<name>.parquet)
 
-    os.chdir(origin_path)
+    Args:
+        paths (list): photo-z outputs of the input file
+        dataset_dir (str): HEALPix dataset directory
+        name (str): input file name
+        nside (int): HEALPix resolution
+        ra (str): right ascension column (as in the outputs)
+        dec (str): declination column (as in the outputs)
+        inputs (list, optional): futures of the outputs. Defaults to [].
+
+    Returns:
+        dict: input name and rows by pixel
+    """
+    from healpix import write_pixels
+
+    return {"name": name, "pixels": write_pixels(paths, dataset_dir, name, nside, ra, dec)}
+
+
+@python_app
+def write_id_index(paths, ids_dir, name, index_column, output_dir, inputs=[]):
+    """ Writes the id sidecar of an input file, once all its partitions (or
+    its compaction) are completed
+
+    Args:
+        paths (list): photo-z outputs of the input file
+        ids_dir (str): sidecar directory
+        name (str): input file name
+        index_column (str): index column name (as in the outputs)
+        output_dir (str): output directory
+        inputs (list, optional): futures of the outputs. Defaults to [].
+
+    Returns:
+        dict: sidecar entry of the id index (see idindex.write_sidecar)
+    """
+    from idindex import write_sidecar
 
-    return {"name": os.path.basename(filename), "file": zphot_output}
\ No newline at end of file
+    return write_sidecar(paths, ids_dir, name, index_column, output_dir)
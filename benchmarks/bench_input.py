@@ -0,0 +1,206 @@
+""" Compares the LePhare input writer with the original format_input
+
+Usage:
+    python benchmarks/bench_input.py -n 1000000
+    python benchmarks/bench_input.py -n 1000000 --memory
+"""
+import os
+import sys
+import time
+import filecmp
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lephare_input import write_input
+
+
+def legacy_format_input(idx, table, bands, photo_type, err_type, index_column, corr, cat_fmt="MEME"):
+    """ Original per-object LePhare input writer, used as baseline """
+
+    CORR_SFD98 = {
+        "G": 3.185, "R": 2.140, "I": 1.571, "Z": 1.198, "Y": 1.052
+    }
+
+    ids = table.get(index_column).to_numpy()
+    n_gals = len(ids)
+    gal_number = range(1, n_gals + 1, 1)
+    _format = ['%10d']
+    mags, errs = {}, {}
+
+    for band in bands:
+        mag_values = table.get(photo_type.format(band)).to_numpy().copy()
+
+        if err_type:
+            err_values = table.get(err_type.format(band)).to_numpy().copy()
+        else:
+            err_values = np.ones_like(mag_values)
+
+        mag_values[(mag_values < 0.) + (mag_values > 30.)] = -99.
+        err_values[(mag_values < 0.) + (mag_values > 30.)] = -99.
+        mag_values[np.isnan(mag_values)] = -99.
+        err_values[np.isnan(err_values)] = -99.
+
+        if corr:
+            corr_col = table.get(corr).to_numpy()
+            mag_values[mag_values != -99.] = mag_values[mag_values != -99.] - (CORR_SFD98.get(band) * corr_col[mag_values != -99.])
+
+        mags[band] = mag_values
+        errs[band] = err_values
+        _format.append('%.5f')
+        _format.append('%.5f')
+
+    acont = list()
+
+    for obj in range(n_gals):
+        m, context = -1, 0
+        for band in bands:
+            m = m + 1
+
+            if mags[band][obj] != -99.:
+                context = context + (2**m)
+
+        acont.append(context)
+
+    acont = np.array(acont)
+    _format.append('%.6d')
+
+    z_true = np.ones(n_gals)*-99.
+    _format.append('%.5f')
+
+    columns = np.c_[gal_number]
+
+    if cat_fmt == "MEME":
+        for band in bands:
+            columns = np.c_[columns, mags[band], errs[band]]
+    elif cat_fmt == "MMEE":
+        for band in bands:
+            columns = np.c_[columns, mags[band]]
+        for band in bands:
+            columns = np.c_[columns, errs[band]]
+
+    _format.append('%10d')
+
+    columns = np.c_[columns, acont, z_true, ids]
+
+    input_file = f'lephare_{str(idx)}.input'
+    np.savetxt(input_file, columns, fmt=_format)
+
+    return input_file
+
+
+def make_catalog(nrows, bands, seed=42):
+    """ Creates a synthetic photometric catalog with invalid magnitudes
+
+    Args:
+        nrows (int): number of objects
+        bands (list): bands list
+        seed (int, optional): random seed. Defaults to 42.
+
+    Returns:
+        DataFrame: catalog with ID, EBV, MAG_{}, MAGERR_{}, RA and DEC columns
+    """
+
+    rng = np.random.default_rng(seed)
+    data = {
+        'ID': np.arange(10**8, 10**8 + nrows, dtype=np.int64),
+        'EBV': rng.uniform(0., 0.1, nrows)
+    }
+
+    for band in bands:
+        mag = rng.normal(23., 2., nrows)
+        mag[rng.random(nrows) < 0.05] = 99.
+        mag[rng.random(nrows) < 0.02] = np.nan
+        err = rng.uniform(0.001, 0.5, nrows)
+        err[rng.random(nrows) < 0.01] = np.nan
+        data[f'MAG_{band}'] = mag
+        data[f'MAGERR_{band}'] = err
+
+    # a 10 x 10 degrees patch of sky by seed
+    data['RA'] = rng.uniform(0., 10., nrows) + 15. * seed
+    data['DEC'] = rng.uniform(-45., -35., nrows)
+
+    return pd.DataFrame(data)
+
+
+def pandas_input(idx, table, *params):
+    """ Input preparation through pandas, as done before the Arrow path """
+
+    return write_input(idx, table.to_pandas(), *params)
+
+
+def peak_memory(parquet_path, name, bands):
+    """ Peak resident memory added by the input preparation of a parquet
+    file, measured in a child process after the file is read """
+
+    code = (
+        "import resource, sys, pyarrow.parquet as pq; "
+        f"sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); "
+        "from bench_input import pandas_input, write_input; "
+        f"table = pq.read_table({parquet_path!r}); "
+        "base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss; "
+        f"func = pandas_input if {name!r} == 'pandas' else write_input; "
+        f"func({name!r}, table, {bands!r}, 'MAG_{{}}', 'MAGERR_{{}}', 'ID', 'EBV', 'MEME'); "
+        "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base)"
+    )
+    proc = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True)
+
+    return int(proc.stdout.split()[-1]) * 1024
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--nrows", dest="nrows", type=int, default=200000, help="number of objects")
+    parser.add_argument("--bands", dest="bands", default="G,R,I,Z,Y", help="comma separated bands")
+    parser.add_argument("--memory", dest="memory", action="store_true", help="peak memory per row of the input preparation")
+    args = parser.parse_args()
+
+    bands = args.bands.split(',')
+    catalog = make_catalog(args.nrows, bands)
+    arrow_catalog = pa.Table.from_pandas(catalog, preserve_index=False)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+
+        if args.memory:
+            parquet_path = os.path.join(tmpdir, 'catalog.parquet')
+            pq.write_table(arrow_catalog, parquet_path)
+            width = len(bands) * 2 * 8
+
+            for name in ('pandas', 'arrow'):
+                peak = peak_memory(parquet_path, name, bands)
+                print(
+                    f"{name:6} rows={args.nrows} bands={len(bands)}: peak {peak / 2**20:.1f} MB, "
+                    f"{peak / args.nrows:.0f} bytes/row ({peak / args.nrows / width:.2f}x the photometry)"
+                )
+            sys.exit(0)
+
+        for cat_fmt in ('MEME', 'MMEE'):
+            for corr in (None, 'EBV'):
+                params = (bands, 'MAG_{}', 'MAGERR_{}', 'ID', corr, cat_fmt)
+                t_old = timed(legacy_format_input, 'old', catalog.copy(), *params)
+                t_new = timed(write_input, 'new', catalog.copy(), *params)
+                t_arrow = timed(write_input, 'arrow', arrow_catalog, *params)
+                same = filecmp.cmp('lephare_old.input', 'lephare_new.input', shallow=False)
+                same = same and filecmp.cmp('lephare_old.input', 'lephare_arrow.input', shallow=False)
+
+                print(
+                    f"{cat_fmt} corr={str(corr):4} rows={args.nrows}: "
+                    f"format_input {t_old:.2f}s, write_input {t_new:.2f}s (arrow {t_arrow:.2f}s), "
+                    f"speedup {t_old / t_new:.1f}x, identical={same}"
+                )
+
+                if not same:
+                    sys.exit(1)
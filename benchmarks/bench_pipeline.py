@@ -0,0 +1,396 @@
+""" Runs pz-run.py end to end with the LePhare stand-in (fake_lephare.py)
+on generated catalogs, recording throughput, stage times and peak memory
+
+Usage:
+    python benchmarks/bench_pipeline.py --rows 200000 --files 4 --executors local local_threads
+    python benchmarks/bench_pipeline.py --output new.json --baseline old.json --tolerance 0.2
+"""
+import os
+import re
+import sys
+import json
+import time
+import glob
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+import yaml
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PHZ_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, PHZ_ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_input import make_catalog
+from utils import get_photometric_columns, prepare_format_output, read_interval, plan_partitions
+from lephare_input import write_input
+from lephare_output import write_output
+
+LEPHARE_PROGRAMS = ('sedtolib', 'filter', 'mag_gal', 'zphota')
+
+
+def create_fake_lephare(bin_dir):
+    """ Creates the LePhare binaries directory with links to the stand-in """
+
+    os.makedirs(bin_dir, exist_ok=True)
+    fake = os.path.join(BENCH_DIR, 'fake_lephare.py')
+    os.chmod(fake, 0o755)
+
+    for program in LEPHARE_PROGRAMS:
+        link = os.path.join(bin_dir, program)
+        if not os.path.lexists(link):
+            os.symlink(fake, link)
+
+
+def create_inputs(workdir, nrows, nfiles, bands, row_group_size, sed_shards=1):
+    """ Writes the catalogs and zphot.para used by the benchmark (with
+    extinction over a range of models crossing the SED subsets when mag_gal
+    is split) """
+
+    cats_dir = os.path.join(workdir, 'cats')
+    os.makedirs(cats_dir, exist_ok=True)
+
+    for nfile in range(nfiles):
+        catalog = make_catalog(nrows, bands, seed=nfile)
+        catalog['ID'] += nfile * nrows
+        pq.write_table(
+            pa.Table.from_pandas(catalog, preserve_index=False),
+            os.path.join(cats_dir, f'cat-{nfile:03d}.parquet'), row_group_size=row_group_size
+        )
+
+    zphot_para = os.path.join(workdir, 'zphot.para')
+    template = os.path.join(PHZ_ROOT, 'sample-data', 'zphot', 'zphot.para.template')
+
+    with open(template) as sources, open(zphot_para, 'w') as para:
+        for line in sources:
+            if line.startswith('PARA_OUT'):
+                line = f"PARA_OUT {PHZ_ROOT}/sample-data/zphot/zphot_output.para\n"
+            elif line.startswith('GAL_SED'):
+                line = f"GAL_SED {PHZ_ROOT}/sample-data/DES/SED/COSMOS_SED/COSMOS_MOD.list\n"
+            elif line.startswith('FILTER_LIST'):
+                line = 'FILTER_LIST ' + ','.join(f'fake/{band}.dat' for band in bands) + '\n'
+            elif line.startswith('MOD_EXTINC') and sed_shards > 1:
+                line = 'MOD_EXTINC 4,14\n'
+            elif line.startswith('EB_V') and sed_shards > 1:
+                line = 'EB_V 0.,0.1,0.2\n'
+            para.write(line)
+
+    return os.path.join(cats_dir, '*.parquet'), zphot_para
+
+
+def create_config(workdir, executor, photometric_data, zphot_para, bin_dir, bands, args):
+    config = {
+        'algorithm': 'lephare',
+        'phz_root_dir': workdir,
+        'executor': executor,
+        'inputs': {'photometric_data': photometric_data, 'zphot': zphot_para},
+        'output_dir': 'outputs',
+        'settings': {
+            'photo_type': 'MAG_{}', 'err_type': 'MAGERR_{}', 'bands': bands,
+            'partitions': args.partitions, 'index': 'ID', 'lephare_bin': bin_dir,
+            'batch_size': args.batch_size, 'stream': args.stream,
+            'max_in_flight': args.max_in_flight
+        },
+        'test_environment': {'turn_on': False}
+    }
+
+    if args.rows_per_task:
+        config['settings']['rows_per_task'] = args.rows_per_task
+
+    if args.pdz is not None:
+        config['settings']['pdz'] = {'turn_on': True, 'quantize': args.pdz or None}
+
+    if args.min_bands is not None:
+        config['settings']['selection'] = {
+            'turn_on': True, 'min_bands': args.min_bands,
+            'mag_limits': {band: [None, args.max_mag] for band in bands} if args.max_mag else {}
+        }
+
+    if args.fail_ids or args.timeout:
+        config['failures'] = {'retries': 1, 'bisect': True, 'min_rows': 100, 'timeout': args.timeout}
+
+    if args.sed_shards > 1:
+        # the merged library is compared with a single mag_gal run
+        config['libraries'] = {'sed_shards': args.sed_shards, 'verify': True}
+
+    if args.speculate:
+        config['settings']['speculation'] = {'turn_on': True, 'min_completed': 3, 'check_seconds': 1}
+
+    if args.previous:
+        config['incremental'] = {'turn_on': True, 'previous': args.previous}
+
+    if args.scratch:
+        config['scratch'] = {'turn_on': True, 'path': args.scratch}
+
+    if args.id_index:
+        config['id_index'] = {'turn_on': True}
+
+    if args.nside:
+        config['settings']['coordinates'] = ['RA', 'DEC']
+        config['healpix'] = {'turn_on': True, 'nside': args.nside}
+
+    if args.sweep:
+        # shifted variants, the last one with its own magnitudes library
+        variants = [{
+            'name': f'shift{number}', 'shifts': ','.join(['0.01'] * number + ['0.0'] * (len(bands) - number))
+        } for number in range(1, args.sweep + 1)]
+
+        alternate = os.path.join(workdir, 'zphot_sweep.para')
+        with open(zphot_para) as sources, open(alternate, 'w') as para:
+            for line in sources:
+                para.write('GAL_LIB_OUT COSMOS_SED_SWEEP\n' if line.startswith('GAL_LIB_OUT') else line)
+        variants[-1]['zphot'] = alternate
+
+        config['sweep'] = {'turn_on': True, 'variants': variants}
+
+    config_path = os.path.join(workdir, f'{executor}.yml')
+    with open(config_path, 'w') as _file:
+        yaml.dump(config, _file)
+
+    return config_path
+
+
+def parse_pipeline_log(log_path):
+    """ Extracts the stage durations logged by pz-run.py """
+
+    patterns = {
+        'libraries': r'steps 1,2 and 3 completed: (\d+) seconds',
+        'photoz': r'step 4 completed: (\d+) seconds',
+        'full': r'Full runtime: (\d+) seconds',
+        'speculative_copies': r'speculative copies: (\d+)',
+        'workers': r'speculative copies: .*workers: (\d+)',
+        'sed_subsets': r'theoretical magnitudes library, (\d+) SED subsets'
+    }
+    stages = dict()
+
+    if not os.path.isfile(log_path):
+        return stages
+
+    with open(log_path) as _file:
+        content = _file.read()
+
+    for stage, pattern in patterns.items():
+        match = re.search(pattern, content)
+        if match:
+            stages[stage] = int(match.group(1))
+
+    return stages
+
+
+def run_pipeline(workdir, config_path, env):
+    """ Runs pz-run.py and returns wall time, peak memory and log stages
+
+    The peak memory is the largest resident size of this pz-run.py process
+    and of the descendants it waited for (wait4 rusage), so each run is
+    measured on its own.
+    """
+
+    rundir = os.path.splitext(config_path)[0]
+    shutil.rmtree(rundir, ignore_errors=True)
+
+    # the output goes to a file: the process is reaped by wait4, which returns its rusage
+    output_path = f'{rundir}.out'
+    start = time.perf_counter()
+    with open(output_path, 'w') as output:
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(PHZ_ROOT, 'pz-run.py'), config_path, '-w', rundir],
+            cwd=PHZ_ROOT, env=env, stdout=output, stderr=subprocess.STDOUT
+        )
+        _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+    if proc.returncode != 0:
+        with open(output_path) as output:
+            print(output.read())
+        raise RuntimeError(f'pz-run.py failed with return code {proc.returncode}')
+
+    # the sweep and HEALPix copies (directories starting with _) are not counted
+    outputs = [
+        path for path in glob.glob(os.path.join(rundir, 'sandbox', 'outputs', '**', '*.parquet'), recursive=True)
+        if not any(part.startswith('_') for part in os.path.relpath(path, rundir).split(os.sep))
+    ]
+    rows = sum(pq.read_metadata(path).num_rows for path in outputs)
+
+    return {
+        'wall_seconds': round(wall, 3),
+        'rows': rows,
+        'rows_per_second': round(rows / wall, 1),
+        'peak_memory_mb': round(usage.ru_maxrss / 1024., 1),
+        'stages_seconds': parse_pipeline_log(os.path.join(rundir, 'sandbox', 'pipeline.log'))
+    }
+
+
+def profile_stages(workdir, photometric_data, zphot_para, bin_dir, bands, env):
+    """ Times each step of run_zphot for the first partition, in process """
+
+    from utils import read_zphot_para
+
+    filename = sorted(glob.glob(photometric_data))[0]
+    interval = plan_partitions([filename], {'partitions': 1})[0]['ranges'][0]
+    para = read_zphot_para(zphot_para)
+    idxs, namephotoz = prepare_format_output(bands, para.get('PARA_OUT'))
+
+    stage_dir = os.path.join(workdir, 'stages')
+    os.makedirs(stage_dir, exist_ok=True)
+    phzout = os.path.join(stage_dir, 'lephare.out')
+
+    times = dict()
+
+    def timed(stage, func, *func_args, **func_kwargs):
+        start = time.perf_counter()
+        result = func(*func_args, **func_kwargs)
+        times[stage] = round(time.perf_counter() - start, 4)
+        return result
+
+    columns = get_photometric_columns(bands, 'MAG_{}', 'MAGERR_{}', 'ID')
+    table = timed('read', read_interval, filename, interval, columns)
+    lephare_input = timed(
+        'format', write_input, 0, table, bands, 'MAG_{}', 'MAGERR_{}', 'ID', None,
+        para.get('CAT_FMT'), path=stage_dir
+    )
+    timed('zphota', subprocess.run, [
+        os.path.join(bin_dir, 'zphota'), '-c', zphot_para,
+        '-CAT_IN', lephare_input, '-CAT_OUT', phzout
+    ], check=True, env=env, cwd=stage_dir)
+    timed(
+        'parse_write', write_output, phzout, idxs, namephotoz, 'ID',
+        table.column('ID'), os.path.join(stage_dir, 'photoz.parquet')
+    )
+
+    times['rows'] = interval[1] - interval[0]
+
+    return times
+
+
+def compare(results, baseline, tolerance):
+    """ Lists the executors whose throughput dropped more than tolerance """
+
+    regressions = list()
+
+    for executor, result in results.get('runs', {}).items():
+        reference = baseline.get('runs', {}).get(executor)
+        if not reference:
+            continue
+
+        minimum = reference['rows_per_second'] * (1. - tolerance)
+        if result['rows_per_second'] < minimum:
+            regressions.append(
+                f"{executor}: {result['rows_per_second']} rows/s < {minimum:.1f} rows/s"
+            )
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", dest="rows", type=int, default=100000, help="rows per file")
+    parser.add_argument("--files", dest="files", type=int, default=4, help="number of files")
+    parser.add_argument("--bands", dest="bands", default="G,R,I,Z", help="comma separated bands")
+    parser.add_argument("--row-group-size", dest="row_group_size", type=int, default=50000)
+    parser.add_argument("--partitions", dest="partitions", type=int, default=4, help="partitions per file")
+    parser.add_argument("--rows-per-task", dest="rows_per_task", type=int, default=None)
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=1)
+    parser.add_argument("--max-in-flight", dest="max_in_flight", type=int, default=1000, help="Parsl tasks in flight")
+    parser.add_argument("--pdz", dest="pdz", type=int, default=None, help="stores the PDFs, quantized with 8 or 16 bits (0 for float32)")
+    parser.add_argument("--min-bands", dest="min_bands", type=int, default=None, help="fits only the objects with this number of valid bands")
+    parser.add_argument("--max-mag", dest="max_mag", type=float, default=None, help="with --min-bands, faintest valid magnitude")
+    parser.add_argument("--previous", dest="previous", default=None, help="incremental run over the outputs of this directory")
+    parser.add_argument("--stream", dest="stream", action="store_true", help="named pipes between the pipeline and zphota")
+    parser.add_argument("--scratch", dest="scratch", default=None, help="node-local run directory (e.g. /dev/shm)")
+    parser.add_argument("--executors", dest="executors", nargs='+', default=['local', 'local_threads'])
+    parser.add_argument("--lib-seconds", dest="lib_seconds", type=float, default=0., help="fake sedtolib/filter/mag_gal duration")
+    parser.add_argument("--setup-seconds", dest="setup_seconds", type=float, default=0., help="fake zphota fixed duration")
+    parser.add_argument("--rows-per-sec", dest="rows_per_sec", type=float, default=0., help="fake zphota speed, 0 for no delay")
+    parser.add_argument("--fail-ids", dest="fail_ids", type=int, nargs='*', default=[], help="object ids making the fake zphota fail")
+    parser.add_argument("--timeout", dest="timeout", type=float, default=None, help="zphota timeout (seconds)")
+    parser.add_argument("--stragglers", dest="stragglers", nargs='*', default=[], help="id:seconds, first zphota run with the object sleeps")
+    parser.add_argument("--id-index", dest="id_index", action="store_true", help="sidecar index of the object ids")
+    parser.add_argument("--nside", dest="nside", type=int, default=None, help="HEALPix layout of the outputs")
+    parser.add_argument("--sweep", dest="sweep", type=int, default=0, help="number of sweep variants")
+    parser.add_argument("--sed-shards", dest="sed_shards", type=int, default=1, help="mag_gal SED subsets, checked against a single run")
+    parser.add_argument("--speculate", dest="speculate", action="store_true", help="speculative copies of the stragglers")
+    parser.add_argument("--workdir", dest="workdir", default=None, help="kept working directory (default: temporary)")
+    parser.add_argument("--output", dest="output", default=None, help="results json")
+    parser.add_argument("--baseline", dest="baseline", default=None, help="results json to compare with")
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=0.2, help="allowed throughput drop")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='phz-bench-')
+    workdir = os.path.abspath(workdir)
+    bands = args.bands.split(',')
+    bin_dir = os.path.join(workdir, 'bin')
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [PHZ_ROOT, env.get('PYTHONPATH')]))
+    env['FAKE_LEPHARE_LIB_SECONDS'] = str(args.lib_seconds)
+    env['FAKE_LEPHARE_SETUP_SECONDS'] = str(args.setup_seconds)
+    env['FAKE_LEPHARE_ROWS_PER_SEC'] = str(args.rows_per_sec)
+    env['FAKE_LEPHARE_FAIL_IDS'] = ','.join(str(ident) for ident in args.fail_ids)
+    env['FAKE_LEPHARE_STRAGGLERS'] = ','.join(args.stragglers)
+
+    create_fake_lephare(bin_dir)
+    photometric_data, zphot_para = create_inputs(
+        workdir, args.rows, args.files, bands, args.row_group_size, args.sed_shards
+    )
+
+    results = {
+        'host': socket.gethostname(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': vars(args), 'runs': dict()
+    }
+
+    results['stages'] = profile_stages(
+        workdir, photometric_data, zphot_para, bin_dir, bands,
+        dict(env, FAKE_LEPHARE_FAIL_IDS='', FAKE_LEPHARE_STRAGGLERS='')
+    )
+    print(f"stages (first partition): {results['stages']}")
+
+    for executor in args.executors:
+        config_path = create_config(
+            workdir, executor, photometric_data, zphot_para, bin_dir, bands, args
+        )
+        run = run_pipeline(workdir, config_path, env)
+        results['runs'][executor] = run
+        print(f"{executor}: {run}")
+
+    # the stragglers (wherever they are in the run) must get a copy, when another worker can run it
+    if args.speculate and args.stragglers:
+        missed = [
+            executor for executor, run in results['runs'].items()
+            if run['stages_seconds'].get('workers', 0) > 1 and not run['stages_seconds'].get('speculative_copies')
+        ]
+        for executor in missed:
+            print(f"FAILED {executor}: no speculative copy of the stragglers {args.stragglers}")
+
+        if missed:
+            sys.exit(1)
+
+    # a split mag_gal fails the run when its merged library differs from a single run
+    if args.sed_shards > 1:
+        unsplit = [executor for executor, run in results['runs'].items() if not run['stages_seconds'].get('sed_subsets')]
+        for executor in unsplit:
+            print(f"FAILED {executor}: mag_gal not split by SED subset")
+
+        if unsplit:
+            sys.exit(1)
+
+    if args.output:
+        with open(args.output, 'w') as _file:
+            json.dump(results, _file, indent=2)
+
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline) as _file:
+            regressions = compare(results, json.load(_file), args.tolerance)
+
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+""" Stand-in for the LePhare binaries used by the pipeline
+
+The program behaves as sedtolib, filter, mag_gal or zphota depending on the
+name it is called with (the benchmark creates symbolic links with these
+names). sedtolib numbers the SEDs of GAL_SED, mag_gal writes a synthetic
+library (.bin records starting with the model number, .doc and, with
+LIB_ASCII, .dat) with a magnitude per model, extinction, redshift and filter.
+zphota writes a synthetic output in the PARA_OUT layout, one line per input
+object.
+
+Environment variables:
+    FAKE_LEPHARE_LIB_SECONDS: duration of sedtolib, filter and mag_gal (default 0)
+    FAKE_LEPHARE_SETUP_SECONDS: fixed duration of each zphota call (default 0)
+    FAKE_LEPHARE_ROWS_PER_SEC: zphota fitting speed, 0 means no delay (default 0)
+    FAKE_LEPHARE_FAIL_IDS: comma separated object ids making zphota exit with code 1
+    FAKE_LEPHARE_STRAGGLERS: comma separated id:seconds, the first zphota run with the
+        object sleeps (a slow node), the next ones do not
+"""
+import os
+import sys
+import time
+import zlib
+import numpy as np
+
+
+# zphota output columns with synthetic values, the other ones are constant
+VARYING = ('Z_BEST', 'Z_BEST68_LOW', 'Z_BEST68_HIGH', 'Z_ML', 'PDZ_BEST')
+
+
+def read_args(argv):
+    args = dict()
+
+    for flag, value in zip(argv[::2], argv[1::2]):
+        args[flag.lstrip('-')] = value
+
+    return args
+
+
+def read_para(path):
+    para = dict()
+
+    with open(path) as _file:
+        for line in _file:
+            fields = line.split()
+            if fields and not fields[0].startswith('#'):
+                para[fields[0]] = ''.join(fields[1:])
+
+    return para
+
+
+def output_columns(para_out, nbands):
+    columns = list()
+
+    with open(para_out) as _file:
+        for line in _file:
+            col = line.strip()
+            if col and not col.startswith('#'):
+                if '()' in col:
+                    columns.extend(col.replace('()', f'_{band}') for band in range(nbands))
+                else:
+                    columns.append(col)
+
+    return columns
+
+
+def write_doc(path, entries, date=False):
+    with open(path, 'w') as _file:
+        _file.writelines(f'{key:<20s} {value}\n' for key, value in entries)
+        if date:
+            _file.write(f"{'CREATION_DATE':<20s} {time.ctime()}\n")
+
+
+def sedtolib(para):
+    """ Writes the SED library: the model number and name of each SED """
+
+    os.makedirs('lib_bin', exist_ok=True)
+    name = os.path.join('lib_bin', para.get('GAL_LIB'))
+
+    with open(os.path.expandvars(para.get('GAL_SED'))) as _file:
+        seds = [line.strip() for line in _file if line.split() and not line.lstrip().startswith('#')]
+
+    record = np.dtype([('model', '=i4'), ('name', 'S64')])
+    models = np.array(list(zip(range(1, len(seds) + 1), seds)), dtype=record)
+    models.tofile(name + '.bin')
+    write_doc(name + '.doc', [('GAL_SED', para.get('GAL_SED')), ('NUMBER_SED', len(seds))])
+
+    time.sleep(float(os.getenv('FAKE_LEPHARE_LIB_SECONDS', 0)))
+
+
+def mag_gal(para):
+    """ Writes the magnitudes library, a record per model, extinction and
+    redshift of the Z_STEP grid """
+
+    os.makedirs('lib_mag', exist_ok=True)
+    name = os.path.join('lib_mag', para.get('GAL_LIB_OUT'))
+    models = np.fromfile(
+        os.path.join('lib_bin', para.get('GAL_LIB_IN') + '.bin'), dtype=[('model', '=i4'), ('name', 'S64')]
+    )
+
+    nbands = len(para.get('FILTER_LIST', '').split(','))
+    dz, zmax = [float(value) for value in para.get('Z_STEP').split(',')[:2]]
+    grid = np.arange(0., zmax + dz / 2., dz)
+    ebvs = [float(value) for value in para.get('EB_V', '0').split(',')]
+    ranges = [int(value) for value in para.get('MOD_EXTINC', '0,0').split(',')]
+
+    record = np.dtype([('model', '=i4'), ('law', '=i4'), ('ebv', '=f4'), ('z', '=f4'), ('mag', '=f4', nbands)])
+    rows = list()
+
+    for model, sed in models.tolist():
+        laws = [law for law, (low, high) in enumerate(zip(ranges[::2], ranges[1::2]), 1) if low <= model <= high]
+        colors = np.random.default_rng(zlib.crc32(sed)).uniform(0., 1., nbands)
+
+        for law, ebv in [(law, ebv) for law in laws for ebv in ebvs] or [(0, 0.)]:
+            for z in grid:
+                rows.append((model, law, ebv, z, 20. + colors + 2.5 * z + 4. * ebv))
+
+    library = np.array(rows, dtype=record)
+    library.tofile(name + '.bin')
+    write_doc(name + '.doc', [
+        ('GAL_LIB_IN', para.get('GAL_LIB_IN')), ('GAL_LIB_OUT', para.get('GAL_LIB_OUT')),
+        ('Z_STEP', para.get('Z_STEP')), ('MOD_EXTINC', para.get('MOD_EXTINC')),
+        ('NUMBER_SED', len(models)), ('NUMBER_ROWS', len(library))
+    ], date=True)
+
+    if para.get('LIB_ASCII', 'NO') == 'YES':
+        with open(name + '.dat', 'w') as _file:
+            _file.write('# model law ebv z mags\n')
+            row_fmt = '%6d %2d %6.3f %7.3f' + ' %8.4f' * nbands + '\n'
+            _file.writelines(
+                row_fmt % ((row[0], row[1], row[2], row[3]) + tuple(row[4])) for row in library.tolist()
+            )
+
+    time.sleep(float(os.getenv('FAKE_LEPHARE_LIB_SECONDS', 0)))
+
+
+def create_lib(para, dirname, key):
+    os.makedirs(dirname, exist_ok=True)
+    name = para.get(key, 'FAKE')
+
+    with open(os.path.join(dirname, f'{name}.fake'), 'w') as _file:
+        _file.write('fake LePhare library\n')
+
+    time.sleep(float(os.getenv('FAKE_LEPHARE_LIB_SECONDS', 0)))
+
+
+def zphota(para, args):
+    nbands = len(para.get('FILTER_LIST', '').split(','))
+    columns = output_columns(para.get('PARA_OUT'), nbands)
+
+    fail_ids = set(filter(None, os.getenv('FAKE_LEPHARE_FAIL_IDS', '').split(',')))
+    stragglers = dict(
+        item.split(':') for item in filter(None, os.getenv('FAKE_LEPHARE_STRAGGLERS', '').split(','))
+    )
+
+    with open(args.get('CAT_IN'), 'rb') as _file:
+        if fail_ids or stragglers:
+            ids = [line.split()[-1].decode() for line in _file]
+            if fail_ids.intersection(ids):
+                print('fake zphota: failing object')
+                sys.exit(1)
+            for ident in set(stragglers).intersection(ids):
+                # marker in the sandbox (parent of the run directory)
+                marker = os.path.join(os.path.dirname(os.getcwd()), f'.straggler-{ident}')
+                if not os.path.exists(marker):
+                    open(marker, 'w').close()
+                    time.sleep(float(stragglers[ident]))
+            nrows = len(ids)
+        else:
+            nrows = sum(block.count(b'\n') for block in iter(lambda: _file.read(1 << 20), b''))
+
+    rows_per_sec = float(os.getenv('FAKE_LEPHARE_ROWS_PER_SEC', 0))
+    time.sleep(float(os.getenv('FAKE_LEPHARE_SETUP_SECONDS', 0)))
+    if rows_per_sec > 0:
+        time.sleep(nrows / rows_per_sec)
+
+    fmt = list()
+    for col in columns:
+        if col == 'IDENT':
+            fmt.append('%9d')
+        elif col in VARYING:
+            fmt.append('%8.4f')
+        else:
+            fmt.append('-99.0000')
+    row_fmt = ' ' + ' '.join(fmt) + '\n'
+
+    rng = np.random.default_rng(nrows)
+    zbest = rng.uniform(0., 2., nrows)
+    values = {
+        'Z_BEST': zbest, 'Z_ML': zbest + rng.normal(0., 0.01, nrows),
+        'Z_BEST68_LOW': zbest - 0.05, 'Z_BEST68_HIGH': zbest + 0.05,
+        'PDZ_BEST': rng.uniform(0., 100., nrows)
+    }
+    ordered = [range(1, nrows + 1) if col == 'IDENT' else values[col].tolist()
+        for col in columns if col == 'IDENT' or col in VARYING]
+
+    with open(args.get('CAT_OUT'), 'w') as _file:
+        _file.write('# fake zphota output\n')
+        _file.write('# ' + ' '.join(columns) + '\n')
+        _file.writelines(map(row_fmt.__mod__, zip(*ordered)))
+
+    if args.get('PDZ_OUT'):
+        write_pdz(args, para, zbest)
+
+
+def write_pdz(args, para, zbest):
+    """ Writes a gaussian PDF per object on the Z_STEP grid (up to zmax) """
+
+    dz, zmax = [float(value) for value in para.get('Z_STEP').split(',')[:2]]
+    grid = np.arange(0., zmax + dz / 2., dz)
+    pdfs = np.exp(-0.5 * ((grid[None, :] - zbest[:, None]) / 0.1) ** 2)
+    pdfs /= pdfs.sum(axis=1)[:, None]
+
+    path = f"{args.get('PDZ_OUT')}_{args.get('PDZ_TYPE', 'BAY_ZG')}.prob"
+    with open(path, 'w') as _file:
+        _file.write('# ' + ' '.join(f'{z:.3f}' for z in grid) + '\n')
+        row_fmt = '%d ' + ' '.join(['%.5e'] * len(grid)) + '\n'
+        _file.writelines(
+            row_fmt % ((ident,) + tuple(pdf)) for ident, pdf in enumerate(pdfs.tolist(), 1)
+        )
+
+
+if __name__ == '__main__':
+    program = os.path.basename(sys.argv[0])
+    args = read_args(sys.argv[1:])
+    para = read_para(args.get('c'))
+    para.update((key, value) for key, value in args.items() if key.isupper())
+
+    if program == 'sedtolib':
+        sedtolib(para)
+    elif program == 'filter':
+        create_lib(para, 'filt', 'FILTER_FILE')
+    elif program == 'mag_gal':
+        mag_gal(para)
+    elif program == 'zphota':
+        zphota(para, args)
+    else:
+        print(f'unexpected program name: {program}')
+        sys.exit(1)
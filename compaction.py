@@ -0,0 +1,171 @@
+import os
+import shutil
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# rows per row group of the compacted files
+ROW_GROUP_SIZE = 1000000
+
+# dataset summary file written next to the compacted files
+METADATA_FILE = '_metadata'
+
+
+def sorted_run(path, index_column, run_path):
+    """ Returns a partial output sorted by the index column, writing a sorted
+    copy (run_path) when it is not
+
+    Args:
+        path (str): partial parquet path
+        index_column (str): index column name (as in the outputs)
+        run_path (str): path of the sorted copy
+
+    Returns:
+        tuple(str, int): sorted parquet path (path or run_path) and its first
+        id, None when it is empty
+    """
+
+    ids = pq.read_table(path, columns=[index_column]).column(0).to_numpy()
+
+    if not len(ids):
+        return path, None
+
+    if np.all(ids[1:] >= ids[:-1]):
+        return path, ids[0]
+
+    order = np.argsort(ids, kind='stable')
+    pq.write_table(pq.read_table(path).take(pa.array(order)), run_path)
+
+    return run_path, ids[order[0]]
+
+
+def compact_partials(partials, output_path, index_column, row_group_size=ROW_GROUP_SIZE):
+    """ Merges the partial photo-z outputs of an input file into a single
+    parquet file sorted by the index column
+
+    The partials, sorted by the index column (see sorted_run), are merged
+    by blocks (k-way merge). A partial is opened once the merge reaches its
+    first id, so only the partials with overlapping ids are read at the
+    same time (one at a time for consecutive intervals of a sorted input).
+
+    Args:
+        partials (list): partial parquet paths
+        output_path (str): compacted file path
+        index_column (str): index column name (as in the outputs)
+        row_group_size (int, optional): rows per row group. Defaults to ROW_GROUP_SIZE.
+
+    Returns:
+        int: number of rows written
+    """
+
+    partials = sorted(partials)
+    runs = [
+        sorted_run(path, index_column, f'{output_path}.run{number}')
+        for number, path in enumerate(partials)
+    ]
+    schema = pq.read_schema(partials[0])
+
+    def blocks(path):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=row_group_size):
+            table = pa.Table.from_batches([batch]).cast(schema)
+            yield table, table.column(index_column).to_numpy()
+
+    # runs not opened yet, by first id, and current block (table, ids, first row not merged) of the opened ones
+    waiting = sorted((first, number) for number, (_, first) in enumerate(runs) if first is not None)
+    cursors = dict()
+
+    # written with a temporary name so a partial file is never taken as complete
+    tmp_path = f'{output_path}.tmp'
+    buffered, rows = list(), 0
+
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        while cursors or waiting:
+            # the rows up to the smallest last id of the current blocks come before any row not read yet
+            while waiting and (not cursors or waiting[0][0] <= min(cursor[2][-1] for cursor in cursors.values())):
+                number = waiting.pop(0)[1]
+                iterator = blocks(runs[number][0])
+                table, ids = next(iterator)
+                cursors[number] = [iterator, table, ids, 0]
+
+            bound = min(cursor[2][-1] for cursor in cursors.values())
+            pieces = list()
+
+            for number in list(cursors):
+                iterator, table, ids, first = cursors[number]
+                last = int(np.searchsorted(ids, bound, side='right'))
+                if last > first:
+                    pieces.append(table.slice(first, last - first))
+                cursors[number][3] = last
+
+                if last == len(ids):
+                    block = next(iterator, None)
+                    if block is None:
+                        del cursors[number]
+                    else:
+                        cursors[number][1:] = [block[0], block[1], 0]
+
+            merged = pa.concat_tables(pieces)
+            if len(pieces) > 1:
+                merged = merged.take(pa.array(np.argsort(merged.column(index_column).to_numpy(), kind='stable')))
+            buffered.append(merged)
+
+            if sum(table.num_rows for table in buffered) >= row_group_size or not (cursors or waiting):
+                table = pa.concat_tables(buffered)
+                full = table.num_rows if not (cursors or waiting) else table.num_rows - table.num_rows % row_group_size
+                writer.write_table(table.slice(0, full), row_group_size=row_group_size)
+                buffered = [table.slice(full)] if full < table.num_rows else list()
+                rows += full
+
+    os.replace(tmp_path, output_path)
+
+    for run_path, _ in runs:
+        if run_path not in partials:
+            os.remove(run_path)
+
+    return rows
+
+
+def remove_partials(partials, partials_dir=None):
+    """ Removes the partial outputs already merged
+
+    Args:
+        partials (list): partial parquet paths
+        partials_dir (str, optional): directory removed when empty. Defaults to None.
+    """
+
+    for path in partials:
+        if os.path.isfile(path):
+            os.remove(path)
+
+    if partials_dir and os.path.isdir(partials_dir) and not os.listdir(partials_dir):
+        shutil.rmtree(partials_dir)
+
+
+def write_dataset_metadata(dataset_dir, files):
+    """ Writes the _metadata summary with the footers of the dataset files,
+    so readers can plan the reads without opening every file
+
+    Args:
+        dataset_dir (str): dataset directory
+        files (list): parquet paths inside dataset_dir
+
+    Returns:
+        str: summary file path, None when there are no files
+    """
+
+    collector, schema = list(), None
+
+    for path in sorted(files):
+        metadata = pq.read_metadata(path)
+        metadata.set_file_path(os.path.relpath(path, dataset_dir))
+        collector.append(metadata)
+        schema = schema or pq.read_schema(path)
+
+    if not collector:
+        return None
+
+    summary = os.path.join(dataset_dir, METADATA_FILE)
+    pq.write_metadata(schema, summary, metadata_collector=collector)
+
+    return summary
@@ -1,3 +1,4 @@
+import os
 from parsl import ThreadPoolExecutor
 from parsl.config import Config
 from parsl.monitoring.monitoring import MonitoringHub
@@ -7,54 +8,188 @@ from parsl.executors import HighThroughputExecutor
 from parsl.addresses import address_by_hostname
 
 
-def get_config(phz_config):
+# executor profiles, any key can be overridden in config.yml (executors: <name>: ...)
+# max_workers, max_threads and mem_per_worker accept "auto"
+PROFILES = {
+    "htcondor": {
+        "type": "htex", "provider": "condor",
+        "max_workers": 54, # memory per worker: rows per task * 8 * (2 * bands + 2) bytes + ~64 MB (see README, Benchmarks)
+        "cores_per_worker": 1, "mem_per_worker": None,
+        "init_blocks": 15, "min_blocks": 15, "max_blocks": 16, "parallelism": 0.5,
+        "scheduler_options": "+RequiresWholeMachine = True",
+        "worker_init": "source {phz_root_dir}/env.sh", "cmd_timeout": 120
+    },
+    "local": {
+        "type": "htex", "provider": "local",
+        "max_workers": "auto", "cores_per_worker": 1, "mem_per_worker": None,
+        "init_blocks": 1, "min_blocks": 1, "max_blocks": 2, "parallelism": 0.5
+    },
+    "local_processes": {
+        "type": "htex", "provider": "local",
+        "max_workers": "auto", "cores_per_worker": 1, "mem_per_worker": "auto",
+        "init_blocks": 1, "min_blocks": 1, "max_blocks": 1, "parallelism": 1
+    },
+    "local_threads": {
+        "type": "threads", "max_threads": 2
+    }
+}
+
+# zphota memory (MB) used by the "auto" mem_per_worker estimate when there are no measurements
+ZPHOTA_MEMORY = 512
+
+# margin applied to the measured task memory
+MEMORY_MARGIN = 1.25
+
+
+def get_profile(phz_config):
     """
-    Creates an instance of the Parsl configuration 
+    Returns the executor profile selected in the config.yml, with its overrides
 
     Args:
         phz_config (dict): Photo-z pipeline configuration - available in the config.yml
+
+    Returns:
+        dict: executor settings
+    """
+
+    executor_key = phz_config.get("executor", "local")
+    overrides = phz_config.get("executors", {}).get(executor_key, {})
+
+    if executor_key not in PROFILES and not overrides.get("type"):
+        print(f"Executor {executor_key}: unknown profile, set its type in executors")
+        raise BaseException
+
+    profile = dict(PROFILES.get(executor_key, {}))
+    profile.update(overrides)
+    profile["label"] = executor_key
+
+    return profile
+
+
+def task_memory(phz_config, profile):
+    """
+    Estimates the memory of a task (GB), used by mem_per_worker: "auto"
+
+    The peak memory recorded by a previous run (memory_from: timings.jsonl)
+    is used when available, otherwise it is computed from the partition size
+    (settings.rows_per_task or task_seconds * throughput) and the bands.
+
+    Args:
+        phz_config (dict): Photo-z pipeline configuration
+        profile (dict): executor settings
+
+    Returns:
+        float: memory per task in GB, None when it can not be estimated
+    """
+
+    timings_path = profile.get("memory_from")
+
+    if timings_path and os.path.isfile(timings_path):
+        from timing import load_timings
+
+        peaks = [
+            sum(record.get("memory_mb", {}).values())
+            for record in load_timings(timings_path)
+        ]
+        if peaks and max(peaks):
+            return round(max(peaks) * MEMORY_MARGIN / 1024., 2)
+
+    settings = phz_config.get("settings", {})
+    rows = settings.get("rows_per_task")
+
+    if not rows and settings.get("task_seconds") and settings.get("throughput"):
+        rows = settings.get("task_seconds") * settings.get("throughput")
+
+    if not rows:
+        return None
+
+    # partition (index, correction, magnitudes and errors) and photo-z table
+    ncolumns = 2 * len(settings.get("bands", [])) + 2 + 8
+    memory = rows * 8 * ncolumns / 2**20 + 64 + profile.get("zphota_memory", ZPHOTA_MEMORY)
+
+    return round(memory / 1024., 2)
+
+
+def get_executor(phz_config, profile):
+    """
+    Creates the Parsl executor of a profile
+
+    Args:
+        phz_config (dict): Photo-z pipeline configuration
+        profile (dict): executor settings (see get_profile)
+
+    Returns:
+        executor: Parsl executor
     """
 
     phz_root_dir = phz_config.get("phz_root_dir")
+    label = profile.get("label")
 
-    executors = {
-        "htcondor": HighThroughputExecutor(
-            label='htcondor',
-            address=address_by_hostname(),
-            max_workers=54,
-            worker_debug=True,
-            provider=CondorProvider(
-                init_blocks=15,
-                min_blocks=15,
-                max_blocks=16,
-                parallelism=0.5,
-                scheduler_options='+RequiresWholeMachine = True',
-                worker_init=f"source {phz_root_dir}/env.sh",
-                cmd_timeout=120,
-            ),
-        ),
-        "local": HighThroughputExecutor(
-            label='local',
-            worker_debug=True,
-            provider=LocalProvider(
-                min_blocks=1,
-                init_blocks=1,
-                max_blocks=2,
-                nodes_per_block=1,
-                parallelism=0.5
-            )
-        ),
-        "local_threads": ThreadPoolExecutor(
-            label='local_threads',
-            max_threads=2
-        )
+    if profile.get("type") == "threads":
+        max_threads = profile.get("max_threads", 2)
+        if max_threads == "auto":
+            max_threads = os.cpu_count()
+
+        return ThreadPoolExecutor(label=label, max_threads=int(max_threads))
+
+    if profile.get("type") != "htex":
+        print(f"Executor {label}: unexpected type - {profile.get('type')}")
+        raise BaseException
+
+    # with "auto", each node runs min(cores / cores_per_worker, memory / mem_per_worker) workers
+    max_workers = profile.get("max_workers", "auto")
+    max_workers = float('inf') if max_workers == "auto" else int(max_workers)
+
+    mem_per_worker = profile.get("mem_per_worker")
+    if mem_per_worker == "auto":
+        mem_per_worker = task_memory(phz_config, profile)
+
+    blocks = {
+        key: profile.get(key) for key in (
+            "init_blocks", "min_blocks", "max_blocks", "parallelism", "nodes_per_block"
+        ) if profile.get(key) is not None
     }
+    worker_init = profile.get("worker_init", "").format(phz_root_dir=phz_root_dir)
 
-    executor_key = phz_config.get("executor", "local")
-    executor = executors[executor_key]
+    if profile.get("provider") == "condor":
+        provider = CondorProvider(
+            scheduler_options=profile.get("scheduler_options", ""),
+            worker_init=worker_init,
+            cmd_timeout=profile.get("cmd_timeout", 120),
+            **blocks
+        )
+    else:
+        provider = LocalProvider(worker_init=worker_init, **blocks)
+
+    return HighThroughputExecutor(
+        label=label,
+        address=address_by_hostname() if profile.get("provider") == "condor" else None,
+        max_workers=max_workers,
+        cores_per_worker=float(profile.get("cores_per_worker", 1)),
+        mem_per_worker=mem_per_worker,
+        worker_debug=True,
+        provider=provider
+    )
+
+
+def get_config(phz_config):
+    """
+    Creates an instance of the Parsl configuration
+
+    Args:
+        phz_config (dict): Photo-z pipeline configuration - available in the config.yml
+    """
+
+    phz_root_dir = phz_config.get("phz_root_dir")
+
+    executor = get_executor(phz_config, get_profile(phz_config))
+
+    # failed tasks are submitted again before the pipeline splits them (see pz-run.py)
+    retries = int(phz_config.get("failures", {}).get("retries", 0))
 
     return Config(
         executors=[executor],
+        retries=retries,
         monitoring=MonitoringHub(
             hub_address=address_by_hostname(),
             hub_port=55055,
@@ -0,0 +1,374 @@
+import os
+import glob
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+# pixel column, also the hive partition key of the directories (hpix=<pixel>)
+PIXEL_COLUMN = 'hpix'
+
+# dataset written in the output directory (ignored when it is read as a dataset)
+# and its index of pixels to files
+HEALPIX_DIR = '_healpix'
+INDEX_FILE = '_index.json'
+
+# row and column of the first pixel of each base face (NESTED scheme)
+JRLL = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])
+JPLL = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])
+
+
+def check_nside(nside):
+    """ Checks that nside is a power of 2 (NESTED scheme)
+
+    Args:
+        nside (int): HEALPix resolution
+
+    Raises:
+        ValueError: nside is not a power of 2
+
+    Returns:
+        int: log2(nside)
+    """
+
+    nside = int(nside)
+    if nside < 1 or nside & (nside - 1):
+        raise ValueError(f'nside {nside} is not a power of 2')
+
+    return nside.bit_length() - 1
+
+
+def ang2pix(nside, ra, dec):
+    """ Computes the NESTED HEALPix pixel of sky positions
+
+    Args:
+        nside (int): HEALPix resolution, a power of 2
+        ra (array): right ascension (degrees)
+        dec (array): declination (degrees)
+
+    Returns:
+        ndarray: int64 pixels, -1 for the positions that are not finite
+    """
+
+    order = check_nside(nside)
+    ra, dec = np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64)
+    finite = np.isfinite(ra) & np.isfinite(dec)
+    ra, dec = np.where(finite, ra, 0.), np.where(finite, dec, 0.)
+
+    z = np.sin(np.radians(dec))
+    tt = np.mod(np.radians(ra), 2 * np.pi) / (np.pi / 2)
+    tt = np.where(tt >= 4., 0., tt)
+    za = np.abs(z)
+
+    # equatorial region
+    temp1, temp2 = nside * (0.5 + tt), nside * z * 0.75
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+    ifp, ifm = jp >> order, jm >> order
+    face = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix = jm & (nside - 1)
+    iy = nside - (jp & (nside - 1)) - 1
+
+    # polar caps
+    polar = za > 2. / 3.
+    ntt = np.minimum(tt.astype(np.int64), 3)
+    tp = tt - ntt
+    tmp = nside * np.sqrt(3. * (1. - za))
+    pjp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    pjm = np.minimum(((1. - tp) * tmp).astype(np.int64), nside - 1)
+    north = z >= 0
+
+    face = np.where(polar, np.where(north, ntt, ntt + 8), face)
+    ix = np.where(polar, np.where(north, nside - pjm - 1, pjp), ix)
+    iy = np.where(polar, np.where(north, nside - pjp - 1, pjm), iy)
+
+    pix = np.zeros(np.shape(face), dtype=np.int64)
+    for bit in range(order):
+        pix |= ((ix >> bit) & 1) << (2 * bit)
+        pix |= ((iy >> bit) & 1) << (2 * bit + 1)
+
+    return np.where(finite, face.astype(np.int64) * nside * nside + pix, -1)
+
+
+def pix2ang(nside, pix):
+    """ Computes the center of NESTED HEALPix pixels
+
+    Args:
+        nside (int): HEALPix resolution, a power of 2
+        pix (array): pixels
+
+    Returns:
+        tuple(ndarray, ndarray): right ascension and declination (degrees)
+    """
+
+    order = check_nside(nside)
+    pix = np.asarray(pix, dtype=np.int64)
+    face, pix = pix >> (2 * order), pix & (nside * nside - 1)
+
+    ix, iy = np.zeros_like(pix), np.zeros_like(pix)
+    for bit in range(order):
+        ix |= ((pix >> (2 * bit)) & 1) << bit
+        iy |= ((pix >> (2 * bit + 1)) & 1) << bit
+
+    jr = JRLL[face] * nside - ix - iy - 1
+    nr = np.where(jr < nside, jr, np.where(jr > 3 * nside, 4 * nside - jr, nside))
+    z = np.where(
+        jr < nside, 1. - nr * nr / (3. * nside * nside),
+        np.where(jr > 3 * nside, nr * nr / (3. * nside * nside) - 1., (2 * nside - jr) * 2. / (3. * nside))
+    )
+
+    tmp = JPLL[face] * nr + ix - iy
+    tmp = np.where(tmp < 0, tmp + 8 * nr, tmp)
+    phi = (np.pi / 4.) * tmp / nr
+
+    return np.degrees(phi), np.degrees(np.arcsin(np.clip(z, -1., 1.)))
+
+
+def max_pixel_radius(nside):
+    """ Returns the largest angular distance between the center and the
+    corners of a pixel
+
+    Args:
+        nside (int): HEALPix resolution
+
+    Returns:
+        float: radius (degrees)
+    """
+
+    t1 = (1. - 1. / nside) ** 2
+    return angular_distance(
+        np.degrees(np.pi / (4 * nside)), np.degrees(np.arcsin(2. / 3.)),
+        0., np.degrees(np.arcsin(1. - t1 / 3.))
+    )
+
+
+def angular_distance(ra1, dec1, ra2, dec2):
+    """ Computes the angular distance between positions (haversine formula)
+
+    Args:
+        ra1, dec1 (array): first positions (degrees)
+        ra2, dec2 (array): second positions (degrees)
+
+    Returns:
+        ndarray: distances (degrees)
+    """
+
+    ra1, dec1, ra2, dec2 = (np.radians(np.asarray(value, dtype=np.float64)) for value in (ra1, dec1, ra2, dec2))
+    hav = np.sin((dec2 - dec1) / 2.) ** 2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2.) ** 2
+
+    return np.degrees(2. * np.arcsin(np.sqrt(np.clip(hav, 0., 1.))))
+
+
+def write_pixels(paths, dataset_dir, name, nside, ra, dec):
+    """ Writes the rows of photo-z outputs in the hive directory of their
+    pixel (hpix=<pixel>/<name>.parquet), sorted by pixel
+
+    The files of a previous layout of the input in the pixels it no longer
+    covers are removed.
+
+    Args:
+        paths (list): photo-z outputs (partial or compacted) of an input file
+        dataset_dir (str): HEALPix dataset directory
+        name (str): file name in each pixel directory (input file name)
+        nside (int): HEALPix resolution
+        ra (str): right ascension column
+        dec (str): declination column
+
+    Returns:
+        dict: rows by pixel
+    """
+
+    table = pa.concat_tables([pq.read_table(path) for path in paths])
+    pixels = ang2pix(
+        nside, pc.fill_null(table.column(ra), np.nan).to_numpy(),
+        pc.fill_null(table.column(dec), np.nan).to_numpy()
+    )
+
+    order = np.argsort(pixels, kind='stable')
+    table, pixels = table.take(pa.array(order)), pixels[order]
+    values, starts, counts = np.unique(pixels, return_index=True, return_counts=True)
+
+    rows = dict()
+
+    for pixel, start, count in zip(values.tolist(), starts.tolist(), counts.tolist()):
+        pixel_dir = os.path.join(dataset_dir, f'{PIXEL_COLUMN}={pixel}')
+        os.makedirs(pixel_dir, exist_ok=True)
+
+        path = os.path.join(pixel_dir, f'{name}.parquet')
+        pq.write_table(table.slice(start, count), f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+        rows[pixel] = count
+
+    for path in glob.glob(os.path.join(dataset_dir, f'{PIXEL_COLUMN}=*', f'{name}.parquet')):
+        pixel = os.path.basename(os.path.dirname(path))[len(PIXEL_COLUMN) + 1:]
+        if int(pixel) not in rows:
+            os.remove(path)
+
+    return rows
+
+
+def new_index(nside, ra, dec, config):
+    """ Creates an empty HEALPix index
+
+    Args:
+        nside (int): HEALPix resolution
+        ra (str): right ascension column
+        dec (str): declination column
+        config (str): configuration hash of the outputs
+
+    Returns:
+        dict: HEALPix index
+    """
+
+    return {
+        'nside': int(nside), 'scheme': 'NESTED', 'ra': ra, 'dec': dec, 'config': config,
+        'pixels': dict(), 'inputs': dict()
+    }
+
+
+def load_index(dataset_dir):
+    """ Loads the index of a HEALPix dataset
+
+    Args:
+        dataset_dir (str): HEALPix dataset directory
+
+    Returns:
+        dict: nside, coordinate columns, config, files by pixel (rows of each
+        file) and rows by input name, empty when the index does not exist
+    """
+
+    index_path = os.path.join(dataset_dir, INDEX_FILE)
+
+    if not os.path.isfile(index_path):
+        return dict()
+
+    with open(index_path) as _file:
+        return json.load(_file)
+
+
+def add_to_index(index, name, rows):
+    """ Adds the pixels of an input file to the index, replacing the ones of
+    a previous layout of the input
+
+    Args:
+        index (dict): HEALPix index (see load_index)
+        name (str): file name in the pixel directories
+        rows (dict): rows by pixel (see write_pixels)
+    """
+
+    for pixel in list(index['pixels']):
+        index['pixels'][pixel].pop(f'{name}.parquet', None)
+        if not index['pixels'][pixel]:
+            del index['pixels'][pixel]
+
+    for pixel, count in rows.items():
+        index['pixels'].setdefault(str(pixel), dict())[f'{name}.parquet'] = int(count)
+
+    index['inputs'][name] = int(sum(rows.values()))
+
+
+def write_index(dataset_dir, index):
+    """ Writes the index of a HEALPix dataset (with a temporary name while
+    incomplete)
+
+    Args:
+        dataset_dir (str): HEALPix dataset directory
+        index (dict): HEALPix index
+    """
+
+    index_path = os.path.join(dataset_dir, INDEX_FILE)
+
+    with open(f'{index_path}.tmp', 'w') as _file:
+        json.dump(index, _file, sort_keys=True)
+
+    os.replace(f'{index_path}.tmp', index_path)
+
+
+def cone_pixels(index, ra, dec, radius):
+    """ Lists the pixels of the index overlapping a cone
+
+    Args:
+        index (dict): HEALPix index
+        ra (float): right ascension of the center (degrees)
+        dec (float): declination of the center (degrees)
+        radius (float): radius (degrees)
+
+    Returns:
+        list: pixels
+    """
+
+    nside = index['nside']
+    # pixel -1 holds the objects without coordinates
+    pixels = np.array(sorted(int(pixel) for pixel in index['pixels'] if int(pixel) >= 0), dtype=np.int64)
+
+    if not len(pixels):
+        return list()
+
+    centers = pix2ang(nside, pixels)
+    near = angular_distance(ra, dec, centers[0], centers[1]) <= radius + max_pixel_radius(nside)
+
+    return pixels[near].tolist()
+
+
+def query(dataset_dir, pixels=None, cone=None, columns=None, pixel_nside=None):
+    """ Reads the photo-zs of sky pixels or of a cone, opening only the files
+    of the overlapping pixels
+
+    Args:
+        dataset_dir (str): HEALPix dataset directory
+        pixels (list, optional): NESTED pixels. Defaults to None.
+        cone (tuple, optional): ra, dec and radius (degrees), the rows are
+            filtered by distance. Defaults to None.
+        columns (list, optional): columns to read. Defaults to None (all).
+        pixel_nside (int, optional): resolution of pixels when it is lower than the
+            dataset one (their sub-pixels are read). Defaults to None.
+
+    Raises:
+        ValueError: pixels at a resolution higher than the dataset one
+
+    Returns:
+        pyarrow.Table: rows with the hpix column
+    """
+
+    index = load_index(dataset_dir)
+    nside, ra, dec = index['nside'], index['ra'], index['dec']
+    selected = set(int(pixel) for pixel in index['pixels'])
+
+    if pixels is not None:
+        shift = 2 * (check_nside(nside) - check_nside(pixel_nside or nside))
+        if shift < 0:
+            raise ValueError(f'pixels at nside {pixel_nside}, the dataset has nside {nside}')
+        parents = set(int(pixel) for pixel in pixels)
+        selected = set(pixel for pixel in selected if pixel >= 0 and pixel >> shift in parents)
+
+    if cone is not None:
+        selected &= set(cone_pixels(index, *cone))
+
+    read_columns = None if columns is None else list(dict.fromkeys(
+        [name for name in columns if name != PIXEL_COLUMN] + ([ra, dec] if cone is not None else [])
+    ))
+
+    tables = list()
+    for pixel in sorted(selected):
+        for name in sorted(index['pixels'][str(pixel)]):
+            table = pq.read_table(os.path.join(dataset_dir, f'{PIXEL_COLUMN}={pixel}', name), columns=read_columns)
+            tables.append(table.append_column(PIXEL_COLUMN, pa.array(np.full(table.num_rows, pixel))))
+
+    if not tables:
+        return pa.table({PIXEL_COLUMN: pa.array([], type=pa.int64())})
+
+    table = pa.concat_tables(tables)
+
+    if cone is not None:
+        distance = angular_distance(
+            cone[0], cone[1], table.column(ra).to_numpy(),
+            table.column(dec).to_numpy()
+        )
+        table = table.filter(pa.array(distance <= cone[2]))
+
+    if columns is not None:
+        table = table.select([name for name in columns if name in table.column_names])
+
+    return table
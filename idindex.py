@@ -0,0 +1,183 @@
+import os
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# sidecar directory in the output directory (ignored when it is read as a dataset)
+IDS_DIR = '_ids'
+INDEX_FILE = '_index.json'
+
+# sidecar entries: object id, output file (position in the files of the input) and row
+SIDECAR_TYPE = np.dtype([('id', '<i8'), ('file', '<u4'), ('row', '<u4')])
+
+
+def write_sidecar(paths, ids_dir, name, index_column, output_dir):
+    """ Writes the object ids of the outputs of an input file, sorted, with
+    their file and row (<ids_dir>/<name>.npy)
+
+    Only the index column of the outputs is read.
+
+    Args:
+        paths (list): photo-z outputs (partial or compacted) of an input file
+        ids_dir (str): sidecar directory
+        name (str): input file name
+        index_column (str): index column name (as in the outputs)
+        output_dir (str): output directory, the file paths are stored relative to it
+
+    Returns:
+        dict: input name, sidecar, files (path and rows of each row group),
+        rows, min and max id
+    """
+
+    parts, files = list(), list()
+
+    for number, path in enumerate(paths):
+        parquet_file = pq.ParquetFile(path)
+        ids = parquet_file.read(columns=[index_column]).column(0).to_numpy()
+
+        part = np.empty(len(ids), dtype=SIDECAR_TYPE)
+        part['id'], part['file'], part['row'] = ids, number, np.arange(len(ids))
+        parts.append(part)
+
+        files.append({
+            'path': os.path.relpath(path, output_dir),
+            'row_groups': [
+                parquet_file.metadata.row_group(rg).num_rows for rg in range(parquet_file.num_row_groups)
+            ]
+        })
+
+    sidecar = np.concatenate(parts) if parts else np.empty(0, dtype=SIDECAR_TYPE)
+    sidecar = sidecar[np.argsort(sidecar['id'], kind='stable')]
+
+    os.makedirs(ids_dir, exist_ok=True)
+    sidecar_path = os.path.join(ids_dir, f'{name}.npy')
+    with open(f'{sidecar_path}.tmp', 'wb') as _file:
+        np.save(_file, sidecar)
+    os.replace(f'{sidecar_path}.tmp', sidecar_path)
+
+    return {
+        'name': name, 'sidecar': f'{name}.npy', 'files': files, 'rows': len(sidecar),
+        'min': int(sidecar['id'][0]) if len(sidecar) else None,
+        'max': int(sidecar['id'][-1]) if len(sidecar) else None
+    }
+
+
+def new_index(index_column, config):
+    """ Creates an empty id index
+
+    Args:
+        index_column (str): index column name (as in the outputs)
+        config (str): configuration hash of the outputs
+
+    Returns:
+        dict: id index
+    """
+
+    return {'index': index_column, 'config': config, 'inputs': dict()}
+
+
+def load_index(ids_dir):
+    """ Loads the id index
+
+    Args:
+        ids_dir (str): sidecar directory
+
+    Returns:
+        dict: index column, config and sidecar of each input file (see
+        write_sidecar), empty when the index does not exist
+    """
+
+    index_path = os.path.join(ids_dir, INDEX_FILE)
+
+    if not os.path.isfile(index_path):
+        return dict()
+
+    with open(index_path) as _file:
+        return json.load(_file)
+
+
+def write_index(ids_dir, index):
+    """ Writes the id index (with a temporary name while incomplete)
+
+    Args:
+        ids_dir (str): sidecar directory
+        index (dict): id index
+    """
+
+    index_path = os.path.join(ids_dir, INDEX_FILE)
+
+    with open(f'{index_path}.tmp', 'w') as _file:
+        json.dump(index, _file, sort_keys=True)
+
+    os.replace(f'{index_path}.tmp', index_path)
+
+
+def lookup(output_dir, ids, columns=None):
+    """ Reads the photo-zs of objects, opening only the sidecars whose id
+    range holds them and the row groups of their rows
+
+    Args:
+        output_dir (str): output directory of the run
+        ids (list): object ids
+        columns (list, optional): columns to read. Defaults to None (all).
+
+    Returns:
+        pyarrow.Table: rows of the ids found, sorted by id
+    """
+
+    ids_dir = os.path.join(output_dir, IDS_DIR)
+    index = load_index(ids_dir)
+    index_column = index['index']
+
+    wanted = np.unique(np.asarray(ids, dtype=np.int64))
+    found = np.zeros(len(wanted), dtype=bool)
+    tables = list()
+
+    if columns is not None and index_column not in columns:
+        columns = [index_column] + list(columns)
+
+    for name in sorted(index['inputs']):
+        entry = index['inputs'][name]
+        if not entry['rows']:
+            continue
+
+        first = np.searchsorted(wanted, entry['min'], side='left')
+        last = np.searchsorted(wanted, entry['max'], side='right')
+        candidates = np.flatnonzero(~found[first:last]) + first
+
+        if not len(candidates):
+            continue
+
+        sidecar = np.load(os.path.join(ids_dir, entry['sidecar']), mmap_mode='r')
+        positions = np.searchsorted(sidecar['id'], wanted[candidates])
+        positions = np.minimum(positions, len(sidecar) - 1)
+        matched = sidecar['id'][positions] == wanted[candidates]
+
+        if not matched.any():
+            continue
+
+        found[candidates[matched]] = True
+        rows = np.asarray(sidecar[positions[matched]])
+
+        for number in np.unique(rows['file']).tolist():
+            file_entry = entry['files'][number]
+            file_rows = np.sort(rows['row'][rows['file'] == number].astype(np.int64))
+
+            # only the row groups holding the rows are read
+            offsets = np.cumsum([0] + file_entry['row_groups'])
+            row_groups = np.unique(np.searchsorted(offsets, file_rows, side='right') - 1)
+            table = pq.ParquetFile(os.path.join(output_dir, file_entry['path'])).read_row_groups(
+                row_groups.tolist(), columns=columns
+            )
+
+            local = np.concatenate([np.arange(offsets[rg], offsets[rg + 1]) for rg in row_groups])
+            tables.append(table.take(pa.array(np.searchsorted(local, file_rows))))
+
+    if not tables:
+        return pa.table({index_column: pa.array([], type=pa.int64())})
+
+    table = pa.concat_tables(tables)
+
+    return table.take(pa.array(np.argsort(table.column(index_column).to_numpy(), kind='stable')))
@@ -0,0 +1,152 @@
+import os
+import glob
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+# per-object hash of the photometric columns, stored in the outputs
+PHOT_HASH = 'phot_hash'
+
+# parquet schema metadata key of the configuration hash (see manifest.config_hash)
+CONFIG_KEY = b'config_hash'
+
+# 64-bit FNV-1a constants
+FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def photometry_hash(table, columns):
+    """ Computes a 64-bit hash of the photometric values of each object
+
+    Args:
+        table (pyarrow.Table): partition columns
+        columns (list): hashed columns (magnitudes, errors, correction, flags)
+
+    Returns:
+        ndarray: uint64 hash by object
+    """
+
+    hashes = np.full(table.num_rows, FNV_OFFSET, dtype=np.uint64)
+
+    for name in columns:
+        values = pc.fill_null(pc.cast(table.column(name), pa.float64()), np.nan)
+        values = values.to_numpy()
+        # a single NaN bit pattern, so missing values hash the same in every release
+        values = np.where(np.isnan(values), np.nan, values)
+        hashes ^= values.view(np.uint64)
+        hashes *= FNV_PRIME
+
+    return hashes
+
+
+def previous_outputs(previous_dir, filename):
+    """ Lists the outputs of a previous run for an input file: the compacted
+    file or the partial outputs (matched by the input file name)
+
+    Args:
+        previous_dir (str): output directory of the previous run
+        filename (str): input file path
+
+    Returns:
+        list: parquet paths
+    """
+
+    tile = os.path.basename(filename).replace(".parquet", "")
+    compacted = os.path.join(previous_dir, f'{tile}.parquet')
+
+    if os.path.isfile(compacted):
+        return [compacted]
+
+    return sorted(glob.glob(os.path.join(previous_dir, tile, '*.parquet')))
+
+
+def load_previous(paths, col_index, col_index_values, hashes, config):
+    """ Finds the objects already computed with the same photometry and
+    configuration, and loads their photo-z rows
+
+    Only the index and hash columns are read to match the objects, then the
+    row groups holding the matches.
+
+    Args:
+        paths (list): previous outputs (see previous_outputs)
+        col_index (str): index column name
+        col_index_values (ChunkedArray): index column values of the partition
+        hashes (ndarray): photometry hash of the partition objects
+        config (str): configuration hash
+
+    Returns:
+        tuple(ndarray, pyarrow.Table): mask of the objects reused and their
+        rows (in the partition order), None when no object is reused
+    """
+
+    reuse = np.zeros(len(hashes), dtype=bool)
+    parts = list()
+
+    for path in paths:
+        parquet_file = pq.ParquetFile(path)
+        metadata = parquet_file.schema_arrow.metadata or {}
+
+        if metadata.get(CONFIG_KEY, b'').decode() != config:
+            continue
+
+        keys = parquet_file.read(columns=[col_index.lower(), PHOT_HASH])
+        if not keys.num_rows:
+            continue
+
+        found = np.asarray(pc.index_in(col_index_values, value_set=keys.column(0)), dtype=np.float64)
+
+        # found holds NaN for the objects missing from this file
+        matched = ~np.isnan(found) & ~reuse
+        rows = np.where(matched, found, 0).astype(np.int64)
+        matched &= keys.column(1).to_numpy()[rows] == hashes
+
+        if not matched.any():
+            continue
+
+        # rows are read from the row groups holding the matches only
+        offsets = np.cumsum([0] + [
+            parquet_file.metadata.row_group(rg).num_rows for rg in range(parquet_file.num_row_groups)
+        ])
+        rows = rows[matched]
+        row_groups = np.unique(np.searchsorted(offsets, rows, side='right') - 1)
+        table = parquet_file.read_row_groups(row_groups.tolist())
+
+        local = np.concatenate([
+            np.arange(offsets[rg], offsets[rg + 1]) for rg in row_groups
+        ])
+        parts.append((np.flatnonzero(matched), table.take(pa.array(np.searchsorted(local, rows)))))
+        reuse |= matched
+
+    if not parts:
+        return reuse, None
+
+    positions = np.concatenate([part[0] for part in parts])
+    table = pa.concat_tables([part[1] for part in parts])
+
+    return reuse, table.take(pa.array(np.argsort(positions, kind='stable')))
+
+
+def add_hash(table, hashes, config):
+    """ Adds the photometry hash column and the configuration hash to the
+    photo-z table, used by the next incremental run
+
+    Args:
+        table (pyarrow.Table): photo-z table
+        hashes (ndarray): photometry hash by object
+        config (str): configuration hash
+
+    Returns:
+        pyarrow.Table: photo-z table with phot_hash
+    """
+
+    if PHOT_HASH in table.column_names:
+        table = table.remove_column(table.schema.get_field_index(PHOT_HASH))
+
+    table = table.append_column(PHOT_HASH, pa.array(hashes, type=pa.uint64()))
+
+    metadata = dict(table.schema.metadata or {})
+    metadata[CONFIG_KEY] = config.encode()
+
+    return table.replace_schema_metadata(metadata)
@@ -0,0 +1,286 @@
+import os
+import numpy as np
+import pyarrow as pa
+
+
+# magnitudes that requires correction
+# TODO: has to be updated in case of dataset with more bands (deep)
+CORR_SFD98 = {
+    "G": 3.185, "R": 2.140, "I": 1.571, "Z": 1.198, "Y": 1.052
+} # SFD98 20th June 2017
+
+# rows formatted per write call
+CHUNK_SIZE = 100000
+
+
+def column_values(table, name):
+    """ Returns a column as a NumPy array, without copying when possible
+
+    Arrow columns with a single chunk and no nulls are viewed in place, the
+    other ones are converted with NaN for the nulls (as in to_pandas).
+
+    Args:
+        table (pyarrow.Table or DataFrame): photometric data
+        name (string): column name
+
+    Returns:
+        ndarray: column values (read-only when it is a view)
+    """
+
+    if isinstance(table, pa.Table):
+        column = table.column(name)
+
+        if column.num_chunks == 1:
+            return column.chunk(0).to_numpy(zero_copy_only=False)
+
+        return column.to_numpy()
+
+    return table.get(name).to_numpy()
+
+
+def prepare_bands(table, bands, photo_type, err_type, corr=None):
+    """ Masks invalid magnitudes and applies the SFD98 correction
+
+    The input columns are never modified, each band gets a new magnitude and
+    error array with the same rules used by the original LePhare input writer.
+    The masks are computed in place in two boolean buffers shared by all
+    bands, so the only allocations per band are the two output arrays.
+
+    Args:
+        table (pyarrow.Table or DataFrame): photometric data
+        bands (list): bands list
+        photo_type (string): string containing magnitude with {} to concatenate the band.
+        err_type (string): string containing magnitude erro with {} to concatenate the band.
+        corr (string, optional): column name to calculate the correction. Defaults to None.
+
+    Raises:
+        BaseException: failed to find a correction value
+
+    Returns:
+        tuple(list, list): magnitude and error arrays in band order
+    """
+
+    corr_col = column_values(table, corr) if corr else None
+    mags, errs = list(), list()
+
+    n_rows = len(table)
+    invalid = np.empty(n_rows, dtype=bool)
+    mask = np.empty(n_rows, dtype=bool)
+    scaled = np.empty(n_rows, dtype=np.result_type(corr_col.dtype, 1.)) if corr else None
+
+    for band in bands:
+        mag_values = np.array(column_values(table, photo_type.format(band)))
+
+        if err_type: #TODO: in simulation case: the value will be None
+            err_values = np.array(column_values(table, err_type.format(band)))
+        else:
+            err_values = np.ones_like(mag_values)
+
+        # Eliminating 99's from sample
+        np.less(mag_values, 0., out=invalid)
+        np.greater(mag_values, 30., out=mask)
+        np.logical_or(invalid, mask, out=invalid)
+        np.putmask(err_values, invalid, -99.)
+        np.isnan(mag_values, out=mask)
+        np.logical_or(invalid, mask, out=invalid)
+        np.putmask(mag_values, invalid, -99.)
+        np.isnan(err_values, out=mask)
+        np.putmask(err_values, mask, -99.)
+
+        if corr:
+            if not band in CORR_SFD98.keys():
+                mag = photo_type.format(band)
+                print(f"\n\nFailed to correct column magnitude {mag}")
+                raise BaseException
+
+            np.multiply(corr_col, CORR_SFD98.get(band), out=scaled)
+            np.logical_not(invalid, out=mask)
+            np.subtract(mag_values, scaled, out=mag_values, where=mask, casting='same_kind')
+
+        mags.append(mag_values)
+        errs.append(err_values)
+
+    return mags, errs
+
+
+def compute_context(mags):
+    """ Computes the LePhare context as a bitmask of the valid bands
+
+    Args:
+        mags (list): magnitude arrays in band order
+
+    Returns:
+        ndarray: context of each object
+    """
+
+    context = np.zeros(len(mags[0]) if mags else 0, dtype=np.int64)
+
+    for bit, mag_values in enumerate(mags):
+        context |= (mag_values != -99.).astype(np.int64) << bit
+
+    return context
+
+
+def order_photometry(mags, errs, cat_fmt="MEME"):
+    """ Orders the magnitude and error columns as expected by CAT_FMT
+
+    Args:
+        mags (list): magnitude arrays in band order
+        errs (list): error arrays in band order
+        cat_fmt (str, optional): catalog format. Defaults to "MEME".
+
+    Raises:
+        BaseException: unexpected catalog format
+
+    Returns:
+        list: photometry columns
+    """
+
+    if cat_fmt == "MEME":
+        return [col for pair in zip(mags, errs) for col in pair]
+
+    if cat_fmt == "MMEE":
+        return list(mags) + list(errs)
+
+    print(f"CAT_FMT: unexpected format - {cat_fmt}")
+    raise BaseException
+
+
+# powers of ten that fit in int64
+POW10 = 10 ** np.arange(19, dtype=np.int64)
+
+# largest value formatted with fixed point arithmetic, x * 1e5 stays exact
+# enough (below 1e-6) to detect the rounding ties of '%.5f'
+MAX_FIXED = 1e4
+
+
+def _format_chunk(gal_number, photometry, context, ids):
+    """ Formats a block of rows, falling back to %-formatting when the
+    values can not be reproduced with integer arithmetic """
+
+    vectorizable = np.issubdtype(ids.dtype, np.integer) and all(
+        np.isfinite(col).all() and (np.abs(col) < MAX_FIXED).all()
+        for col in photometry
+    )
+
+    if not vectorizable:
+        row_fmt = ' '.join(
+            ['%10d'] + ['%.5f'] * len(photometry) + ['%.6d', '-99.00000', '%10d']
+        ) + '\n'
+        columns = [gal_number.tolist()]
+        columns.extend(col.tolist() for col in photometry)
+        columns.append(context.tolist())
+        columns.append(ids.tolist())
+        return ''.join(map(row_fmt.__mod__, zip(*columns))).encode()
+
+    n_rows = len(ids)
+    space = np.full((1, n_rows), ord(' '), dtype=np.uint8)
+
+    fields = [_int_field(gal_number, width=10)]
+    for col in photometry:
+        fields.extend((space, _fixed_field(col)))
+    fields.extend((space, _int_field(context, precision=6)))
+    # "True" redshifts
+    fields.extend((space, np.tile(np.frombuffer(b'-99.00000', dtype=np.uint8)[:, None], n_rows)))
+    fields.extend((space, _int_field(ids, width=10)))
+    fields.append(np.full((1, n_rows), ord('\n'), dtype=np.uint8))
+
+    rows = np.ascontiguousarray(np.concatenate(fields).T)
+
+    return rows[rows != 0].tobytes()
+
+
+def _int_field(values, width=0, precision=1):
+    """ Formats integers as '%{width}.{precision}d' into a (chars, rows)
+    byte matrix where 0 marks the unused leading positions """
+
+    values = values.astype(np.int64)
+    neg = values < 0
+    quotient = np.abs(values)
+    ndigits = np.maximum(np.searchsorted(POW10[1:], quotient, side='right') + 1, precision)
+    nchars = max(width, int((ndigits + neg).max())) if len(values) else width
+
+    field = np.empty((nchars, len(values)), dtype=np.uint8)
+
+    for pos in range(nchars):
+        row = field[nchars - 1 - pos]
+        row[:] = quotient % 10 + ord('0')
+        quotient //= 10
+
+        if pos >= precision:
+            lead = pos >= ndigits
+            row[lead] = ord(' ') if pos < width else 0
+            row[lead & (pos == ndigits) & neg] = ord('-')
+
+    return field
+
+
+def _fixed_field(values, decimals=5):
+    """ Formats floats as '%.{decimals}f' into a (chars, rows) byte matrix """
+
+    scale = 10**decimals
+    scaled_values = values.astype(np.float64) * scale
+    scaled = np.rint(scaled_values).astype(np.int64)
+
+    # values too close to a rounding tie are rounded by Python itself
+    ties = np.abs(np.abs(scaled_values - np.trunc(scaled_values)) - 0.5) < 1e-6
+
+    if ties.any():
+        fmt = f'%.{decimals}f'
+        scaled[ties] = [int((fmt % val).replace('.', '')) for val in values[ties].tolist()]
+
+    digits = _int_field(np.abs(scaled), precision=decimals + 1)
+    field = np.insert(digits, len(digits) - decimals, ord('.'), axis=0)
+
+    # sign of negative values, including the ones rounded to zero
+    sign = np.zeros((1, len(values)), dtype=np.uint8)
+    sign[0, np.signbit(values)] = ord('-')
+
+    return np.concatenate([sign, field])
+
+
+def write_input(idx, table, bands, photo_type, err_type, index_column, corr, cat_fmt="MEME", path=None,
+        chunk_size=CHUNK_SIZE):
+    """ Responsible for formatting the Lephare input
+
+    Args:
+        idx (string): thread id
+        table (pyarrow.Table or DataFrame): photometric data
+        bands (list): bands list
+        photo_type (string): string containing magnitude with {} to concatenate the band.
+        err_type (string): string containing magnitude erro with {} to concatenate the band.
+        index_column (string): index column name
+        corr (string): column name to calculate the correction
+        cat_fmt (str, optional): catalog format. Defaults to "MEME".
+        path (string, optional): directory of the input. Defaults to the current directory.
+        chunk_size (int, optional): rows prepared and formatted at a time. Defaults to CHUNK_SIZE.
+
+    Returns:
+        string: input name created
+    """
+
+    input_file = f'lephare_{str(idx)}.input'
+    if path:
+        input_file = os.path.join(path, input_file)
+
+    n_gals = len(table)
+    order_photometry([], [], cat_fmt)
+
+    # rows are prepared and formatted by chunks (slices of the input columns), so
+    # the memory used beyond the input table is proportional to chunk_size
+    with open(input_file, 'wb') as outfile:
+        for first in range(0, n_gals, chunk_size):
+            if isinstance(table, pa.Table):
+                chunk = table.slice(first, chunk_size)
+            else:
+                chunk = table.iloc[first:first + chunk_size]
+
+            mags, errs = prepare_bands(chunk, bands, photo_type, err_type, corr)
+            gal_number = np.arange(first + 1, first + len(chunk) + 1, dtype=np.int64)
+
+            outfile.write(_format_chunk(
+                gal_number, order_photometry(mags, errs, cat_fmt), compute_context(mags),
+                column_values(chunk, index_column)
+            ))
+
+    return input_file
@@ -0,0 +1,139 @@
+import pyarrow as pa
+import pyarrow.csv as pcsv
+import pyarrow.compute as pc
+import pyarrow.parquet as parq
+
+
+# LePhare output columns types, the other columns are read as float64
+OUTPUT_TYPES = {'IDENT': pa.int64()}
+
+# bytes of the LePhare output parsed per block
+BLOCK_SIZE = 1 << 24
+
+
+def iter_lines(phzout, block_size=BLOCK_SIZE):
+    """ Reads a LePhare ASCII output in blocks of lines, skipping the
+    comment lines
+
+    Each line becomes a single string field (the unit separator is used as
+    delimiter, it never appears in the LePhare output), the blocks are read
+    by the multithreaded pyarrow CSV reader.
+
+    Args:
+        phzout (str or file): LePhare output path or opened file (e.g. a named pipe)
+        block_size (int, optional): bytes per block. Defaults to BLOCK_SIZE.
+
+    Yields:
+        pyarrow.StringArray: data lines
+    """
+
+    reader = pcsv.open_csv(
+        phzout,
+        read_options=pcsv.ReadOptions(column_names=['line'], block_size=block_size),
+        parse_options=pcsv.ParseOptions(delimiter='\x1f', quote_char=False, escape_char=False),
+        convert_options=pcsv.ConvertOptions(column_types={'line': pa.string()})
+    )
+
+    for batch in reader:
+        lines = batch.column(0)
+        yield lines.filter(pc.invert(pc.starts_with(lines, pattern='#')))
+
+
+def split_columns(lines, idxs, names):
+    """ Extracts the selected columns from LePhare output lines
+
+    Only the fields up to the last selected column are split.
+
+    Args:
+        lines (pyarrow.StringArray): data lines
+        idxs (list): column indexes
+        names (list): column names
+
+    Returns:
+        list: pyarrow arrays in idxs order
+    """
+
+    fields = pc.ascii_split_whitespace(
+        pc.ascii_ltrim_whitespace(lines), max_splits=max(idxs) + 1
+    )
+
+    return [
+        pc.cast(pc.list_element(fields, idx), OUTPUT_TYPES.get(name, pa.float64()))
+        for idx, name in zip(idxs, names)
+    ]
+
+
+def read_output(phzout, idxs, namephotoz, block_size=BLOCK_SIZE):
+    """ Loads the LePhare output only with the selected columns
+
+    Args:
+        phzout (str or file): LePhare output path or opened file
+        idxs (list): column indexes (see prepare_format_output)
+        namephotoz (list): column names (see prepare_format_output)
+        block_size (int, optional): bytes per block. Defaults to BLOCK_SIZE.
+
+    Returns:
+        pyarrow.Table: selected columns
+    """
+
+    chunks = [list() for _ in idxs]
+
+    for lines in iter_lines(phzout, block_size):
+        for chunk, column in zip(chunks, split_columns(lines, idxs, namephotoz)):
+            chunk.append(column)
+
+    columns = [
+        pa.chunked_array(chunk, type=OUTPUT_TYPES.get(name, pa.float64()))
+        for chunk, name in zip(chunks, namephotoz)
+    ]
+
+    return pa.Table.from_arrays(columns, names=namephotoz)
+
+
+def build_photoz_table(zphotoz, col_index, col_index_values):
+    """ Creates the photo-z table with lowercase column names, the index
+    column and the photo-z error
+
+    Args:
+        zphotoz (pyarrow.Table): LePhare selected columns (see read_output)
+        col_index (str): index column name
+        col_index_values (array or ChunkedArray): index column values
+
+    Returns:
+        pyarrow.Table: photo-z table
+    """
+
+    # Calculating the photoz error as the mean of Z_BEST68_LOW and Z_BEST68_HIGH
+    photozerr = pc.divide(
+        pc.abs(pc.subtract(zphotoz.column('Z_BEST68_HIGH'), zphotoz.column('Z_BEST68_LOW'))), 2.
+    ) #The name of the column on file must be ERR_Z
+
+    if not isinstance(col_index_values, pa.ChunkedArray):
+        col_index_values = pa.chunked_array([col_index_values])
+
+    columns = list(zphotoz.columns) + [col_index_values, photozerr]
+    names = [name.lower() for name in zphotoz.column_names] + [col_index.lower(), 'err_z']
+
+    return pa.Table.from_arrays(columns, names=names)
+
+
+def write_output(phzout, idxs, namephotoz, col_index, col_index_values, zphot_output):
+    """ Converts the LePhare output to the photo-z parquet file
+
+    Args:
+        phzout (str): LePhare output path
+        idxs (list): column indexes (see prepare_format_output)
+        namephotoz (list): column names (see prepare_format_output)
+        col_index (str): index column name
+        col_index_values (array or ChunkedArray): index column values
+        zphot_output (str): parquet output path
+
+    Returns:
+        pyarrow.Table: photo-z table
+    """
+
+    zphotoz = read_output(phzout, idxs, namephotoz)
+    table = build_photoz_table(zphotoz, col_index, col_index_values)
+    parq.write_table(table, zphot_output)
+
+    return table
@@ -0,0 +1,202 @@
+import os
+import glob
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from lephare_output import iter_lines, BLOCK_SIZE
+
+
+# PDZ_TYPE used when the configuration does not set one
+PDZ_TYPE = 'BAY_ZG'
+
+# integer types of the quantized PDFs
+QUANTIZED_TYPES = {8: (pa.uint8(), np.uint8), 16: (pa.uint16(), np.uint16)}
+
+# parquet schema metadata keys
+GRID_KEY = b'pdz_grid'
+QUANTIZE_KEY = b'pdz_quantize'
+
+
+def redshift_grid(z_step):
+    """ Computes the LePhare redshift grid from Z_STEP (dz, zmax, dz above z=6)
+
+    Args:
+        z_step (str): Z_STEP value, e.g. "0.02,2.0,0.1"
+
+    Returns:
+        ndarray: redshifts
+    """
+
+    values = [float(value) for value in str(z_step).split(',')]
+    dz, zmax = values[0], values[1]
+    dz_high = values[2] if len(values) > 2 else dz
+
+    low = np.arange(0., min(zmax, 6.) + dz / 2., dz)
+
+    if zmax <= 6.:
+        return np.round(low, 6)
+
+    high = np.arange(low[-1] + dz_high, zmax + dz_high / 2., dz_high)
+
+    return np.round(np.concatenate([low, high]), 6)
+
+
+def pdz_file(pdz_out):
+    """ Finds the PDF file written by zphota for a PDZ_OUT prefix (LePhare
+    appends the PDZ type and an extension to the prefix)
+
+    Args:
+        pdz_out (str): PDZ_OUT prefix
+
+    Raises:
+        RuntimeError: no file, or more than one file, with the prefix
+
+    Returns:
+        str: PDF file path
+    """
+
+    paths = [path for path in glob.glob(f'{pdz_out}*') if os.path.isfile(path)]
+
+    if len(paths) != 1:
+        raise RuntimeError(f'expected one PDF file for {pdz_out}, found {paths}')
+
+    return paths[0]
+
+
+def quantize(values, bits):
+    """ Scales the PDFs of each object by its maximum and rounds them to
+    unsigned integers
+
+    Args:
+        values (ndarray): PDFs, one row per object
+        bits (int): 8 or 16
+
+    Returns:
+        tuple(ndarray, ndarray): quantized PDFs and the scale of each object
+        (p = q * scale)
+    """
+
+    itype = QUANTIZED_TYPES[bits][1]
+    top = np.iinfo(itype).max
+
+    scale = values.max(axis=1, initial=0.).astype(np.float32) / top
+    safe = np.where(scale > 0., scale, 1.)
+
+    return np.rint(values / safe[:, None]).astype(itype), scale
+
+
+def read_pdz(path, bits=None, block_size=BLOCK_SIZE):
+    """ Loads the PDFs written by zphota, one block of lines at a time, as
+    fixed-size lists (one value per redshift of the grid)
+
+    Each line holds the object identifier followed by the PDF values. Only
+    the current block is kept as text.
+
+    Args:
+        path (str): PDF file path
+        bits (int, optional): quantization (8 or 16 bits). Defaults to None (float32).
+        block_size (int, optional): bytes per block. Defaults to BLOCK_SIZE.
+
+    Raises:
+        RuntimeError: lines with different numbers of values
+
+    Returns:
+        tuple(ChunkedArray, ChunkedArray, ChunkedArray): identifiers, PDFs
+        and scales (None without quantization)
+    """
+
+    idents, pdfs, scales, width = list(), list(), list(), None
+
+    for lines in iter_lines(path, block_size):
+        if len(lines) == 0:
+            continue
+
+        fields = pc.ascii_split_whitespace(pc.ascii_trim_whitespace(lines))
+        minmax = pc.min_max(pc.list_value_length(fields)).as_py()
+        width = width or minmax['max'] - 1
+
+        if minmax['min'] != minmax['max'] or minmax['max'] - 1 != width:
+            raise RuntimeError(f'{path}: PDFs with different sizes')
+
+        # every line has width + 1 fields: the identifier, then the PDF
+        flat = pc.list_flatten(fields)
+        first = np.arange(len(flat)) % (width + 1) == 0
+        idents.append(pc.cast(flat.filter(pa.array(first)), pa.int64()))
+        values = pc.cast(flat.filter(pa.array(~first)), pa.float32())
+
+        if bits:
+            quantized, scale = quantize(values.to_numpy().reshape(-1, width), bits)
+            values = pa.array(quantized.ravel())
+            scales.append(pa.array(scale))
+
+        pdfs.append(pa.FixedSizeListArray.from_arrays(values, width))
+
+    ptype = QUANTIZED_TYPES[bits][0] if bits else pa.float32()
+    pdf_type = pa.list_(ptype, width or 0)
+
+    return (
+        pa.chunked_array(idents, type=pa.int64()),
+        pa.chunked_array(pdfs, type=pdf_type),
+        pa.chunked_array(scales, type=pa.float32()) if bits else None
+    )
+
+
+def add_pdz(table, idents, pdfs, scales=None, grid=None, bits=None):
+    """ Adds the PDF columns to the photo-z table, with the redshift grid in
+    the schema metadata
+
+    Args:
+        table (pyarrow.Table): photo-z table (see build_photoz_table)
+        idents (ChunkedArray): PDF identifiers, in the LePhare output order
+        pdfs (ChunkedArray): PDFs
+        scales (ChunkedArray, optional): quantization scales. Defaults to None.
+        grid (ndarray, optional): redshift grid. Defaults to None.
+        bits (int, optional): quantization. Defaults to None.
+
+    Raises:
+        RuntimeError: the PDFs do not match the photo-z rows
+
+    Returns:
+        pyarrow.Table: photo-z table with pdz (and pdz_scale)
+    """
+
+    if not idents.equals(table.column('ident')):
+        raise RuntimeError('PDF identifiers differ from the LePhare output')
+
+    width = pdfs.type.list_size
+    if grid is not None and len(grid) != width:
+        raise RuntimeError(f'PDFs with {width} values for a grid of {len(grid)} redshifts')
+
+    table = table.append_column('pdz', pdfs)
+    if scales is not None:
+        table = table.append_column('pdz_scale', scales)
+
+    metadata = dict(table.schema.metadata or {})
+    metadata[GRID_KEY] = json.dumps(np.asarray(grid).tolist() if grid is not None else None).encode()
+    metadata[QUANTIZE_KEY] = str(bits or 0).encode()
+
+    return table.replace_schema_metadata(metadata)
+
+
+def decode_pdz(table):
+    """ Returns the PDFs of a photo-z table as a float32 matrix with the
+    redshift grid, undoing the quantization
+
+    Args:
+        table (pyarrow.Table): photo-z table with pdz
+
+    Returns:
+        tuple(ndarray, ndarray): PDFs (objects x redshifts) and the grid
+    """
+
+    metadata = table.schema.metadata or {}
+    grid = json.loads(metadata.get(GRID_KEY, b'null'))
+    pdfs = table.column('pdz').combine_chunks()
+    values = pdfs.flatten().to_numpy().reshape(len(pdfs), pdfs.type.list_size)
+
+    if 'pdz_scale' in table.column_names:
+        scale = table.column('pdz_scale').to_numpy()
+        values = values.astype(np.float32) * scale[:, None]
+
+    return values, np.array(grid) if grid is not None else None
@@ -0,0 +1,408 @@
+import os
+import shlex
+import resource
+import subprocess
+import threading
+import numpy as np
+import pyarrow.parquet as parq
+from utils import get_photometric_columns, read_interval, pushed_down_rows, file_checksum
+from lephare_input import write_input
+from lephare_output import read_output, build_photoz_table
+from lephare_pdz import PDZ_TYPE, pdz_file, read_pdz, add_pdz
+from timing import StageTimer
+from qa import partition_summary
+from selection import (
+    selection_columns, row_group_filter, select_rows, empty_photoz, sentinel_rows, assemble
+)
+from incremental import photometry_hash, previous_outputs, load_previous, add_hash
+
+
+def max_rss_mb():
+    """ Returns the peak memory of the worker process and of its largest
+    LePhare subprocess so far (MB) """
+
+    return {
+        'worker': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024., 1),
+        'zphota': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024., 1)
+    }
+
+
+def run_program(cmd, lephare_work, log_path):
+    """ Runs a LePhare program with LEPHAREWORK set for the subprocess only,
+    so programs of concurrent tasks never share the working directory
+
+    Args:
+        cmd (str): command line
+        lephare_work (str): LEPHAREWORK and working directory
+        log_path (str): stdout and stderr path
+
+    Raises:
+        RuntimeError: the program failed
+
+    Returns:
+        int: return code
+    """
+
+    env = dict(os.environ, LEPHAREWORK=lephare_work)
+
+    with open(log_path, 'w+') as subplog:
+        proc = subprocess.Popen(
+            shlex.split(cmd), stdout=subplog, stderr=subplog, universal_newlines=True,
+            cwd=lephare_work, env=env
+        )
+        returncode = proc.wait()
+
+    if returncode != 0:
+        raise RuntimeError(f'{cmd} failed with return code {returncode}, see {log_path}')
+
+    return returncode
+
+
+def wait_program(proc, timeout=None):
+    """ Waits for a LePhare program, killing it after timeout seconds
+
+    Args:
+        proc (Popen): running program
+        timeout (float, optional): seconds. Defaults to None (no limit).
+
+    Raises:
+        RuntimeError: the program did not finish in time
+
+    Returns:
+        int: return code
+    """
+
+    try:
+        return proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        raise RuntimeError(f'{proc.args[0]} killed after {timeout} seconds')
+
+
+def run_partition(key, filename, interval, shifts, zphot_output, photo_type, err_type, apply_corr,
+        bands, zphot, col_index, cat_fmt, idxs, namephotoz, lephare_dir, lephare_run_path,
+        logger, parquet_file=None, stream=False, pdz=None, selection=None,
+        incremental=None, timeout=None, variants=None, coordinates=None):
+    """ Runs LePhare for a partition of an input file
+
+    The run directory must already contain the links to the LePhare
+    libraries (see create_inputs_symbolic_link).
+
+    Args:
+        key (int): partition id
+        filename (str): input file path
+        interval (tuple): first and last (exclusive) rows
+        shifts (str): APPLY_SYSSHIFT values
+        zphot_output (str): parquet output path
+        photo_type (str): string containing magnitude with {} to concatenate the band.
+        err_type (str): string containing magnitude erro with {} to concatenate the band.
+        apply_corr (str): column name to calculate the correction
+        bands (list): bands list
+        zphot (str): zphot.para path
+        col_index (str): index column name
+        cat_fmt (str): catalog format
+        idxs (list): LePhare output column indexes
+        namephotoz (list): LePhare output column names
+        lephare_dir (str): the LePhare installation directory path
+        lephare_run_path (str): run directory path
+        logger (logger): logger object
+        parquet_file (ParquetFile, optional): input file already opened. Defaults to None.
+        stream (bool, optional): exchanges the catalogs with zphota through named pipes. Defaults to False.
+        pdz (dict, optional): PDF output (type, quantize and grid). Defaults to None.
+        selection (dict, optional): objects to fit (min_bands, mag_limits, flags), the
+            others are written with sentinel values. Defaults to None.
+        incremental (dict, optional): previous output directory and configuration hash,
+            the objects with the same photometry keep their previous results. Defaults to None.
+        timeout (float, optional): seconds before zphota is killed. Defaults to None.
+        variants (list, optional): other zphota runs over the same catalog, dicts with
+            name, zphot, shifts and output. Defaults to None.
+        coordinates (list, optional): right ascension and declination columns, copied
+            to the outputs (lower case). Defaults to None.
+
+    Raises:
+        RuntimeError: zphota failed or timed out, or rows are missing
+
+    Returns:
+        dict: input name, output file, number of rows, output checksum, timing
+        record and QA summary, with the file, rows, checksum and QA summary of
+        each variant
+    """
+
+    logger.info('Running zphot ID: {}'.format(key))
+    logger.info('Input file: {}'.format(filename))
+    logger.info('Interval: {}'.format(interval))
+
+    timer = StageTimer()
+
+    # Paths are absolute, the working directory is shared by the threads of a worker
+    with timer.stage('read'):
+        # Gets the list of columns used by LePhare to filter photometric data
+        columns_list = get_photometric_columns(bands, photo_type, err_type, col_index, apply_corr)
+
+        # Columns copied to the outputs, not used by LePhare
+        extra_columns = [name for name in coordinates or [] if name not in columns_list]
+
+        # Loading in memory only the row groups overlapping the selected rows
+        # (kept as an Arrow table, the input columns are viewed without copies)
+        if selection:
+            parquet_file = parquet_file or parq.ParquetFile(filename)
+            columns_list += [name for name in selection_columns(selection) if name not in columns_list]
+            rg_filter = row_group_filter(parquet_file, selection, bands, photo_type)
+            tb = read_interval(
+                filename, interval, columns_list + extra_columns, parquet_file,
+                rg_filter, [col_index] + extra_columns
+            )
+            pushed = pushed_down_rows(parquet_file, interval, rg_filter)
+        else:
+            tb = read_interval(filename, interval, columns_list + extra_columns, parquet_file)
+            pushed = None
+        bytes_in = tb.nbytes
+
+        if tb.num_rows != interval[1] - interval[0]:
+            raise RuntimeError(f"{filename}: {tb.num_rows} rows read, {interval[1] - interval[0]} expected")
+
+        # Gets the index column to be added to the final result
+        col_index_values = tb.column(col_index)
+
+        # Only the selected objects are sent to zphota
+        mask = select_rows(tb, selection, bands, photo_type) if selection else np.ones(tb.num_rows, dtype=bool)
+
+        # Objects unchanged since the previous run keep their results
+        reuse, previous = np.zeros(tb.num_rows, dtype=bool), None
+        if incremental:
+            hashes = photometry_hash(tb, [name for name in columns_list if name != col_index])
+            reuse, previous = load_previous(
+                previous_outputs(incremental.get('previous'), filename), col_index,
+                col_index_values, hashes, incremental.get('config')
+            )
+
+        fit = mask & ~reuse
+        fit_tb = tb if fit.all() else tb.filter(fit)
+
+    logger.info(f'Objects to fit: {fit_tb.num_rows}/{tb.num_rows}, reused: {int(reuse.sum())}')
+
+    lephare_input = os.path.join(lephare_run_path, f'lephare_{str(key)}.input')
+
+    env = dict(os.environ, LEPHAREWORK=lephare_run_path)
+    # env['LEPHAREDIR'] = os.path.dirname(os.path.normpath(lephare_dir))
+
+    logger.info(f'LEPHAREWORK: {lephare_run_path}')
+    logger.info(f'LEPHAREDIR: {os.getenv("LEPHAREDIR")}')
+
+    # zphota runs of the partition, all reading the same catalog
+    runs = [{'name': None, 'zphot': zphot, 'shifts': shifts, 'output': zphot_output}] + list(variants or [])
+
+    if stream and len(runs) > 1:
+        logger.info('Sweep: the catalog is written once to a file, not streamed')
+        stream = False
+
+    def write_catalog():
+        # Create txt input expected by Lephare
+        return write_input(
+            key, fit_tb, bands, photo_type, err_type, col_index, apply_corr, cat_fmt,
+            path=lephare_run_path
+        )
+
+    def parse_output(phzfile):
+        # Loading lePhare output only with selected columns (idxs)
+        zphotoz = read_output(phzfile, idxs, namephotoz)
+        return build_photoz_table(zphotoz, col_index, fit_tb.column(col_index))
+
+    if fit_tb.num_rows and not stream:
+        with timer.stage('format'):
+            write_catalog()
+
+    results = dict()
+
+    for run in runs:
+        suffix = f'_{run["name"]}' if run['name'] else str()
+        phzout = os.path.join(lephare_run_path, f'lephare_{str(key)}{suffix}.out')
+        run_shifts = f'-APPLY_SYSSHIFT {run["shifts"]}' if run['shifts'] else str()
+
+        cmd_phz = f'{lephare_dir}/zphota -c {run["zphot"]} -CAT_IN {lephare_input} -CAT_OUT {phzout} {run_shifts}'
+
+        if pdz:
+            pdz_out = os.path.join(lephare_run_path, f'lephare_{str(key)}{suffix}_pdz')
+            cmd_phz += f' -PDZ_OUT {pdz_out} -PDZ_TYPE {pdz.get("type", PDZ_TYPE)}'
+
+        logger.info(f"Run zphot cmd: {cmd_phz}")
+
+        with open(os.path.join(lephare_run_path, 'zphot.run'), 'a') as subplog:
+            if not fit_tb.num_rows:
+                # nothing to fit, zphota is not started
+                returncode = None
+                table = empty_photoz(namephotoz, col_index, col_index_values.type, pdz)
+            elif stream:
+                # formatting, fitting and parsing overlap, all timed as zphota
+                with timer.stage('zphota'):
+                    returncode, table = stream_zphota(
+                        cmd_phz, lephare_run_path, env, subplog, lephare_input, phzout,
+                        write_catalog, parse_output, timeout
+                    )
+            else:
+                with timer.stage('zphota'):
+                    proc = subprocess.Popen(
+                        shlex.split(cmd_phz), stdout=subplog, stderr=subplog, universal_newlines=True,
+                        cwd=lephare_run_path, env=env
+                    )
+                    returncode = wait_program(proc, timeout)
+
+                # a failed run may leave a truncated output
+                if returncode != 0:
+                    raise RuntimeError(f'zphota failed with return code {returncode}')
+
+                with timer.stage('parse'):
+                    table = parse_output(phzout)
+
+                # the output of the run configuration is kept until the task ends
+                if run['name']:
+                    os.remove(phzout)
+
+        logger.info(f"Return code = {returncode}")
+
+        if table.num_rows != fit_tb.num_rows:
+            raise RuntimeError(f"LePhare output has {table.num_rows} rows, {fit_tb.num_rows} expected")
+
+        if pdz and fit_tb.num_rows:
+            # PDFs parsed by blocks from the file written by zphota
+            with timer.stage('parse'):
+                pdz_path = pdz_file(pdz_out)
+                idents, pdfs, scales = read_pdz(pdz_path, pdz.get('quantize'))
+                table = add_pdz(
+                    table, idents, pdfs, scales, pdz.get('grid'), pdz.get('quantize')
+                )
+                os.remove(pdz_path)
+
+        # Fitted, reused and sentinel rows in the input order
+        parts = [(np.flatnonzero(fit), table)]
+        if previous is not None:
+            parts.append((np.flatnonzero(reuse), previous))
+        if not mask.all():
+            rejected = np.flatnonzero(~mask & ~reuse)
+            parts.append((rejected, sentinel_rows(table.schema, rejected, col_index, col_index_values)))
+
+        if len(parts) > 1:
+            table = assemble(parts)
+
+        for name in coordinates or []:
+            table = table.append_column(name.lower(), tb.column(name))
+
+        if incremental:
+            table = add_hash(table, hashes, incremental.get('config'))
+
+        # Writing the photo-z parquet
+        with timer.stage('write'):
+            os.makedirs(os.path.dirname(run['output']), exist_ok=True)
+            parq.write_table(table, run['output'])
+
+        # Mergeable QA statistics of the partition, reduced by the driver
+        with timer.stage('qa'):
+            summary = partition_summary(table, tb, bands, photo_type, pushed)
+
+        results[run['name']] = {
+            "file": run['output'], "rows": table.num_rows,
+            "checksum": file_checksum(run['output']), "qa": summary
+        }
+
+    if len(runs) > 1 and os.path.isfile(lephare_input):
+        os.remove(lephare_input)
+
+    result = results.pop(None)
+    phzout = os.path.join(lephare_run_path, f'lephare_{str(key)}.out')
+
+    timing = timer.record(
+        key=key, input=os.path.abspath(filename), interval=[int(interval[0]), int(interval[1])],
+        rows=result['rows'], fitted=fit_tb.num_rows, reused=int(reuse.sum()), variants=len(results),
+        bytes_in=bytes_in, bytes_out=os.path.getsize(zphot_output),
+        ascii_bytes=None if stream or len(runs) > 1 or not fit_tb.num_rows else [os.path.getsize(lephare_input), os.path.getsize(phzout)],
+        memory_mb=max_rss_mb()
+    )
+    logger.info(f"Stages (seconds): {timing['stages']}")
+
+    result.update(name=os.path.basename(filename), timing=timing)
+    if results:
+        result['variants'] = results
+
+    return result
+
+
+def _release_fifo(path, flags, thread):
+    """ Opens and closes the other end of a named pipe until the thread
+    blocked on it finishes (zphota exited without opening it) """
+
+    thread.join(timeout=0.1)
+
+    while thread.is_alive():
+        try:
+            os.close(os.open(path, flags | os.O_NONBLOCK))
+        except OSError:
+            pass
+        thread.join(timeout=0.1)
+
+
+def stream_zphota(cmd_phz, lephare_run_path, env, subplog, lephare_input, phzout, write, parse,
+        timeout=None):
+    """ Runs zphota with named pipes as CAT_IN and CAT_OUT: the catalog is
+    written by a thread while zphota reads it, and its output is parsed
+    while it is written, so no ASCII file touches the disk
+
+    Args:
+        cmd_phz (str): zphota command
+        lephare_run_path (str): run directory path
+        env (dict): zphota environment
+        subplog (file): zphota log
+        lephare_input (str): CAT_IN path
+        phzout (str): CAT_OUT path
+        write (callable): writes the catalog in lephare_input
+        parse (callable): parses the output from a file object
+        timeout (float, optional): seconds before zphota is killed. Defaults to None.
+
+    Returns:
+        tuple: zphota return code and parsed output
+    """
+
+    for path in (lephare_input, phzout):
+        if os.path.exists(path):
+            os.remove(path)
+        os.mkfifo(path)
+
+    results, errors = dict(), dict()
+
+    def writer():
+        try:
+            write()
+        except Exception as err:
+            errors['write'] = err
+
+    def reader():
+        try:
+            with open(phzout, 'rb') as phzfile:
+                results['table'] = parse(phzfile)
+        except Exception as err:
+            errors['parse'] = err
+
+    try:
+        proc = subprocess.Popen(
+            shlex.split(cmd_phz), stdout=subplog, stderr=subplog, universal_newlines=True,
+            cwd=lephare_run_path, env=env
+        )
+        threads = (threading.Thread(target=writer), threading.Thread(target=reader))
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            returncode = wait_program(proc, timeout)
+        finally:
+            _release_fifo(lephare_input, os.O_RDONLY, threads[0])
+            _release_fifo(phzout, os.O_WRONLY, threads[1])
+    finally:
+        for path in (lephare_input, phzout):
+            if os.path.exists(path):
+                os.remove(path)
+
+    if returncode != 0 or errors:
+        raise RuntimeError(f'zphota streaming failed (return code {returncode}): {errors}')
+
+    return returncode, results['table']
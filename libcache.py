@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from utils import file_checksum
+
+
+# LePhare directories created by sedtolib, filter and mag_gal
+LIBRARY_DIRS = ('filt', 'lib_bin', 'lib_mag')
+
+# zphot.para keys read by sedtolib, filter and mag_gal
+LIBRARY_KEYS = (
+    'GAL_SED', 'GAL_FSCALE', 'GAL_LIB', 'SEL_AGE', 'AGE_RANGE',
+    'FILTER_LIST', 'TRANS_TYPE', 'FILTER_CALIB', 'FILTER_FILE',
+    'GAL_LIB_IN', 'GAL_LIB_OUT', 'COSMOLOGY', 'MAGTYPE', 'Z_STEP',
+    'EXTINC_LAW', 'EB_V', 'MOD_EXTINC', 'EM_LINES', 'ADD_EMLINES',
+    'LIB_ASCII', 'ADD_DUSTEM'
+)
+
+USED_MARKER = '.last_used'
+
+
+def _resolve(name, candidates):
+    """ Returns the first existing path of name among the candidate dirs """
+
+    if os.path.isabs(name):
+        return name if os.path.isfile(name) else None
+
+    for directory in candidates:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+
+    return None
+
+
+def sed_list_path(zphot_dict):
+    """ Returns the path of the GAL_SED list, looked up in $LEPHAREDIR/sed/GAL
+    and in the working directory when it is relative
+
+    Args:
+        zphot_dict (dict): zphot.para keys and values
+
+    Returns:
+        str: SED list path, None when it is not found
+    """
+
+    lephare_root = os.getenv('LEPHAREDIR', '')
+    sed_list = zphot_dict.get('GAL_SED')
+
+    return _resolve(sed_list, [os.path.join(lephare_root, 'sed', 'GAL'), os.getcwd()]) if sed_list else None
+
+
+def library_inputs(zphot_dict, lephare_dir=None):
+    """ Lists the zphot.para values and the files the libraries depend on
+
+    Relative SED, filter and extinction law names are looked up in
+    $LEPHAREDIR (sed/GAL, filt and ext) and next to the SED list.
+
+    Args:
+        zphot_dict (dict): zphot.para keys and values
+        lephare_dir (str, optional): LePhare binaries path. Defaults to None.
+
+    Returns:
+        dict: parameters, files digests and missing files
+    """
+
+    lephare_root = os.getenv('LEPHAREDIR', '')
+    params = {key: zphot_dict.get(key) for key in LIBRARY_KEYS if key in zphot_dict}
+    files, missing = dict(), list()
+
+    def add(name, candidates):
+        path = _resolve(name, candidates)
+        if path:
+            files[name] = file_checksum(path)
+        else:
+            missing.append(name)
+
+    sed_list = sed_list_path(zphot_dict)
+
+    if sed_list:
+        files[os.path.basename(sed_list)] = file_checksum(sed_list)
+        list_dir = os.path.dirname(sed_list)
+        candidates = [
+            os.path.join(lephare_root, 'sed', 'GAL'), list_dir, os.path.dirname(list_dir)
+        ]
+
+        with open(sed_list) as _file:
+            for line in _file:
+                fields = line.split()
+                if fields and not fields[0].startswith('#'):
+                    add(fields[0], candidates)
+    elif zphot_dict.get('GAL_SED'):
+        missing.append(zphot_dict.get('GAL_SED'))
+
+    for name in filter(None, zphot_dict.get('FILTER_LIST', '').split(',')):
+        add(name, [os.path.join(lephare_root, 'filt')])
+
+    for name in filter(None, zphot_dict.get('EXTINC_LAW', '').split(',')):
+        add(name, [os.path.join(lephare_root, 'ext')])
+
+    return {
+        'params': params, 'files': files, 'missing': sorted(missing),
+        'lephare_bin': lephare_dir
+    }
+
+
+def library_key(zphot_dict, lephare_dir=None):
+    """ Computes the content hash identifying a LePhare library set
+
+    Args:
+        zphot_dict (dict): zphot.para keys and values
+        lephare_dir (str, optional): LePhare binaries path. Defaults to None.
+
+    Returns:
+        tuple(str, dict): hash and the inputs used to compute it
+    """
+
+    inputs = library_inputs(zphot_dict, lephare_dir)
+    encoded = json.dumps(inputs, sort_keys=True).encode()
+
+    return hashlib.sha256(encoded).hexdigest(), inputs
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def restore(cache_dir, key, lephare_sandbox):
+    """ Copies a cached library set to the sandbox
+
+    Args:
+        cache_dir (str): cache root path
+        key (str): library hash
+        lephare_sandbox (str): working directory path
+
+    Returns:
+        bool: True if the libraries were found in the cache
+    """
+
+    entry = os.path.join(cache_dir, key)
+
+    if not os.path.isfile(os.path.join(entry, USED_MARKER)):
+        return False
+
+    for dirname in LIBRARY_DIRS:
+        shutil.copytree(
+            os.path.join(entry, dirname), os.path.join(lephare_sandbox, dirname),
+            copy_function=_link_or_copy, dirs_exist_ok=True
+        )
+
+    os.utime(os.path.join(entry, USED_MARKER))
+
+    return True
+
+
+def merge(library_dir, lephare_sandbox):
+    """ Links the libraries built in another directory (of another zphot.para)
+    next to the sandbox ones, used by the same zphota runs
+
+    Args:
+        library_dir (str): directory with filt, lib_bin and lib_mag
+        lephare_sandbox (str): working directory path
+
+    Raises:
+        FileExistsError: a sandbox library has the same name and another content
+    """
+
+    for dirname in LIBRARY_DIRS:
+        source_dir = os.path.join(library_dir, dirname)
+        target_dir = os.path.join(lephare_sandbox, dirname)
+        os.makedirs(target_dir, exist_ok=True)
+
+        for name in sorted(os.listdir(source_dir)) if os.path.isdir(source_dir) else []:
+            src, dst = os.path.join(source_dir, name), os.path.join(target_dir, name)
+
+            if not os.path.isfile(src):
+                continue
+
+            if os.path.exists(dst):
+                if os.path.samefile(src, dst) or file_checksum(src) == file_checksum(dst):
+                    continue
+                raise FileExistsError(f'{dst} already exists with another content')
+
+            _link_or_copy(src, dst)
+
+
+def store(cache_dir, key, lephare_sandbox, inputs=None):
+    """ Adds the sandbox libraries to the cache
+
+    The entry is written in a temporary directory and renamed, so
+    concurrent runs never see a partial library set.
+
+    Args:
+        cache_dir (str): cache root path
+        key (str): library hash
+        lephare_sandbox (str): working directory path
+        inputs (dict, optional): inputs used to compute the key. Defaults to None.
+    """
+
+    entry = os.path.join(cache_dir, key)
+
+    if os.path.isdir(entry):
+        return
+
+    tmp_entry = f'{entry}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp_entry, ignore_errors=True)
+    os.makedirs(tmp_entry)
+
+    for dirname in LIBRARY_DIRS:
+        shutil.copytree(
+            os.path.join(lephare_sandbox, dirname), os.path.join(tmp_entry, dirname),
+            copy_function=_link_or_copy
+        )
+
+    with open(os.path.join(tmp_entry, 'inputs.json'), 'w') as _file:
+        json.dump(inputs or {}, _file, indent=2, sort_keys=True)
+
+    open(os.path.join(tmp_entry, USED_MARKER), 'w').close()
+
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # another run stored the same libraries
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+
+def _dir_size(path):
+    size = 0
+
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.lstat(os.path.join(root, name)).st_size
+
+    return size
+
+
+def evict(cache_dir, max_size=None, max_age=None, keep=None):
+    """ Removes cache entries unused for more than max_age days, then the
+    least recently used ones until the cache fits in max_size GB
+
+    Args:
+        cache_dir (str): cache root path
+        max_size (float, optional): maximum cache size in GB. Defaults to None.
+        max_age (float, optional): maximum age in days. Defaults to None.
+        keep (str or list, optional): keys that are never removed. Defaults to None.
+
+    Returns:
+        list: removed keys
+    """
+
+    if not os.path.isdir(cache_dir):
+        return list()
+
+    keep = [keep] if isinstance(keep, str) else list(keep or [])
+    entries = list()
+
+    for key in os.listdir(cache_dir):
+        marker = os.path.join(cache_dir, key, USED_MARKER)
+        if os.path.isfile(marker):
+            entries.append((os.path.getmtime(marker), key, _dir_size(os.path.join(cache_dir, key))))
+
+    entries.sort()
+    removed, now = list(), time.time()
+    total = sum(entry[2] for entry in entries)
+
+    for last_used, key, size in entries:
+        too_old = max_age is not None and now - last_used > max_age * 86400
+        too_big = max_size is not None and total > max_size * 1024**3
+
+        if key in keep or not (too_old or too_big):
+            continue
+
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        removed.append(key)
+        total -= size
+
+    return removed
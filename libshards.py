@@ -0,0 +1,321 @@
+import os
+import filecmp
+import numpy as np
+
+
+# LePhare keys given on the command line of the shard programs, restored to
+# the zphot.para values in the merged .doc
+SHARD_KEYS = ('GAL_SED', 'GAL_LIB', 'GAL_LIB_IN', 'GAL_LIB_OUT', 'MOD_EXTINC')
+
+# .doc keys summed over the shards
+COUNT_KEYS = ('NUMBER_SED', 'NUMBER_ROWS')
+
+# .doc keys that differ between two runs of the same library
+DATE_KEYS = ('CREATION_DATE', 'DATE')
+
+# lib_mag files of a library: binary models, header and ASCII copy (LIB_ASCII)
+LIBRARY_EXTENSIONS = ('.bin', '.doc', '.dat')
+
+
+def read_sed_list(path):
+    """ Reads the SED names of a GAL_SED list
+
+    Args:
+        path (str): SED list path
+
+    Returns:
+        list: SED lines, in the order of the model numbers
+    """
+
+    with open(path) as _file:
+        return [line.strip() for line in _file if line.split() and not line.lstrip().startswith('#')]
+
+
+def shard_extinction(mod_extinc, first, count):
+    """ Restricts the MOD_EXTINC model ranges to a shard and renumbers them
+
+    Each pair of values is the range of models using the extinction law of the
+    same rank in EXTINC_LAW, so the pairs keep their positions (0,0 when the
+    range has no model of the shard).
+
+    Args:
+        mod_extinc (str): MOD_EXTINC value, e.g. 13,23,23,31
+        first (int): number of models before the shard
+        count (int): number of models of the shard
+
+    Returns:
+        str: MOD_EXTINC value of the shard
+    """
+
+    values = [int(value) for value in mod_extinc.split(',') if value]
+    ranges = list()
+
+    for low, high in zip(values[::2], values[1::2]):
+        low, high = max(low, first + 1), min(high, first + count)
+        ranges.extend([low - first, high - first] if low <= high else [0, 0])
+
+    return ','.join(str(value) for value in ranges)
+
+
+def plan_shards(zphot_dict, sed_list, shards, library_dir):
+    """ Splits the SED list in consecutive subsets and writes their lists
+
+    Args:
+        zphot_dict (dict): zphot.para keys and values
+        sed_list (str): GAL_SED list path
+        shards (int): number of subsets
+        library_dir (str): directory of filt, lib_bin and lib_mag
+
+    Returns:
+        list: shards, dicts with the first model number minus one (offset),
+        the number of models (count) and the sedtolib and mag_gal command line
+        keys (sedtolib, mag_gal)
+    """
+
+    seds = read_sed_list(sed_list)
+    gal_lib = zphot_dict.get('GAL_LIB')
+    gal_lib_out = zphot_dict.get('GAL_LIB_OUT')
+    mod_extinc = zphot_dict.get('MOD_EXTINC', '0,0')
+
+    plan, first = list(), 0
+
+    for nshard, subset in enumerate(np.array_split(np.arange(len(seds)), min(shards, len(seds)))):
+        list_path = os.path.join(library_dir, f'{gal_lib}_shard{nshard}.list')
+
+        with open(list_path, 'w') as _file:
+            _file.writelines(f'{seds[index]}\n' for index in subset)
+
+        plan.append({
+            'offset': first, 'count': len(subset),
+            'sedtolib': {'GAL_SED': list_path, 'GAL_LIB': f'{gal_lib}_shard{nshard}'},
+            'mag_gal': {
+                'GAL_LIB_IN': f'{gal_lib}_shard{nshard}',
+                'GAL_LIB_OUT': f'{gal_lib_out}_shard{nshard}',
+                'MOD_EXTINC': shard_extinction(mod_extinc, first, len(subset))
+            }
+        })
+        first += len(subset)
+
+    return plan
+
+
+def read_doc(path):
+    """ Reads a LePhare .doc file
+
+    Args:
+        path (str): .doc path
+
+    Returns:
+        list: (key, value) of each line, value as written after the key
+    """
+
+    entries = list()
+
+    with open(path) as _file:
+        for line in _file.read().splitlines():
+            fields = line.split(None, 1)
+            if fields:
+                entries.append((fields[0], fields[1] if len(fields) > 1 else ''))
+
+    return entries
+
+
+def _doc_values(entries, skip):
+    return [(key, value.strip()) for key, value in entries if key not in skip]
+
+
+def merge_docs(docs, restore):
+    """ Merges the .doc of the shards: sums the counts and restores the keys
+    given on the shard command lines
+
+    Args:
+        docs (list): read_doc entries of each shard
+        restore (dict): SHARD_KEYS values of zphot.para
+
+    Raises:
+        ValueError: the shards differ in another key
+
+    Returns:
+        list: (key, value) of the merged .doc
+    """
+
+    skip = COUNT_KEYS + DATE_KEYS + tuple(restore)
+    reference = _doc_values(docs[0], skip)
+
+    for doc in docs[1:]:
+        if _doc_values(doc, skip) != reference:
+            raise ValueError('the .doc of the shards differ beyond the model counts')
+
+    merged = list()
+
+    for key, value in docs[0]:
+        if key in COUNT_KEYS:
+            value = str(sum(int(dict(doc)[key].split()[0]) for doc in docs))
+        elif key in restore:
+            value = restore[key]
+        merged.append((key, value))
+
+    return merged
+
+
+def write_doc(path, entries):
+    """ Writes a LePhare .doc file
+
+    Args:
+        path (str): .doc path
+        entries (list): (key, value) of each line
+    """
+
+    with open(path, 'w') as _file:
+        _file.writelines(f'{key:<20s} {value}\n' for key, value in entries)
+
+
+def renumber_binary(path, offset, nrows, output):
+    """ Appends the models of a binary library to output, adding offset to
+    their model number
+
+    The models are fixed length records (Fortran direct access) starting with
+    the model number as a 4-byte integer.
+
+    Args:
+        path (str): .bin path of a shard
+        offset (int): number of models before the shard
+        nrows (int): number of records (NUMBER_ROWS of the .doc)
+        output (file): merged .bin, opened in binary mode
+
+    Raises:
+        ValueError: the file size is not a multiple of nrows
+    """
+
+    size = os.path.getsize(path)
+
+    if nrows and size % nrows:
+        raise ValueError(f'{path}: {size} bytes is not a multiple of {nrows} records')
+
+    if not nrows:
+        return
+
+    record = np.dtype([('model', '=i4'), ('values', f'V{size // nrows - 4}')])
+    models = np.fromfile(path, dtype=record)
+    models['model'] += offset
+    models.tofile(output)
+
+
+def renumber_ascii(path, offset, output, header=True):
+    """ Appends the models of an ASCII library (LIB_ASCII) to output, adding
+    offset to the model number of the first column, kept in its width
+
+    Args:
+        path (str): .dat path of a shard
+        offset (int): number of models before the shard
+        output (file): merged .dat, opened in text mode
+        header (bool, optional): copies the comment lines. Defaults to True.
+    """
+
+    with open(path) as _file:
+        for line in _file:
+            fields = line.split(None, 1)
+
+            if not fields or fields[0].startswith('#'):
+                if header:
+                    output.write(line)
+                continue
+
+            start = line.index(fields[0])
+            width = start + len(fields[0])
+            model = str(int(fields[0]) + offset)
+            output.write(model.rjust(width) + line[width:])
+
+
+def merge_libraries(lib_dir, plan, name, restore):
+    """ Merges the lib_mag libraries of the shards into the library name,
+    as written by a single mag_gal run over all the SEDs
+
+    Args:
+        lib_dir (str): lib_mag path
+        plan (list): shards, see plan_shards
+        name (str): GAL_LIB_OUT of the merged library
+        restore (dict): SHARD_KEYS values of zphot.para
+
+    Raises:
+        ValueError: a shard is missing, has an unexpected file or another .doc
+    """
+
+    parts = [os.path.join(lib_dir, shard['mag_gal']['GAL_LIB_OUT']) for shard in plan]
+
+    for part in parts:
+        prefix = os.path.basename(part) + '.'
+        extra = [
+            filename for filename in os.listdir(lib_dir)
+            if filename.startswith(prefix) and filename[len(prefix) - 1:] not in LIBRARY_EXTENSIONS
+        ]
+        if extra or not os.path.isfile(part + '.doc'):
+            raise ValueError(f'{part}: files {extra or [".doc"]} can not be merged')
+
+    docs = [read_doc(part + '.doc') for part in parts]
+    nrows = [int(dict(doc).get('NUMBER_ROWS', '0').split()[0] or 0) for doc in docs]
+
+    if any(os.path.getsize(part + '.bin') for part in parts) and not all(nrows):
+        raise ValueError(f'{lib_dir}: NUMBER_ROWS missing in the .doc of the shards')
+
+    target = os.path.join(lib_dir, name)
+    write_doc(target + '.doc', merge_docs(docs, restore))
+
+    with open(target + '.bin', 'wb') as output:
+        for part, shard, rows in zip(parts, plan, nrows):
+            renumber_binary(part + '.bin', shard['offset'], rows, output)
+
+    if os.path.isfile(parts[0] + '.dat'):
+        with open(target + '.dat', 'w') as output:
+            for part, shard in zip(parts, plan):
+                renumber_ascii(part + '.dat', shard['offset'], output, header=shard is plan[0])
+
+
+def compare_libraries(lib_dir, name, reference, restore):
+    """ Compares the merged library with a single-run library
+
+    Args:
+        lib_dir (str): lib_mag path
+        name (str): GAL_LIB_OUT of the merged library
+        reference (str): GAL_LIB_OUT of the single-run library
+        restore (dict): SHARD_KEYS values of zphot.para
+
+    Returns:
+        list: files of the merged library that differ
+    """
+
+    differ = list()
+
+    for extension in LIBRARY_EXTENSIONS:
+        path, expected = os.path.join(lib_dir, name + extension), os.path.join(lib_dir, reference + extension)
+
+        if not os.path.isfile(path) and not os.path.isfile(expected):
+            continue
+
+        if extension == '.doc' and os.path.isfile(path) and os.path.isfile(expected):
+            skip = DATE_KEYS + tuple(restore)
+            same = _doc_values(read_doc(path), skip) == _doc_values(read_doc(expected), skip)
+        elif os.path.isfile(path) and os.path.isfile(expected):
+            same = filecmp.cmp(path, expected, shallow=False)
+        else:
+            same = False
+
+        if not same:
+            differ.append(os.path.basename(path))
+
+    return differ
+
+
+def remove_library(directory, name):
+    """ Removes the files of a library (name.*) from a LePhare directory
+
+    Args:
+        directory (str): lib_bin or lib_mag path
+        name (str): library name
+    """
+
+    prefix = name + '.'
+
+    for filename in os.listdir(directory):
+        if filename.startswith(prefix):
+            os.remove(os.path.join(directory, filename))
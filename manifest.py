@@ -0,0 +1,186 @@
+import os
+import json
+import hashlib
+from utils import file_checksum
+
+
+# settings that change the photo-z results
+RESULT_SETTINGS = (
+    'photo_corr', 'photo_type', 'err_type', 'bands', 'index', 'shifts', 'pdz',
+    'selection', 'coordinates'
+)
+
+
+def config_hash(settings, zphot_dict):
+    """ Computes the hash of the configuration used to compute the photo-zs
+
+    Args:
+        settings (dict): settings section of config.yml
+        zphot_dict (dict): zphot.para keys and values
+
+    Returns:
+        string: hexadecimal digest
+    """
+
+    config = {
+        'settings': {key: settings.get(key) for key in RESULT_SETTINGS},
+        'zphot': zphot_dict
+    }
+
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def partition_record(filename, interval, config, output, rows=None, checksum=None):
+    """ Creates a manifest record
+
+    Args:
+        filename (string): input file path
+        interval (tuple): first and last (exclusive) rows
+        config (string): configuration hash
+        output (string): output file path
+        rows (int, optional): number of rows written. Defaults to None.
+        checksum (string, optional): output checksum. Defaults to None.
+
+    Returns:
+        dict: manifest record
+    """
+
+    return {
+        'input': os.path.abspath(filename), 'interval': [int(interval[0]), int(interval[1])],
+        'config': config, 'output': os.path.abspath(output),
+        'rows': rows, 'checksum': checksum
+    }
+
+
+def _record_key(record):
+    return (
+        record.get('input'), tuple(record.get('interval')), record.get('config'),
+        record.get('output')
+    )
+
+
+def load_manifest(manifest_path):
+    """ Loads the records of the completed partitions
+
+    Truncated lines, left by an interrupted run, are ignored.
+
+    Args:
+        manifest_path (string): manifest path
+
+    Returns:
+        dict: records by (input, interval, config, output)
+    """
+
+    records = dict()
+
+    if not os.path.isfile(manifest_path):
+        return records
+
+    with open(manifest_path) as _file:
+        for line in _file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[_record_key(record)] = record
+
+    return records
+
+
+def append_record(manifest_path, record):
+    """ Appends a completed partition to the manifest
+
+    Args:
+        manifest_path (string): manifest path
+        record (dict): manifest record
+    """
+
+    with open(manifest_path, 'a') as _file:
+        _file.write(json.dumps(record, sort_keys=True) + '\n')
+        _file.flush()
+        os.fsync(_file.fileno())
+
+
+def is_complete(records, expected):
+    """ Checks if a partition was already computed with the same
+    configuration and if its output is still valid
+
+    Args:
+        records (dict): manifest records (see load_manifest)
+        expected (dict): record of the planned partition
+
+    Returns:
+        bool: True if the partition can be skipped
+    """
+
+    record = records.get(_record_key(expected))
+
+    if not record:
+        return False
+
+    first, last = expected.get('interval')
+    if record.get('rows') != last - first:
+        return False
+
+    output = record.get('output')
+    if not os.path.isfile(output):
+        return False
+
+    return file_checksum(output) == record.get('checksum')
+
+
+def split_interval(interval, output):
+    """ Splits a partition in halves, named after its output
+
+    Args:
+        interval (tuple): first and last (exclusive) rows
+        output (string): output file path
+
+    Returns:
+        list: (interval, output) of each half
+    """
+
+    first, last = interval
+    middle = (first + last) // 2
+    stem = os.path.splitext(output)[0]
+
+    return [((first, middle), f'{stem}a.parquet'), ((middle, last), f'{stem}b.parquet')]
+
+
+def resume_pieces(records, filename, interval, config, output, min_rows=None, others=None):
+    """ Finds the pieces of a partition to compute again: the whole partition,
+    or the halves without a valid output when it was split after failures
+
+    Args:
+        records (dict): manifest records (see load_manifest)
+        filename (string): input file path
+        interval (tuple): first and last (exclusive) rows
+        config (string): configuration hash
+        output (string): output file path
+        min_rows (int, optional): smallest half. Defaults to None (never split).
+        others (callable, optional): records of the other outputs of a piece
+            (interval, output), all valid when it is complete. Defaults to None.
+
+    Returns:
+        list: (interval, output, complete) of each piece, in the rows order
+    """
+
+    expected = [partition_record(filename, interval, config, output)]
+    if others:
+        expected += others(interval, output)
+
+    if all(is_complete(records, record) for record in expected):
+        return [(interval, output, True)]
+
+    if not min_rows or interval[1] - interval[0] < 2 * min_rows:
+        return [(interval, output, False)]
+
+    pieces = list()
+    for half, half_output in split_interval(interval, output):
+        pieces += resume_pieces(records, filename, half, config, half_output, min_rows, others)
+
+    # without any completed half, the partition is computed whole
+    if not any(complete for _, _, complete in pieces):
+        return [(interval, output, False)]
+
+    return pieces
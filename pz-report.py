@@ -0,0 +1,118 @@
+from timing import (
+    STAGES, TIMINGS_FILE, load_timings, throughput_by_host,
+    slowest_partitions, stage_breakdown
+)
+from qa import QA_FILE, load_qa, describe
+import os
+import json
+import argparse
+
+
+def report(timings_path, count=10):
+    """ Prints the throughput per node, the slowest partitions and the
+    stage breakdown of a run
+
+    Args:
+        timings_path (str): timings file path
+        count (int, optional): number of slowest partitions. Defaults to 10.
+
+    Returns:
+        dict: report sections
+    """
+
+    records = load_timings(timings_path)
+
+    if not records:
+        print(f'No timing records in {timings_path}')
+        raise BaseException
+
+    hosts = throughput_by_host(records)
+    slowest = slowest_partitions(records, count)
+    breakdown = stage_breakdown(records)
+
+    rows = sum(record.get('rows', 0) for record in records)
+    wall = max(r.get('end') for r in records) - min(r.get('start') for r in records)
+
+    print(f'Partitions: {len(records)}, rows: {rows}, wall: {wall:.1f} s, rows/s: {rows / max(wall, 1e-9):.1f}')
+
+    print('\nThroughput per node')
+    print(f"{'host':<30} {'partitions':>10} {'rows':>12} {'busy (s)':>10} {'wall (s)':>10} {'rows/s':>10} {'mem (MB)':>10}")
+    for host, values in sorted(hosts.items(), key=lambda item: item[1]['rows_per_second'] or 0.):
+        print(
+            f"{host:<30} {values['partitions']:>10} {values['rows']:>12} "
+            f"{values['busy_seconds']:>10.1f} {values['wall_seconds']:>10.1f} "
+            f"{values['rows_per_second'] or 0.:>10.1f} {values['max_memory_mb']:>10.1f}"
+        )
+
+    print('\nSlowest partitions')
+    print(f"{'key':>6} {'seconds':>9} {'rows':>9} {'host':<20} " + ' '.join(f'{name:>8}' for name in STAGES) + '  input')
+    for record in slowest:
+        stages = record.get('stages', {})
+        print(
+            f"{record.get('key'):>6} {record.get('seconds'):>9.2f} {record.get('rows'):>9} "
+            f"{record.get('host'):<20} " + ' '.join(f'{stages.get(name, 0.):>8.2f}' for name in STAGES)
+            + f"  {os.path.basename(record.get('input'))}{record.get('interval')}"
+        )
+
+    print('\nStage breakdown')
+    print(f"{'stage':<8} {'seconds':>10} {'mean':>9} {'share':>7}")
+    for name, values in breakdown.items():
+        share = f"{100. * values['share']:>6.1f}%" if values['share'] is not None else f"{'-':>7}"
+        print(f"{name:<8} {values['seconds']:>10.1f} {values['mean']:>9.3f} {share}")
+
+    return {'hosts': hosts, 'slowest': slowest, 'stages': breakdown}
+
+
+def report_qa(qa_path):
+    """ Prints the QA statistics merged over the partitions of a run
+
+    Args:
+        qa_path (str): QA file path
+
+    Returns:
+        dict: count, invalid, min, max, mean and std by column
+    """
+
+    summary = load_qa(qa_path).get('summary')
+
+    if not summary:
+        print(f'No QA statistics in {qa_path}')
+        raise BaseException
+
+    print(f"\nQA: {summary['partitions']} partitions, {summary['rows']} rows, "
+          f"objects without valid bands (context 0): {summary['context_0']}, "
+          f"photometry not read (selection): {summary.get('pushed_down', 0)}")
+    print(f"{'column':<20} {'count':>12} {'invalid':>10} {'min':>9} {'max':>9} {'mean':>9} {'std':>9}")
+
+    description = describe(summary)
+    for name, values in description.items():
+        stats = ' '.join(
+            f'{values[key]:>9.4f}' if values[key] is not None else f"{'-':>9}"
+            for key in ('min', 'max', 'mean', 'std')
+        )
+        print(f"{name:<20} {values['count']:>12} {values['invalid']:>10} {stats}")
+
+    return description
+
+
+if __name__ == '__main__':
+    working_dir = os.getcwd()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--working_dir", dest="working_dir", default=working_dir, help="run directory")
+    parser.add_argument("-t", "--timings", dest="timings", default=None, help=f"timings path (default: <working_dir>/sandbox/{TIMINGS_FILE})")
+    parser.add_argument("-n", "--slowest", dest="slowest", type=int, default=10, help="number of slowest partitions")
+    parser.add_argument("-q", "--qa", dest="qa", default=None, help="QA path (e.g. <working_dir>/sandbox/<output_dir>/" + QA_FILE + ")")
+    parser.add_argument("-o", "--output", dest="output", default=None, help="writes the report as json")
+
+    args = parser.parse_args()
+    timings_path = args.timings or os.path.join(args.working_dir, 'sandbox', TIMINGS_FILE)
+
+    sections = report(timings_path, args.slowest)
+
+    if args.qa:
+        sections['qa'] = report_qa(args.qa)
+
+    if args.output:
+        with open(args.output, 'w') as _file:
+            json.dump(sections, _file, indent=2)
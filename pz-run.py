@@ -1,26 +1,265 @@
 import parsl
 from condor import get_config
-from apps import (
-    run_zphot, create_galaxy_lib,
-    create_filter_set, compute_galaxy_mag
-)
+from apps import create_galaxy_lib, create_filter_set, compute_galaxy_mag, merge_galaxy_mag
 from utils import (
-    create_dir, prepare_format_output, set_partitions
+    create_dir, prepare_format_output, plan_partitions, read_zphot_para
 )
+from timing import TIMINGS_FILE
+from lephare_pdz import PDZ_TYPE, redshift_grid
+from qa import QA_FILE, load_qa, partition_key, missing_partitions
+from scheduler import FileOutputs, Scheduler
+from sweep import variant_root, load_variants, variant_records
+from healpix import HEALPIX_DIR, check_nside, new_index, load_index
+import libcache
+import libshards
+import manifest
+import idindex
 import time
 import yaml
 import os
 import glob
+import shutil
 import logging
 import argparse
 
 
-def run(phz_config, parsl_config):
+def build_libraries(zphot_para, zphot_dict, lephare_dir, library_dir, cache_dir, logger, libraries=None):
+    """ Restores the LePhare libraries of a zphot.para from the cache, or
+    creates them (steps 1, 2 and 3)
+
+    Args:
+        zphot_para (str): zphot.para path
+        zphot_dict (dict): zphot.para keys and values
+        lephare_dir (str): LePhare binaries path
+        library_dir (str): directory of filt, lib_bin and lib_mag
+        cache_dir (str): cache root path, None without cache
+        logger (logger): logger object
+        libraries (dict, optional): libraries section of config.yml (SED
+            subsets of mag_gal). Defaults to None.
+
+    Returns:
+        str: library hash, None without cache
+    """
+
+    libraries = libraries or {}
+
+    # Creating LePhare dirs
+    for x in ['filt', 'lib_bin', 'lib_mag']:
+        try:
+            os.mkdir(os.path.join(library_dir, x))
+        except:
+            pass
+
+    libkey = None
+
+    if cache_dir:
+        libkey, libinputs = libcache.library_key(zphot_dict, lephare_dir)
+
+        if libinputs.get('missing'):
+            logger.warning(f"   library inputs not found: {libinputs.get('missing')}")
+
+    if cache_dir and libcache.restore(cache_dir, libkey, library_dir):
+        logger.info(f"-> Steps 1, 2 and 3: libraries restored from cache {libkey}")
+    else:
+        # Steps 1 and 2 are independent, step 3 starts when both are completed
+        logger.info("-> Steps 1 and 2: creating SED library and filter transmission files")
+        gallib = create_galaxy_lib(
+            zphot_para, lephare_dir, library_dir, stdout='sedtolib.log'
+        )
+        filterset = create_filter_set(
+            zphot_para, lephare_dir, library_dir, stdout='filter.log'
+        )
+
+        shards = int(libraries.get('sed_shards', 1))
+        sed_list = libcache.sed_list_path(zphot_dict) if shards > 1 else None
+
+        if shards > 1 and not sed_list:
+            logger.warning(f"   SED list {zphot_dict.get('GAL_SED')} not found, mag_gal runs over all the SEDs")
+
+        if sed_list:
+            # Step 3 by SED subsets: sedtolib and mag_gal of each subset, then merge
+            name = zphot_dict.get('GAL_LIB_OUT')
+            plan = libshards.plan_shards(zphot_dict, sed_list, shards, library_dir)
+            restore = {key: zphot_dict.get(key, '') for key in libshards.SHARD_KEYS}
+            logger.info(f"-> Step 3: theoretical magnitudes library, {len(plan)} SED subsets")
+
+            parts = list()
+            for nshard, shard in enumerate(plan):
+                shardlib = create_galaxy_lib(
+                    zphot_para, lephare_dir, library_dir, stdout=f'sedtolib_shard{nshard}.log',
+                    options=shard['sedtolib']
+                )
+                parts.append(compute_galaxy_mag(
+                    zphot_para, lephare_dir, library_dir, stdout=f'mag_gal_shard{nshard}.log',
+                    options=shard['mag_gal'], inputs=[shardlib, filterset]
+                ))
+
+            galmag = merge_galaxy_mag(library_dir, plan, name, restore, inputs=parts)
+
+            if libraries.get('verify', False):
+                reference = f'{name}_single'
+                single = compute_galaxy_mag(
+                    zphot_para, lephare_dir, library_dir, stdout='mag_gal_single.log',
+                    options={'GAL_LIB_OUT': reference}, inputs=[gallib, filterset]
+                )
+
+            try:
+                galmag.result()
+            except ValueError as err:
+                logger.error(f"   SED subsets not merged: {err}")
+                raise BaseException
+
+            if libraries.get('verify', False):
+                single.result()
+
+                lib_mag = os.path.join(library_dir, 'lib_mag')
+                differ = libshards.compare_libraries(lib_mag, name, reference, restore)
+                libshards.remove_library(lib_mag, reference)
+
+                if differ:
+                    logger.error(f"   merged library differs from a single mag_gal run: {differ}")
+                    raise BaseException
+
+                logger.info("   merged library identical to a single mag_gal run")
+        else:
+            logger.info("-> Step 3: theoretical magnitudes library")
+            galmag = compute_galaxy_mag(
+                zphot_para, lephare_dir, library_dir, stdout='mag_gal.log',
+                inputs=[gallib, filterset]
+            )
+
+        galmag.result()
+        gallib.result()
+
+        if cache_dir:
+            libcache.store(cache_dir, libkey, library_dir, libinputs)
+            logger.info(f"   libraries stored in cache {libkey}")
+
+    return libkey
+
+
+def plan_tasks(partitions_list, output_root, confighash, variants, outputs, completed, resume=False,
+        ninterval=0, min_rows=None):
+    """ Creates the partitions to compute, numbered in the files order, and
+    the input files they belong to
+
+    With resume, the partitions (and pieces of failed partitions) recorded in
+    the manifest are skipped, as the files already compacted, whose final
+    outputs are laid out and indexed again when needed.
+
+    Args:
+        partitions_list (list): planned partitions of each file (path and ranges)
+        output_root (str): output directory of the run
+        confighash (str): configuration hash
+        variants (list): sweep variants
+        outputs (FileOutputs): final outputs of the files
+        completed (dict): manifest records of a previous run
+        resume (bool, optional): skips the completed partitions. Defaults to False.
+        ninterval (int, optional): partitions per file, 0 for all (test environment). Defaults to 0.
+        min_rows (int, optional): smallest half of a failed partition, None
+            without bisection. Defaults to None.
+
+    Returns:
+        tuple(list, list, list, list, int):
+            0: partitions to compute, the largest first
+            1: input files (entries of the partitions)
+            2: (file, paths) of the compacted files to lay out and index
+            3: partition keys (see qa.partition_key) of the skipped partitions
+            4: id of the next partition
+    """
+
+    counter, tasks, files, finals, skipped_keys = 1, list(), list(), list(), list()
+
+    for item in partitions_list:
+        filename = item.get("path")
+        ranges = item.get("ranges")[:ninterval] if ninterval else item.get("ranges")
+        tile = os.path.basename(filename).replace(".parquet", "")
+        output_dir_file = os.path.join(output_root, tile)
+
+        compact_out = os.path.join(output_root, f'{tile}.parquet')
+        compact_record = manifest.partition_record(
+            filename, (ranges[0][0], ranges[-1][1]), confighash, compact_out
+        )
+        compact_variants = variant_records(
+            variants, filename, (ranges[0][0], ranges[-1][1]), compact_out, output_root
+        )
+
+        # a partition (or file) is complete when the outputs of all the variants are
+        def others(piece, output, filename=filename):
+            return list(variant_records(variants, filename, piece, output, output_root).values())
+
+        if outputs.compact and resume and all(
+            manifest.is_complete(completed, record) for record in [compact_record, *compact_variants.values()]
+        ):
+            outputs.compacted[None].append(compact_out)
+            for name, record in compact_variants.items():
+                outputs.compacted[name].append(record['output'])
+            if outputs.healpix or outputs.ids:
+                finals.append(({'name': tile, 'record': compact_record}, [compact_out]))
+            skipped_keys.extend(partition_key(filename, interval) for interval in ranges)
+            counter += len(ranges)
+            continue
+
+        file_tasks, partials = list(), list()
+
+        for interval in ranges:
+            create_dir(output_dir_file)
+            phot_out = os.path.join(
+                output_dir_file,
+                f'photz-{str(counter).zfill(5)}.parquet'
+            )
+
+            # partitions split after failures are resumed by halves
+            pieces = manifest.resume_pieces(
+                completed, filename, interval, confighash, phot_out, min_rows,
+                others if variants else None
+            ) if resume else [(interval, phot_out, False)]
+
+            for number, (piece, output, complete) in enumerate(pieces):
+                partials.append(output)
+                # the first piece keeps the partition id, the others get one after the planning
+                key = counter if number == 0 else None
+
+                if complete:
+                    skipped_keys.append(partition_key(filename, piece))
+                    continue
+
+                task = {
+                    'key': key, 'file': filename, 'interval': piece, 'output': output,
+                    'record': manifest.partition_record(filename, piece, confighash, output)
+                }
+                tasks.append(task)
+                file_tasks.append(task)
+
+            counter += 1
+
+        entry = {
+            'record': compact_record, 'output': compact_out, 'partials': partials,
+            'remaining': len(file_tasks), 'failed': 0, 'variants': compact_variants,
+            'name': tile, 'computed': bool(file_tasks)
+        }
+        for task in file_tasks:
+            task['entry'] = entry
+        files.append(entry)
+
+    for task in tasks:
+        if task['key'] is None:
+            task['key'] = counter
+            counter += 1
+
+    # The largest tasks are submitted first, reducing the tail of the run
+    tasks.sort(key=lambda task: task['interval'][1] - task['interval'][0], reverse=True)
+
+    return tasks, files, finals, skipped_keys, counter
+
+
+def run(phz_config, parsl_config, resume=False):
     """ Run Photo-z Compute 
 
     Args:
         phz_config (dict): Photo-z pipeline configuration - available in the config.yml
         parsl_config (dict): Parsl config
+        resume (bool, optional): skips the partitions completed by a previous run. Defaults to False.
     """
     lephare_sandbox = os.getcwd()
 
@@ -43,6 +282,7 @@ def run(phz_config, parsl_config):
     # Settings Parsl configurations
     parsl.clear()
     parsl.load(parsl_config)
+    executors = [executor for label, executor in parsl.dfk().executors.items() if label != '_parsl_internal']
 
     inputs = phz_config.get('inputs', {})
     output_dir = phz_config.get('output_dir', {})
@@ -51,33 +291,64 @@ def run(phz_config, parsl_config):
     zphot_para = inputs.get('zphot')
 
     lephare_dir = settings.get("lephare_bin")
+    cache = phz_config.get('library_cache', {})
+    cache_dir = cache.get('path', None)
 
-    # Creating LePhare dirs
-    for x in ['filt', 'lib_bin', 'lib_mag']:
-        try:
-            os.mkdir(x)
-        except:
-            pass
+    # Reading zphot.para
+    dic = read_zphot_para(zphot_para)
+
+    # Variants fitting the same catalogs, written in <output_dir>/_sweep/<name> (optional)
+    sweep = phz_config.get('sweep', {})
+
+    try:
+        variants = load_variants(sweep, zphot_para, dic, settings) if sweep.get('turn_on', False) else list()
+    except ValueError as err:
+        logger.error(f'   {err}')
+        raise BaseException
+
+    if variants:
+        logger.info(f"   sweep: {[variant['name'] for variant in variants]}")
 
     start_time = time.time()
 
-    logger.info("-> Step 1: creating SED library")
-    gallib = create_galaxy_lib(
-        zphot_para, lephare_dir, lephare_sandbox, stdout='sedtolib.log'
-    )
-    gallib.result()
+    libraries = phz_config.get('libraries', {})
+    libkeys = [build_libraries(zphot_para, dic, lephare_dir, lephare_sandbox, cache_dir, logger, libraries)]
 
-    logger.info("-> Step 2: creating filter transmission files")
-    filterset = create_filter_set(
-        zphot_para, lephare_dir, lephare_sandbox, stdout='filter.log'
-    )
-    filterset.result()
+    # Variants with other libraries build them in their own directory, linked next to the run ones
+    built = {libcache.library_key(dic, lephare_dir)[0]} if any(
+        variant['zphot'] != zphot_para for variant in variants
+    ) else set()
 
-    logger.info("-> Step 3: theoretical magnitudes library")
-    galmag = compute_galaxy_mag(
-        zphot_para, lephare_dir, lephare_sandbox, stdout='mag_gal.log'
-    )
-    galmag.result()
+    for variant in variants:
+        if variant['zphot'] == zphot_para:
+            continue
+
+        key = libcache.library_key(variant['zphot_dict'], lephare_dir)[0]
+        if key in built:
+            logger.info(f"   sweep variant {variant['name']}: libraries shared")
+            continue
+        built.add(key)
+
+        logger.info(f"   sweep variant {variant['name']}: libraries of {variant['zphot']}")
+        library_dir = os.path.join(lephare_sandbox, 'libraries', variant['name'])
+        create_dir(library_dir)
+        libkeys.append(build_libraries(
+            variant['zphot'], variant['zphot_dict'], lephare_dir, library_dir, cache_dir, logger,
+            libraries
+        ))
+
+        try:
+            libcache.merge(library_dir, lephare_sandbox)
+        except FileExistsError as err:
+            logger.error(f"   sweep variant {variant['name']}: {err}, its libraries need other names")
+            raise BaseException
+
+    if cache_dir:
+        removed = libcache.evict(
+            cache_dir, cache.get('max_size', None), cache.get('max_age', None), keep=libkeys
+        )
+        if removed:
+            logger.info(f"   libraries evicted from cache: {removed}")
 
     logger.info("   steps 1,2 and 3 completed: %s seconds" % (int(time.time() - start_time)))
 
@@ -92,13 +363,6 @@ def run(phz_config, parsl_config):
     id_col = settings.get("index")
     shifts = settings.get("shifts", None)
     limit_sample = test_env.get("limit_sample", None) if test_env.get("turn_on", False) else None
-    npartition = int(settings.get("partitions", 50))
-
-    # Reading zphot.para
-    dic = dict()
-    with open(zphot_para, "r") as conffile:
-        for line in conffile.read().splitlines():
-            dic[line.split()[0]] = "".join(line.split()[1:])
 
     paraout = dic.get('PARA_OUT')
     cat_fmt = str(dic['CAT_FMT'])
@@ -107,7 +371,7 @@ def run(phz_config, parsl_config):
     idxs, namephotoz = prepare_format_output(bands_list, paraout)
 
     # Getting Input Catalog
-    photo_files = glob.glob(inputs.get("photometric_data"))
+    photo_files = sorted(glob.glob(inputs.get("photometric_data")))
 
     # Limits photometric data according to selected config. (for testing)
     ninterval = 0
@@ -117,35 +381,201 @@ def run(phz_config, parsl_config):
 
     # Creating outputs directory
     create_dir(output_dir)
+    output_root = os.path.join(lephare_sandbox, output_dir)
 
-    # Settings partitions in photometrics data
-    partitions_list = set_partitions(photo_files, npartition, id_col)
+    for variant in variants:
+        create_dir(variant_root(output_root, variant['name']))
 
-    # Creating Lephare's runs list
-    counter, procs = 1, list()
+    # Completed partitions are recorded in the manifest to resume interrupted runs
+    manifest_path = os.path.join(lephare_sandbox, output_dir, '_manifest.jsonl')
+    confighash = manifest.config_hash(settings, dic)
+    completed = manifest.load_manifest(manifest_path) if resume else dict()
 
-    for item in partitions_list:
-        filename = item.get("path")
-        ranges = item.get("ranges")[:ninterval] if ninterval else item.get("ranges")
-        for interval in ranges:
-            output_dir_file = os.path.join(
-                lephare_sandbox, output_dir, os.path.basename(filename).replace(".parquet", "")
-            )
-            create_dir(output_dir_file)
-            phot_out = os.path.join(
-                output_dir_file,
-                f'photz-{str(counter).zfill(5)}.parquet'
-            )
-            procs.append(run_zphot(counter, filename, interval, shifts, phot_out, photo_type,
-                err_type, apply_corr, bands_list, zphot_para, id_col, cat_fmt, idxs, namephotoz,
-                lephare_dir, lephare_sandbox, stdout=f'zphot-{counter}.log'
-            ))
-            counter += 1
+    if not resume and os.path.isfile(manifest_path):
+        os.remove(manifest_path)
+
+    # Settings partitions in photometrics data, with the same target size for all files
+    partitions_list = plan_partitions(photo_files, settings)
+
+    # Failed tasks are retried by Parsl (see condor.get_config), then split in halves down to min_rows
+    failures = phz_config.get('failures', {})
+    bisect = failures.get('bisect', True)
+    min_rows = int(failures.get('min_rows', 100))
+    timeout = failures.get('timeout', None)
+    failed_path = os.path.join(lephare_sandbox, output_dir, '_failed.jsonl')
+
+    if os.path.isfile(failed_path):
+        os.remove(failed_path)
+
+    # Merging the partial outputs of each input file (optional)
+    compaction = phz_config.get('compaction', {})
+
+    # Input coordinates copied to the outputs (optional), required by the HEALPix layout
+    coordinates = settings.get("coordinates", None)
+
+    # Outputs also written by HEALPix pixel, with an index of the pixels files (optional)
+    healpix = phz_config.get('healpix', {})
+    layout = healpix.get('turn_on', False)
+    healpix_dir = os.path.join(output_root, HEALPIX_DIR)
+
+    if layout:
+        nside = int(healpix.get('nside', 32))
+
+        try:
+            check_nside(nside)
+        except ValueError as err:
+            logger.error(f'   healpix: {err}')
+            raise BaseException
+
+        if not coordinates:
+            logger.error('   healpix: settings.coordinates (right ascension and declination columns) is required')
+            raise BaseException
+
+        ra, dec = [name.lower() for name in coordinates]
+        index = load_index(healpix_dir) if resume else dict()
+
+        # pixels of another resolution or configuration are written again
+        if (index.get('nside'), index.get('config')) != (nside, confighash):
+            shutil.rmtree(healpix_dir, ignore_errors=True)
+            index = new_index(nside, ra, dec, confighash)
+
+        create_dir(healpix_dir)
+        logger.info(f'   HEALPix layout: nside {nside} (NESTED), {healpix_dir}')
+
+    # Sorted object ids of the outputs with their file and row, read by idindex.lookup (optional)
+    id_index = phz_config.get('id_index', {}).get('turn_on', False)
+    ids_dir = os.path.join(output_root, idindex.IDS_DIR)
+
+    if id_index:
+        ids_index = idindex.load_index(ids_dir) if resume else dict()
+
+        if ids_index.get('config') != confighash:
+            shutil.rmtree(ids_dir, ignore_errors=True)
+            ids_index = idindex.new_index(id_col.lower(), confighash)
+
+        create_dir(ids_dir)
+        logger.info(f'   id index: {ids_dir}')
+
+    # Compaction, HEALPix layout and id index of each file, once its partitions are completed
+    outputs = FileOutputs(
+        variants, output_root, manifest_path, id_col.lower(), logger, compaction=compaction,
+        healpix={'dir': healpix_dir, 'nside': nside, 'ra': ra, 'dec': dec, 'index': index} if layout else None,
+        ids={'dir': ids_dir, 'index': ids_index} if id_index else None
+    )
+
+    # Creating Lephare's runs list, numbered in the files order
+    tasks, files, finals, skipped_keys, counter = plan_tasks(
+        partitions_list, output_root, confighash, variants, outputs, completed, resume=resume,
+        ninterval=ninterval, min_rows=min_rows if bisect else None
+    )
+
+    # Partitions processed by each Parsl task
+    batch_size = int(settings.get("batch_size", 1))
+
+    # Node-local run directories, only the outputs and the compressed logs are copied back (optional)
+    scratch = phz_config.get('scratch', {})
+    scratch_dir = scratch.get('path', '$TMPDIR') if scratch.get('turn_on', False) else None
+
+    if scratch_dir:
+        logger.info(f'   node-local run directories: {scratch_dir}')
+
+    # Objects with the photometry and configuration of a previous run keep its results (optional)
+    incremental = phz_config.get('incremental', {})
+    if incremental.get('turn_on', False):
+        if variants:
+            logger.error('   incremental runs can not be combined with a sweep')
+            raise BaseException
+
+        previous_dir = os.path.abspath(os.path.expandvars(incremental.get('previous')))
+
+        if previous_dir == os.path.abspath(os.path.join(lephare_sandbox, output_dir)):
+            logger.error('   incremental.previous must not be the output directory of this run')
+            raise BaseException
+
+        incremental = {'previous': previous_dir, 'config': confighash}
+        logger.info(f'   incremental run, previous outputs: {previous_dir}')
+    else:
+        incremental = None
+
+    # LePhare input and output exchanged through named pipes (optional), not with a sweep
+    stream = settings.get("stream", False) and not variants
+
+    # PDFs on the Z_STEP grid stored with the point estimates (optional)
+    pdz = settings.get("pdz", {})
+    if pdz.get("turn_on", False):
+        pdz = {
+            "type": pdz.get("type", PDZ_TYPE), "quantize": pdz.get("quantize", None),
+            "grid": redshift_grid(dic.get("Z_STEP")).tolist()
+        }
+        logger.info(f'   PDFs: {pdz.get("type")}, {str(len(pdz.get("grid")))} redshifts, quantize: {pdz.get("quantize")}')
+    else:
+        pdz = None
+
+    # Objects that can not be fitted skip zphota and get sentinel values (optional)
+    selection = settings.get("selection", {})
+    if selection.get("turn_on", False):
+        logger.info(f'   selection: {selection}')
+    else:
+        selection = None
+
+    # Parsl tasks, each one with batch_size partitions, submitted lazily
+    batches = [tasks[first:first + batch_size] for first in range(0, len(tasks), batch_size)]
+
+    if resume:
+        logger.info(f'   partitions already completed: {str(len(skipped_keys))}')
+
+    logger.info(f'   number of partitions: {str(len(tasks))}')
+    logger.info(
+        f'   number of parallel jobs: {str(len(batches))} (at most {str(int(settings.get("max_in_flight", 1000)))} in flight)'
+    )
+
+    # Stage timings of each partition (see pz-report.py)
+    timings_path = os.path.join(lephare_sandbox, TIMINGS_FILE)
+
+    # QA statistics merged as partitions complete, resumed runs start from the previous summary
+    qa_path = os.path.join(lephare_sandbox, output_dir, QA_FILE)
+    qa = dict()
+
+    for name, config, path in [(None, confighash, qa_path)] + [(
+        variant['name'], variant['config'], os.path.join(variant_root(output_root, variant['name']), QA_FILE)
+    ) for variant in variants]:
+        previous_qa = load_qa(path) if resume else dict()
+
+        if previous_qa.get('config') == config:
+            qa[name] = {'path': path, 'config': config, 'summary': previous_qa.get('summary'), 'keys': set(previous_qa.get('keys'))}
+        else:
+            qa[name] = {'path': path, 'config': config, 'summary': None, 'keys': set()}
+
+    missing_qa = missing_partitions(qa[None]['keys'], skipped_keys)
+    if missing_qa:
+        logger.warning(f'   QA statistics missing for {str(missing_qa)} completed partitions')
+
+    # run_zphot arguments shared by all the partitions
+    zphot_args = {
+        'shifts': shifts, 'photo_type': photo_type, 'err_type': err_type, 'apply_corr': apply_corr,
+        'bands': bands_list, 'zphot': zphot_para, 'col_index': id_col, 'cat_fmt': cat_fmt,
+        'idxs': idxs, 'namephotoz': namephotoz, 'lephare_dir': lephare_dir,
+        'lephare_sandbox': lephare_sandbox, 'scratch_dir': scratch_dir, 'stream': stream, 'pdz': pdz,
+        'selection': selection, 'incremental': incremental, 'timeout': timeout, 'coordinates': coordinates
+    }
+
+    scheduler = Scheduler(
+        zphot_args, variants, output_root, outputs, qa,
+        {'manifest': manifest_path, 'failed': failed_path, 'timings': timings_path},
+        confighash, counter, logger, settings=settings, failures=failures, executors=executors
+    )
+    scheduler.run(tasks, batches, files, finals)
+    scheduler.close()
+    outputs.close()
+
+    scheduler.write_summaries()
+    if qa[None]['summary']:
+        logger.info(f'   QA statistics: {qa_path}')
 
-    logger.info(f'   number of parallel jobs: {str(len(procs))}')
+    if variants:
+        logger.info(f"   sweep outputs: {variant_root(output_root, '<name>')}")
 
-    for proc in procs:
-        proc.result()
+    logger.info(f'   stage timings: {timings_path}')
 
     logger.info("   step 4 completed: %s seconds" % (int(time.time() - start_time)))
     logger.info("Full runtime: %s seconds" % (int(time.time() - start_time_full)))
@@ -158,6 +588,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(dest='config_path', help="yaml config path")
     parser.add_argument("-w", "--working_dir", dest="working_dir", default=working_dir, help="run directory")
+    parser.add_argument("-r", "--resume", dest="resume", action="store_true", help="resume a previous run, computing only the missing or invalid partitions")
 
     args = parser.parse_args()
     working_dir = args.working_dir
@@ -167,11 +598,11 @@ if __name__ == '__main__':
     with open(config_path) as _file:
         phz_config = yaml.load(_file, Loader=yaml.FullLoader)
 
-    # Create sandbox dir
+    # Create sandbox dir (kept when resuming a previous run)
     lephare_sandbox = f'{working_dir}/sandbox/'
-    create_dir(lephare_sandbox, chdir=True, rmtree=True)
+    create_dir(lephare_sandbox, chdir=True, rmtree=not args.resume)
 
     parsl_config = get_config(phz_config)
 
     # Run Photo-z
-    run(phz_config, parsl_config)
\ No newline at end of file
+    run(phz_config, parsl_config, resume=args.resume)
\ No newline at end of file
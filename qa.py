@@ -0,0 +1,267 @@
+import os
+import json
+import numpy as np
+
+
+# fixed bins (first edge, last edge, number of bins) of the QA histograms
+PHOTOZ_BINS = {
+    'z_best': (0., 4., 400), 'z_ml': (0., 4., 400),
+    'err_z': (0., 2., 200), 'pdz_best': (0., 100., 100)
+}
+MAG_BINS = (10., 35., 250)
+ZZ_BINS = (0., 4., 200)
+
+# invalid value written by LePhare and by the input writer
+INVALID = -99.
+
+# merged QA summary written in the output directory
+QA_FILE = '_qa.json'
+
+
+def column_summary(values, bins, invalid=None):
+    """ Computes the mergeable statistics of a column
+
+    Args:
+        values (array): column values
+        bins (tuple): first edge, last edge and number of bins
+        invalid (ndarray, optional): mask of the invalid values. Defaults to
+            None (values equal to -99 or not finite).
+
+    Returns:
+        dict: counts, min, max, sums and histogram (with under and overflows)
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+
+    if invalid is None:
+        invalid = (values == INVALID) | ~np.isfinite(values)
+
+    valid = values[~invalid]
+    low, high, nbins = bins
+    hist, _ = np.histogram(valid, bins=nbins, range=(low, high))
+
+    return {
+        'count': int(len(values)), 'invalid': int(invalid.sum()),
+        'min': float(valid.min()) if len(valid) else None,
+        'max': float(valid.max()) if len(valid) else None,
+        'sum': float(valid.sum()), 'sum2': float(np.square(valid).sum()),
+        'under': int((valid < low).sum()), 'over': int((valid > high).sum()),
+        'bins': list(bins), 'hist': hist.tolist()
+    }
+
+
+def partition_summary(photoz, photometry, bands, photo_type, pushed=None):
+    """ Computes the QA summary of a partition
+
+    The magnitudes and context 0 are computed over the rows whose photometry
+    was read: the rows of the row groups skipped by the selection (pushed)
+    are only counted (pushed_down).
+
+    Args:
+        photoz (pyarrow.Table): photo-z table (see build_photoz_table)
+        photometry (pyarrow.Table): input columns of the partition
+        bands (list): bands list
+        photo_type (str): string containing magnitude with {} to concatenate the band.
+        pushed (ndarray, optional): rows whose photometry was not read (see
+            utils.pushed_down_rows). Defaults to None (all read).
+
+    Returns:
+        dict: QA summary
+    """
+
+    summary = {'partitions': 1, 'rows': photoz.num_rows, 'columns': dict()}
+
+    read = ~pushed if pushed is not None else np.ones(photometry.num_rows, dtype=bool)
+    summary['pushed_down'] = int((~read).sum())
+
+    for name, bins in PHOTOZ_BINS.items():
+        if name in photoz.column_names:
+            summary['columns'][name] = column_summary(
+                photoz.column(name).to_numpy(), bins
+            )
+
+    # bands rejected by the input writer (outside [0, 30] or NaN) and objects without valid bands
+    valid_bands = np.zeros(int(read.sum()), dtype=np.int64)
+
+    for band in bands:
+        name = photo_type.format(band)
+        mags = np.asarray(photometry.column(name).to_numpy(), dtype=np.float64)[read]
+        invalid = ~((mags >= 0.) & (mags <= 30.))
+        valid_bands += ~invalid
+        summary['columns'][name] = column_summary(mags, MAG_BINS, invalid)
+
+    summary['context_0'] = int((valid_bands == 0).sum())
+
+    z_best = photoz.column('z_best').to_numpy()
+    z_ml = photoz.column('z_ml').to_numpy()
+    valid = (z_best != INVALID) & (z_ml != INVALID)
+    low, high, nbins = ZZ_BINS
+    hist, _, _ = np.histogram2d(
+        z_best[valid], z_ml[valid], bins=nbins, range=((low, high), (low, high))
+    )
+    summary['z_best_vs_z_ml'] = {'bins': list(ZZ_BINS), 'hist': hist.astype(np.int64).tolist()}
+
+    return summary
+
+
+def _merge_column(first, second):
+    def extreme(func, a, b):
+        values = [value for value in (a, b) if value is not None]
+        return func(values) if values else None
+
+    return {
+        'count': first['count'] + second['count'],
+        'invalid': first['invalid'] + second['invalid'],
+        'min': extreme(min, first['min'], second['min']),
+        'max': extreme(max, first['max'], second['max']),
+        'sum': first['sum'] + second['sum'], 'sum2': first['sum2'] + second['sum2'],
+        'under': first['under'] + second['under'], 'over': first['over'] + second['over'],
+        'bins': first['bins'],
+        'hist': (np.array(first['hist']) + np.array(second['hist'])).tolist()
+    }
+
+
+def merge_summaries(first, second):
+    """ Merges two QA summaries (of partitions or of already merged ones)
+
+    Args:
+        first (dict): QA summary, may be None
+        second (dict): QA summary
+
+    Returns:
+        dict: QA summary of both
+    """
+
+    if not first:
+        return second
+
+    columns = dict(first['columns'])
+    for name, column in second['columns'].items():
+        columns[name] = _merge_column(columns[name], column) if name in columns else column
+
+    return {
+        'partitions': first['partitions'] + second['partitions'],
+        'rows': first['rows'] + second['rows'],
+        'columns': columns,
+        'context_0': first['context_0'] + second['context_0'],
+        'pushed_down': first.get('pushed_down', 0) + second.get('pushed_down', 0),
+        'z_best_vs_z_ml': {
+            'bins': first['z_best_vs_z_ml']['bins'],
+            'hist': (
+                np.array(first['z_best_vs_z_ml']['hist']) + np.array(second['z_best_vs_z_ml']['hist'])
+            ).tolist()
+        }
+    }
+
+
+def describe(summary):
+    """ Derives mean and standard deviation of each column of a QA summary
+
+    Args:
+        summary (dict): QA summary
+
+    Returns:
+        dict: count, invalid, min, max, mean and std by column
+    """
+
+    description = dict()
+
+    for name, column in summary.get('columns', {}).items():
+        nvalid = column['count'] - column['invalid']
+        mean = column['sum'] / nvalid if nvalid else None
+        std = np.sqrt(max(column['sum2'] / nvalid - mean ** 2, 0.)) if nvalid else None
+
+        description[name] = {
+            'count': column['count'], 'invalid': column['invalid'],
+            'min': column['min'], 'max': column['max'], 'mean': mean,
+            'std': float(std) if std is not None else None
+        }
+
+    return description
+
+
+def partition_key(filename, interval):
+    """ Identifies a partition in the QA file by its input file and interval,
+    which do not change when a resumed run numbers the partitions again
+
+    Args:
+        filename (str): input file path
+        interval (tuple): first and last (exclusive) rows
+
+    Returns:
+        tuple: input file absolute path, first and last rows
+    """
+
+    return (os.path.abspath(filename), int(interval[0]), int(interval[1]))
+
+
+def missing_partitions(keys, partitions):
+    """ Counts the partitions whose rows are not all in the QA summary (a
+    partition split after failures is covered by its pieces)
+
+    Args:
+        keys (set): partitions included in the summary (see partition_key)
+        partitions (list): partitions to check (see partition_key)
+
+    Returns:
+        int: partitions not covered
+    """
+
+    intervals = dict()
+    for filename, first, last in keys:
+        intervals.setdefault(filename, list()).append((first, last))
+
+    missing = 0
+    for filename, first, last in partitions:
+        rows = sum(
+            min(last, piece_last) - max(first, piece_first)
+            for piece_first, piece_last in intervals.get(filename, [])
+            if piece_first < last and piece_last > first
+        )
+        missing += rows < last - first
+
+    return missing
+
+
+def load_qa(qa_path):
+    """ Loads a QA file
+
+    Args:
+        qa_path (str): QA file path
+
+    Returns:
+        dict: QA file content (keys as tuples, see partition_key), empty when
+        the file does not exist or has keys of another format
+    """
+
+    if not os.path.isfile(qa_path):
+        return dict()
+
+    with open(qa_path) as _file:
+        content = json.load(_file)
+
+    # summaries keyed by partition number, renumbered by a resumed run, are not reused
+    if not all(isinstance(key, list) and len(key) == 3 for key in content.get('keys', [])):
+        return dict()
+
+    content['keys'] = [tuple(key) for key in content.get('keys', [])]
+
+    return content
+
+
+def write_qa(qa_path, summary, config, keys):
+    """ Writes the merged QA summary (with a temporary name while incomplete)
+
+    Args:
+        qa_path (str): QA file path
+        summary (dict): merged QA summary
+        config (str): configuration hash
+        keys (list): partitions included in the summary (see partition_key)
+    """
+
+    tmp_path = f'{qa_path}.tmp'
+
+    with open(tmp_path, 'w') as _file:
+        json.dump({'config': config, 'keys': sorted(keys), 'summary': summary}, _file)
+
+    os.replace(tmp_path, qa_path)
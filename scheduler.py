@@ -0,0 +1,631 @@
+import os
+import time
+import queue
+from apps import run_zphot, run_zphot_batch, compact_outputs, write_healpix, write_id_index
+from compaction import write_dataset_metadata
+from timing import append_timings
+from qa import write_qa, merge_summaries, partition_key
+from speculation import (
+    FACTOR, MIN_COMPLETED, MAX_COPIES, CHECK_SECONDS, attempt_output, promote, discard,
+    concurrency, worker_capacity, seconds_per_row, is_straggler
+)
+from sweep import variant_root, variant_output, partition_variants, variant_records
+from healpix import INDEX_FILE, add_to_index, write_index
+import manifest
+import idindex
+
+
+def split_task(task, key, confighash):
+    """ Splits a failed partition in halves, computed as new partitions
+
+    Args:
+        task (dict): partition (key, file, interval, output, record and entry)
+        key (int): id of the first half
+        confighash (str): configuration hash
+
+    Returns:
+        list: partitions of the halves
+    """
+
+    children = list()
+
+    for interval, output in manifest.split_interval(task['interval'], task['output']):
+        children.append({
+            'key': key + len(children), 'file': task['file'], 'interval': interval,
+            'output': output, 'entry': task['entry'],
+            'record': manifest.partition_record(task['file'], interval, confighash, output)
+        })
+
+    return children
+
+
+def submit_batch(batch, zphot_args, variants, output_root, retries=0):
+    """ Submits the attempts of a batch of partitions as one Parsl task
+
+    Args:
+        batch (list): attempts (task, key and output)
+        zphot_args (dict): run_zphot arguments shared by all the partitions
+            (shifts, photo_type, ..., coordinates)
+        variants (list): sweep variants
+        output_root (str): output directory of the run
+        retries (int, optional): retries of a batch. Defaults to 0.
+
+    Returns:
+        AppFuture: result of run_zphot (one partition) or run_zphot_batch
+    """
+
+    if len(batch) > 1:
+        return run_zphot_batch(
+            [{
+                'key': attempt['key'], 'file': attempt['task']['file'],
+                'interval': attempt['task']['interval'], 'output': attempt['output'],
+                'variants': partition_variants(variants, attempt['output'], output_root)
+            } for attempt in batch],
+            stdout=f"zphot-batch-{batch[0]['key']}.log", retries=retries, **zphot_args
+        )
+
+    attempt, task = batch[0], batch[0]['task']
+    return run_zphot(
+        attempt['key'], task['file'], task['interval'], zphot_output=attempt['output'],
+        stdout=f"zphot-{attempt['key']}.log",
+        variants=partition_variants(variants, attempt['output'], output_root) or None, **zphot_args
+    )
+
+
+class FileOutputs:
+    """ Final outputs of each input file, made once its last partition is
+    completed: compaction of the partial outputs, HEALPix layout and id index
+    """
+
+    def __init__(self, variants, output_root, manifest_path, index_column, logger,
+            compaction=None, healpix=None, ids=None):
+        """
+        Args:
+            variants (list): sweep variants
+            output_root (str): output directory of the run
+            manifest_path (str): manifest path
+            index_column (str): index column name (as in the outputs)
+            logger (logger): logger object
+            compaction (dict, optional): compaction section of config.yml. Defaults to None.
+            healpix (dict, optional): HEALPix layout (dir, nside, ra, dec and
+                index), None without layout. Defaults to None.
+            ids (dict, optional): id index (dir and index), None without index.
+                Defaults to None.
+        """
+
+        compaction = compaction or {}
+        self.variants, self.output_root, self.logger = variants, output_root, logger
+        self.manifest_path, self.index_column = manifest_path, index_column
+        self.compact = compaction.get('turn_on', False)
+        self.row_group_size = int(compaction.get('row_group_size', 1000000))
+        self.remove_partials = compaction.get('remove_partials', True)
+        # compacted files of the run (None) and of each variant
+        self.compacted = {name: list() for name in [None] + [variant['name'] for variant in variants]}
+        self.healpix, self.ids = healpix, ids
+
+    @property
+    def enabled(self):
+        """ bool: a final output is made when the partitions of a file are completed """
+
+        return bool(self.compact or self.healpix or self.ids)
+
+    def submit_compaction(self, entry):
+        """ Compacts the partial outputs of a file, and those of each variant
+
+        Args:
+            entry (dict): file (record, partials, variants...)
+
+        Returns:
+            list: (future, kind, item) to track
+        """
+
+        targets = [(None, entry['record'], entry['partials'])] + [(
+            name, record, [variant_output(partial, self.output_root, name) for partial in entry['partials']]
+        ) for name, record in entry['variants'].items()]
+
+        submitted = list()
+        for name, record, partials in targets:
+            future = compact_outputs(
+                partials, record['output'], self.index_column, self.row_group_size,
+                remove=self.remove_partials
+            )
+            submitted.append((future, 'compaction', {'name': name, 'record': record, 'entry': entry}))
+
+        return submitted
+
+    def submit_outputs(self, entry, paths):
+        """ Lays out by pixel and indexes by id the final outputs of a file,
+        unless a resumed run did it and no partition was computed again
+
+        Args:
+            entry (dict): file (name, record and computed)
+            paths (list): final outputs (compacted file or partial outputs)
+
+        Returns:
+            list: (future, kind, item) to track
+        """
+
+        name, computed = entry['name'], entry.get('computed', False)
+        submitted = list()
+
+        if self.healpix and (computed or name not in self.healpix['index']['inputs']):
+            future = write_healpix(
+                paths, self.healpix['dir'], name, self.healpix['nside'], self.healpix['ra'], self.healpix['dec']
+            )
+            submitted.append((future, 'healpix', entry))
+
+        if self.ids and (computed or name not in self.ids['index']['inputs']):
+            future = write_id_index(paths, self.ids['dir'], name, self.index_column, self.output_root)
+            submitted.append((future, 'ids', entry))
+
+        return submitted
+
+    def submit(self, entry):
+        """ Compacts, or lays out and indexes, a file with all its partitions completed
+
+        Args:
+            entry (dict): file
+
+        Returns:
+            list: (future, kind, item) to track
+        """
+
+        if self.compact:
+            return self.submit_compaction(entry)
+
+        return self.submit_outputs(entry, entry['partials'])
+
+    def completed(self, kind, item, future):
+        """ Handles a completed compaction, layout or index task
+
+        Args:
+            kind (str): compaction, healpix or ids
+            item (dict): compaction target or file
+            future (AppFuture): completed task
+
+        Returns:
+            list: (future, kind, item) to track, the layout and index of a compacted file
+        """
+
+        labels = {'compaction': 'compaction', 'healpix': 'HEALPix layout', 'ids': 'id index'}
+
+        try:
+            result = future.result()
+        except Exception as err:
+            self.logger.error(f"   {labels[kind]} of {item['record'].get('input')} failed: {err}")
+            return list()
+
+        if kind == 'healpix':
+            add_to_index(self.healpix['index'], result.get("name"), result.get("pixels"))
+            return list()
+
+        if kind == 'ids':
+            self.ids['index']['inputs'][result.pop("name")] = result
+            return list()
+
+        item['record'].update(rows=result.get("rows"), checksum=result.get("checksum"))
+        manifest.append_record(self.manifest_path, item['record'])
+        self.compacted[item['name']].append(result.get("file"))
+
+        # the partial outputs may be removed, the compacted file is laid out and indexed
+        if item['name'] is None:
+            return self.submit_outputs(item['entry'], [result.get("file")])
+
+        return list()
+
+    def write_indexes(self):
+        """ Writes the HEALPix and id indexes """
+
+        if self.healpix:
+            write_index(self.healpix['dir'], self.healpix['index'])
+        if self.ids:
+            idindex.write_index(self.ids['dir'], self.ids['index'])
+
+    def close(self):
+        """ Writes the dataset summaries of the compacted files and the indexes """
+
+        if self.compact:
+            summary = write_dataset_metadata(self.output_root, self.compacted[None])
+            self.logger.info(f'   compacted files: {str(len(self.compacted[None]))}, summary: {summary}')
+
+            for variant in self.variants:
+                write_dataset_metadata(variant_root(self.output_root, variant['name']), self.compacted[variant['name']])
+
+        if self.healpix:
+            index = self.healpix['index']
+            write_index(self.healpix['dir'], index)
+            self.logger.info(
+                f"   HEALPix pixels: {str(len(index['pixels']))}, index: {os.path.join(self.healpix['dir'], INDEX_FILE)}"
+            )
+
+        if self.ids:
+            index = self.ids['index']
+            idindex.write_index(self.ids['dir'], index)
+            self.logger.info(
+                f"   id index: {str(len(index['inputs']))} files, {os.path.join(self.ids['dir'], idindex.INDEX_FILE)}"
+            )
+
+
+class Scheduler:
+    """ Submits the partitions of a run and handles the results as they complete
+
+    The Parsl tasks (batches of partitions) are submitted lazily, at most
+    max_in_flight futures at a time, and handled in completion order through
+    the queue filled by their callbacks: manifest records, QA statistics and
+    timings of the completed partitions, halves of the failed ones, copies of
+    the stragglers at the end of the run and final outputs of the files.
+    """
+
+    def __init__(self, zphot_args, variants, output_root, outputs, qa, paths, confighash, counter,
+            logger, settings=None, failures=None, executors=None):
+        """
+        Args:
+            zphot_args (dict): run_zphot arguments shared by all the partitions
+            variants (list): sweep variants
+            output_root (str): output directory of the run
+            outputs (FileOutputs): final outputs of the files
+            qa (dict): QA state (path, config, summary and keys) of the run
+                (None) and of each variant
+            paths (dict): manifest, failed and timings paths
+            confighash (str): configuration hash
+            counter (int): id of the next partition
+            logger (logger): logger object
+            settings (dict, optional): settings section of config.yml
+                (max_in_flight, progress_interval and speculation). Defaults to None.
+            failures (dict, optional): failures section of config.yml. Defaults to None.
+            executors (list, optional): Parsl executors, to count the workers. Defaults to None.
+        """
+
+        settings, failures = settings or {}, failures or {}
+        self.zphot_args, self.variants, self.output_root = zphot_args, variants, output_root
+        self.outputs, self.qa, self.paths = outputs, qa, paths
+        self.confighash, self.counter, self.logger = confighash, counter, logger
+        self.executors = executors or list()
+
+        self.max_in_flight = int(settings.get("max_in_flight", 1000))
+        self.progress_interval = float(settings.get("progress_interval", 60))
+
+        # Failed tasks are retried by Parsl (see condor.get_config), then split in halves down to min_rows
+        self.bisect = failures.get('bisect', True)
+        self.min_rows = int(failures.get('min_rows', 100))
+        self.retries = int(failures.get('retries', 0))
+
+        # Copies of the slowest partitions are launched at the end of the run (optional)
+        speculation = settings.get("speculation", {})
+        self.speculate = speculation.get("turn_on", False)
+        self.factor = float(speculation.get("factor", FACTOR))
+        self.min_completed = int(speculation.get("min_completed", MIN_COMPLETED))
+        self.max_copies = int(speculation.get("max_copies", MAX_COPIES))
+        self.check_seconds = float(speculation.get("check_seconds", CHECK_SECONDS))
+
+        # Futures are handled in completion order, through the queue filled by their callbacks
+        self.completions, self.pending, self.submitted = queue.Queue(), dict(), dict()
+        self.completed_timings, self.tail_start, self.speculated = list(), None, set()
+        self.done, self.done_rows, self.failed, self.failed_rows, self.copies = 0, 0, 0, 0, 0
+        self.ntasks, self.total_rows = 0, 0
+
+    def track(self, future, kind, item):
+        """ Handles the future when it completes
+
+        Args:
+            future (AppFuture): Parsl future
+            kind (str): zphot, compaction, healpix or ids
+            item: attempts of a zphot task, compaction target or file
+        """
+
+        self.pending[future] = (kind, item)
+        self.submitted[future] = time.time()
+        future.add_done_callback(self.completions.put)
+
+    def track_all(self, submitted):
+        """ Tracks the (future, kind, item) of FileOutputs """
+
+        for future, kind, item in submitted:
+            self.track(future, kind, item)
+
+    def needed(self):
+        """ bool: futures of partitions not completed yet are pending (the other
+        ones are slower copies) """
+
+        return any(
+            kind != 'zphot' or any(not attempt['task']['settled'] for attempt in item)
+            for kind, item in self.pending.values()
+        )
+
+    def new_attempt(self, task, key):
+        """ Creates an attempt of a partition: with speculation, each attempt
+        writes its own file, the first one completed is promoted
+
+        Args:
+            task (dict): partition
+            key (int): id of the attempt
+
+        Returns:
+            dict: attempt (task, key and output)
+        """
+
+        attempt = task['attempts'] = task.get('attempts', -1) + 1
+        task['in_flight'] = task.get('in_flight', 0) + 1
+        task.setdefault('settled', False)
+        output = attempt_output(task['output'], attempt) if self.speculate else task['output']
+        return {'task': task, 'key': key, 'output': output}
+
+    def attempt_outputs(self, attempt):
+        """ Lists the (attempt path, partition output) of the run and of each variant """
+
+        outputs = [(attempt['output'], attempt['task']['output'])]
+        for variant in self.variants:
+            outputs.append((
+                variant_output(attempt['output'], self.output_root, variant['name']),
+                variant_output(attempt['task']['output'], self.output_root, variant['name'])
+            ))
+        return outputs
+
+    def submit(self, attempts):
+        """ Submits the attempts as one Parsl task """
+
+        future = submit_batch(attempts, self.zphot_args, self.variants, self.output_root, self.retries)
+        self.track(future, 'zphot', attempts)
+
+    def speculate_stragglers(self):
+        """ At the end of the run, when every remaining task is running and
+        workers are idle, submits a copy of the stragglers (the workers are
+        counted from the executors, since a straggler started first never
+        shows in the concurrency of the completed tasks) """
+
+        running = [future for future, (kind, _) in self.pending.items() if kind == 'zphot']
+
+        if len(self.completed_timings) < self.min_completed or \
+                len(running) >= max(concurrency(self.completed_timings), worker_capacity(self.executors)):
+            return
+
+        now = time.time()
+        self.tail_start = self.tail_start or now
+        rate = seconds_per_row(self.completed_timings)
+
+        for straggler in running:
+            item = self.pending[straggler][1]
+            tasks_left = [
+                attempt['task'] for attempt in item
+                if not attempt['task']['settled'] and attempt['task']['attempts'] < self.max_copies
+            ]
+            rows = sum(task['interval'][1] - task['interval'][0] for task in tasks_left)
+            elapsed = now - max(self.submitted[straggler], self.tail_start)
+
+            if straggler in self.speculated or not tasks_left or not is_straggler(rows, elapsed, rate, self.factor):
+                continue
+
+            self.speculated.add(straggler)
+            attempts = list()
+            for task in tasks_left:
+                attempts.append(self.new_attempt(task, self.counter))
+                self.counter += 1
+
+            self.logger.warning(
+                f"   zphot IDs {[task['key'] for task in tasks_left]} running for {elapsed:.0f} s "
+                f"({rows} rows) - speculative copy"
+            )
+            self.submit(attempts)
+            self.copies += 1
+
+    def partition_failed(self, task, error):
+        """ Splits a failed partition in halves, isolating the objects that
+        make zphota fail, or records it in the failed partitions
+
+        Args:
+            task (dict): partition
+            error (Exception): error of the task
+
+        Returns:
+            bool: the partition was split
+        """
+
+        entry = task['entry']
+        rows = task['interval'][1] - task['interval'][0]
+
+        if self.bisect and rows >= 2 * self.min_rows:
+            self.logger.warning(f"   zphot ID {task['key']} failed: {error} - split in halves")
+            children = split_task(task, self.counter, self.confighash)
+            self.counter += len(children)
+            self.ntasks += len(children) - 1
+            entry['remaining'] += len(children)
+            position = entry['partials'].index(task['output'])
+            entry['partials'][position:position + 1] = [child['output'] for child in children]
+            for child in children:
+                self.submit([self.new_attempt(child, child['key'])])
+            return True
+
+        self.logger.error(f"   zphot ID {task['key']} failed: {error}")
+        manifest.append_record(self.paths['failed'], {
+            'input': os.path.abspath(task['file']), 'interval': list(task['interval']),
+            'key': task['key'], 'error': str(error)
+        })
+        entry['failed'] += 1
+        self.failed += 1
+        self.failed_rows += rows
+        return False
+
+    def partition_completed(self, task, result):
+        """ Promotes the outputs of a completed partition and records them in
+        the manifest, with its timing and QA statistics
+
+        Args:
+            task (dict): partition
+            result (dict): run_zphot result
+        """
+
+        promote(result.get("file"), task['output'])
+
+        # the variant outputs are recorded before the partition, which completes them
+        records = variant_records(self.variants, task['file'], task['interval'], task['output'], self.output_root)
+        for name, variant in result.get("variants", {}).items():
+            promote(variant.get("file"), records[name]['output'])
+            records[name].update(rows=variant.get("rows"), checksum=variant.get("checksum"))
+            manifest.append_record(self.paths['manifest'], records[name])
+
+        record = task['record']
+        record.update(rows=result.get("rows"), checksum=result.get("checksum"))
+        manifest.append_record(self.paths['manifest'], record)
+
+        if result.get("timing"):
+            append_timings(self.paths['timings'], [result.get("timing")])
+            self.completed_timings.append(result.get("timing"))
+
+        # partitions recomputed by a resumed run are already in the summary
+        qa_key = partition_key(task['file'], task['interval'])
+        for name, values in [(None, result)] + list(result.get("variants", {}).items()):
+            state = self.qa[name]
+            if values.get("qa") and qa_key not in state['keys']:
+                state['summary'] = merge_summaries(state['summary'], values.get("qa"))
+                state['keys'].add(qa_key)
+
+    def zphot_completed(self, future, item):
+        """ Handles the partitions of a completed zphot task
+
+        Args:
+            future (AppFuture): completed task
+            item (list): attempts of the task
+        """
+
+        for attempt in item:
+            task = attempt['task']
+            task['in_flight'] -= 1
+            entry = task['entry']
+            rows = task['interval'][1] - task['interval'][0]
+
+            try:
+                result = future.result()
+                if len(item) > 1:
+                    result = result.get(attempt['key'])
+                if result.get("error"):
+                    raise RuntimeError(result.get("error"))
+                error = None
+            except Exception as err:
+                error = err
+
+            # another copy completed the partition, or may still complete it
+            if task['settled'] or (error and task['in_flight']):
+                for path, output in self.attempt_outputs(attempt):
+                    discard(path, output)
+                continue
+
+            task['settled'] = True
+            entry['remaining'] -= 1
+
+            if error and self.partition_failed(task, error):
+                continue
+
+            if not error:
+                self.partition_completed(task, result)
+                self.done_rows += rows
+
+            self.done += 1
+
+            # the file is compacted (or laid out and indexed) as soon as its last partition is completed
+            if self.outputs.enabled and not entry['remaining']:
+                if entry['failed']:
+                    self.logger.warning(
+                        f"   compaction, HEALPix layout and id index of {entry['record'].get('input')} skipped: "
+                        f"{str(entry['failed'])} failed partitions"
+                    )
+                else:
+                    self.track_all(self.outputs.submit(entry))
+
+    def write_summaries(self):
+        """ Writes the QA statistics of the run and of each variant """
+
+        for state in self.qa.values():
+            if state['summary']:
+                write_qa(state['path'], state['summary'], state['config'], state['keys'])
+
+    def progress(self, now, start):
+        """ Writes the summaries and indexes and logs the progress of the run
+
+        Args:
+            now (float): current time
+            start (float): time of the first submission
+        """
+
+        self.write_summaries()
+        self.outputs.write_indexes()
+
+        rate = self.done_rows / max(now - start, 1e-6)
+        eta = (self.total_rows - self.done_rows - self.failed_rows) / rate if rate else 0.
+        self.logger.info(
+            f'   progress: {str(self.done)}/{str(self.ntasks)} partitions, {str(self.done_rows)} rows, '
+            f'{rate:.1f} rows/s, failed: {str(self.failed)}, ETA: {time.strftime("%H:%M:%S", time.gmtime(eta))}'
+        )
+
+    def run(self, tasks, batches, files, finals):
+        """ Submits the batches and handles the results until all the
+        partitions and final outputs are completed
+
+        Args:
+            tasks (list): partitions to compute
+            batches (list): partitions of each Parsl task
+            files (list): input files (entries of the partitions)
+            finals (list): (file, paths) of the compacted files of a resumed run
+        """
+
+        # files without partitions to compute (resumed runs) are compacted (or laid out and indexed) right away
+        for entry in files:
+            if not entry['remaining']:
+                self.track_all(self.outputs.submit(entry))
+
+        for entry, paths in finals:
+            self.track_all(self.outputs.submit_outputs(entry, paths))
+
+        self.total_rows = sum(task['interval'][1] - task['interval'][0] for task in tasks)
+        self.ntasks, next_batch = len(tasks), 0
+        start = last_progress = time.time()
+
+        while next_batch < len(batches) or self.needed():
+            while next_batch < len(batches) and len(self.pending) < self.max_in_flight:
+                self.submit([self.new_attempt(task, task['key']) for task in batches[next_batch]])
+                next_batch += 1
+
+            try:
+                future = self.completions.get(timeout=self.check_seconds if self.speculate else None)
+            except queue.Empty:
+                future = None
+
+            if self.speculate and next_batch == len(batches):
+                self.speculate_stragglers()
+
+            if future is None:
+                continue
+
+            kind, item = self.pending.pop(future)
+            self.submitted.pop(future)
+
+            if kind != 'zphot':
+                self.track_all(self.outputs.completed(kind, item, future))
+                continue
+
+            self.zphot_completed(future, item)
+
+            now = time.time()
+            if now - last_progress >= self.progress_interval or self.done == self.ntasks:
+                last_progress = now
+                self.progress(now, start)
+
+    def close(self):
+        """ Removes the outputs of the copies still running when they complete
+        (they can not be cancelled) and logs the copies and failures """
+
+        for future, (kind, item) in self.pending.items():
+            for attempt in item:
+                for path, output in self.attempt_outputs(attempt):
+                    future.add_done_callback(lambda _, path=path, output=output: discard(path, output))
+
+        if self.speculate:
+            self.logger.info(
+                f'   speculative copies: {str(self.copies)}, still running: {str(len(self.pending))}, '
+                f'workers: {str(worker_capacity(self.executors))}'
+            )
+
+        if self.failed:
+            self.logger.error(
+                f"   failed partitions: {str(self.failed)}, listed in {self.paths['failed']} "
+                f"(use --resume to compute them again)"
+            )
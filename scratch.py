@@ -0,0 +1,181 @@
+import os
+import gzip
+import fcntl
+import shutil
+import tempfile
+import hashlib
+from libcache import LIBRARY_DIRS
+from utils import create_dir, create_inputs_symbolic_link
+
+
+# written in the staged libraries directory with the fingerprint of the sandbox libraries
+STAGED_MARKER = '.staged'
+
+# compressed task logs copied back to the sandbox
+LOGS_DIR = 'logs'
+
+
+def node_dir(scratch_dir, lephare_sandbox):
+    """ Returns the node-local directory of a run
+
+    Environment variables are expanded on the worker, so $TMPDIR points to
+    the directory of the node running the task (the system temporary
+    directory is used when a variable is not set).
+
+    Args:
+        scratch_dir (str): node-local directory (e.g. $TMPDIR or /dev/shm)
+        lephare_sandbox (str): sandbox path
+
+    Returns:
+        str: <scratch_dir>/phz-<sandbox hash>
+    """
+
+    scratch_dir = os.path.expandvars(os.path.expanduser(scratch_dir))
+    if '$' in scratch_dir:
+        scratch_dir = tempfile.gettempdir()
+
+    run_id = hashlib.sha1(os.path.abspath(lephare_sandbox).encode()).hexdigest()[:12]
+
+    return os.path.join(scratch_dir, f'phz-{run_id}')
+
+
+def library_fingerprint(lephare_sandbox):
+    """ Identifies the libraries of the sandbox without reading them: the
+    directories are created again (new inode and mtime) when the libraries
+    are computed or restored
+
+    Args:
+        lephare_sandbox (str): sandbox path
+
+    Returns:
+        str: fingerprint
+    """
+
+    stats = list()
+
+    for dirname in LIBRARY_DIRS:
+        stat = os.stat(os.path.join(lephare_sandbox, dirname))
+        stats.append(f'{dirname} {stat.st_ino} {stat.st_mtime_ns}')
+
+    return ';'.join(stats)
+
+
+def stage_libraries(lephare_sandbox, run_node_dir):
+    """ Copies the LePhare libraries to the node-local directory, once per
+    node: the tasks of the node wait on a lock and the copy is done by the
+    first one
+
+    Args:
+        lephare_sandbox (str): sandbox path
+        run_node_dir (str): node-local directory of the run (see node_dir)
+
+    Returns:
+        str: directory with filt, lib_bin and lib_mag
+    """
+
+    os.makedirs(run_node_dir, exist_ok=True)
+    libraries = os.path.join(run_node_dir, 'libs')
+    marker = os.path.join(libraries, STAGED_MARKER)
+    fingerprint = library_fingerprint(lephare_sandbox)
+
+    with open(os.path.join(run_node_dir, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            if os.path.isfile(marker):
+                with open(marker) as _file:
+                    if _file.read() == fingerprint:
+                        return libraries
+
+            tmp_dir = f'{libraries}.tmp'
+            create_dir(tmp_dir, rmtree=True)
+
+            for dirname in LIBRARY_DIRS:
+                shutil.copytree(
+                    os.path.join(lephare_sandbox, dirname), os.path.join(tmp_dir, dirname)
+                )
+
+            with open(os.path.join(tmp_dir, STAGED_MARKER), 'w') as _file:
+                _file.write(fingerprint)
+
+            if os.path.isdir(libraries):
+                shutil.rmtree(libraries)
+
+            os.rename(tmp_dir, libraries)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    return libraries
+
+
+def create_run_dir(lephare_sandbox, name, scratch_dir=None):
+    """ Creates the run directory of a task with the links to the libraries
+
+    Args:
+        lephare_sandbox (str): sandbox path
+        name (str): run directory name
+        scratch_dir (str, optional): node-local directory. Defaults to None (sandbox).
+
+    Returns:
+        str: run directory path
+    """
+
+    if scratch_dir:
+        run_node_dir = node_dir(scratch_dir, lephare_sandbox)
+        libraries = stage_libraries(lephare_sandbox, run_node_dir)
+        lephare_run_path = os.path.join(run_node_dir, name)
+    else:
+        libraries = lephare_sandbox
+        lephare_run_path = os.path.join(lephare_sandbox, name)
+
+    create_dir(lephare_run_path, rmtree=True)
+    create_inputs_symbolic_link(libraries, lephare_run_path)
+
+    return lephare_run_path
+
+
+def copy_back(local_path, shared_path):
+    """ Copies a file to the shared filesystem, with a temporary name while
+    it is incomplete
+
+    Args:
+        local_path (str): node-local file
+        shared_path (str): destination path
+    """
+
+    tmp_path = f'{shared_path}.tmp'
+    shutil.copyfile(local_path, tmp_path)
+    os.replace(tmp_path, shared_path)
+
+
+def archive_run_dir(lephare_run_path, lephare_sandbox, logs=('zphot.run',)):
+    """ Copies the logs of a node-local run directory, compressed, to the
+    sandbox and removes the directory
+
+    Args:
+        lephare_run_path (str): node-local run directory
+        lephare_sandbox (str): sandbox path
+        logs (tuple, optional): log names. Defaults to ('zphot.run',).
+
+    Returns:
+        str: compressed log path
+    """
+
+    logs_dir = os.path.join(lephare_sandbox, LOGS_DIR)
+    os.makedirs(logs_dir, exist_ok=True)
+    archive = os.path.join(logs_dir, f'{os.path.basename(lephare_run_path)}.log.gz')
+
+    with gzip.open(f'{archive}.tmp', 'wb') as _archive:
+        for log in logs:
+            path = os.path.join(lephare_run_path, log)
+            if not os.path.isfile(path):
+                continue
+
+            _archive.write(f'==> {log} <==\n'.encode())
+            with open(path, 'rb') as _file:
+                shutil.copyfileobj(_file, _archive)
+
+    os.replace(f'{archive}.tmp', archive)
+    shutil.rmtree(lephare_run_path, ignore_errors=True)
+
+    return archive
@@ -0,0 +1,207 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from lephare_output import OUTPUT_TYPES, build_photoz_table
+from lephare_pdz import QUANTIZED_TYPES, add_pdz
+
+
+# value written in the numeric photo-z columns of the objects not fitted
+SENTINEL = -99.
+
+# magnitudes accepted by the LePhare input writer (see lephare_input.prepare_bands)
+MAG_RANGE = (0., 30.)
+
+
+def selection_columns(selection):
+    """ Returns the flag columns read in addition to the photometric columns
+
+    Args:
+        selection (dict): selection settings (min_bands, mag_limits, flags)
+
+    Returns:
+        list: column names
+    """
+
+    return list(selection.get('flags', {}))
+
+
+def _accepted(values):
+    return values if isinstance(values, (list, tuple)) else [values]
+
+
+def _limits(selection, band):
+    low, high = selection.get('mag_limits', {}).get(band, (None, None))
+    return max(MAG_RANGE[0], low if low is not None else -np.inf), \
+        min(MAG_RANGE[1], high if high is not None else np.inf)
+
+
+def row_group_filter(parquet_file, selection, bands, photo_type):
+    """ Creates the predicate of the row groups with selectable objects,
+    decided from the parquet statistics (min and max of each column)
+
+    A row group is rejected when a flag column can not hold an accepted
+    value, or when fewer than min_bands bands can be within their limits.
+    Row groups without statistics are kept.
+
+    Args:
+        parquet_file (ParquetFile): input file
+        selection (dict): selection settings
+        bands (list): bands list
+        photo_type (str): string containing magnitude with {} to concatenate the band.
+
+    Returns:
+        function: row group metadata -> True when the row group must be read
+    """
+
+    metadata = parquet_file.metadata
+    positions = {
+        metadata.row_group(0).column(idx).path_in_schema: idx
+        for idx in range(metadata.num_columns)
+    } if metadata.num_row_groups else dict()
+
+    min_bands = int(selection.get('min_bands', 1))
+    flags = selection.get('flags', {})
+
+    def statistics(row_group, name):
+        stats = row_group.column(positions[name]).statistics if name in positions else None
+        if stats is None or not stats.has_min_max:
+            return None
+        return stats.min, stats.max
+
+    def keep(row_group):
+        for name, values in flags.items():
+            bounds = statistics(row_group, name)
+            if bounds and not any(bounds[0] <= value <= bounds[1] for value in _accepted(values)):
+                return False
+
+        possible = 0
+        for band in bands:
+            bounds = statistics(row_group, photo_type.format(band))
+            low, high = _limits(selection, band)
+            if bounds is None or (bounds[1] >= low and bounds[0] <= high):
+                possible += 1
+
+        return possible >= min_bands
+
+    return keep
+
+
+def select_rows(table, selection, bands, photo_type):
+    """ Computes the objects to fit: flags with an accepted value and at
+    least min_bands magnitudes within their limits (and within 0-30, the
+    others are not used by LePhare)
+
+    Args:
+        table (pyarrow.Table): partition columns
+        selection (dict): selection settings
+        bands (list): bands list
+        photo_type (str): string containing magnitude with {} to concatenate the band.
+
+    Returns:
+        ndarray: boolean mask of the objects to fit
+    """
+
+    valid_bands = np.zeros(table.num_rows, dtype=np.int64)
+
+    for band in bands:
+        mags = table.column(photo_type.format(band)).to_numpy()
+        low, high = _limits(selection, band)
+        with np.errstate(invalid='ignore'):
+            valid_bands += (mags >= low) & (mags <= high)
+
+    mask = valid_bands >= int(selection.get('min_bands', 1))
+
+    for name, values in selection.get('flags', {}).items():
+        accepted = pc.is_in(table.column(name), value_set=pa.array(_accepted(values)))
+        mask &= pc.fill_null(accepted, False).to_numpy()
+
+    return mask
+
+
+def empty_photoz(namephotoz, col_index, index_type, pdz=None):
+    """ Creates the photo-z table of a partition without objects to fit
+
+    Args:
+        namephotoz (list): LePhare output column names
+        col_index (str): index column name
+        index_type (DataType): index column type
+        pdz (dict, optional): PDF output (quantize and grid). Defaults to None.
+
+    Returns:
+        pyarrow.Table: photo-z table without rows
+    """
+
+    zphotoz = pa.Table.from_arrays(
+        [pa.chunked_array([], type=OUTPUT_TYPES.get(name, pa.float64())) for name in namephotoz],
+        names=namephotoz
+    )
+    table = build_photoz_table(zphotoz, col_index, pa.chunked_array([], type=index_type))
+
+    if pdz:
+        bits = pdz.get('quantize')
+        ptype = QUANTIZED_TYPES[bits][0] if bits else pa.float32()
+        table = add_pdz(
+            table, table.column('ident'), pa.chunked_array([], type=pa.list_(ptype, len(pdz.get('grid')))),
+            pa.chunked_array([], type=pa.float32()) if bits else None, pdz.get('grid'), bits
+        )
+
+    return table
+
+
+def sentinel_rows(schema, positions, col_index, col_index_values):
+    """ Creates the photo-z rows of the objects not fitted, with SENTINEL in
+    the numeric columns (zeros in the PDF columns)
+
+    Args:
+        schema (pyarrow.Schema): photo-z table schema
+        positions (ndarray): rows of the objects in the partition
+        col_index (str): index column name
+        col_index_values (ChunkedArray): index column values of all the objects
+
+    Returns:
+        pyarrow.Table: sentinel rows
+    """
+
+    columns = list()
+
+    for field in schema:
+        if field.name == col_index.lower():
+            columns.append(col_index_values.take(pa.array(positions)))
+        elif pa.types.is_floating(field.type) or pa.types.is_integer(field.type):
+            columns.append(pa.array(np.full(len(positions), SENTINEL)).cast(field.type))
+        elif pa.types.is_fixed_size_list(field.type):
+            # the parquet writer of pyarrow 6 does not write null fixed-size lists
+            values = pa.array(np.zeros(len(positions) * field.type.list_size)).cast(field.type.value_type)
+            columns.append(pa.FixedSizeListArray.from_arrays(values, field.type.list_size))
+        else:
+            columns.append(pa.nulls(len(positions), field.type))
+
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def assemble(parts):
+    """ Merges photo-z rows computed separately (fitted, sentinels, reused)
+    into the partition order
+
+    The LePhare identifiers (row numbers of the fitted catalog) become the
+    row numbers of the partition, as when all the objects are fitted.
+
+    Args:
+        parts (list): tuples (positions in the partition, photo-z rows), with
+            the schema of the first part
+
+    Returns:
+        pyarrow.Table: photo-z table of all the objects
+    """
+
+    schema = parts[0][1].schema
+    positions = np.concatenate([part[0] for part in parts])
+    table = pa.concat_tables([part[1].select(schema.names).cast(schema) for part in parts])
+    table = table.take(pa.array(np.argsort(positions, kind='stable')))
+
+    ident = schema.get_field_index('ident')
+    if ident >= 0:
+        field = schema.field(ident)
+        table = table.set_column(ident, field, pa.array(np.arange(1, len(positions) + 1)).cast(field.type))
+
+    return table
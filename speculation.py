@@ -0,0 +1,129 @@
+import os
+import numpy as np
+
+
+# straggler settings used when config.yml does not set them (speculation: ...)
+FACTOR = 2.0
+MIN_COMPLETED = 10
+MAX_COPIES = 1
+CHECK_SECONDS = 10.
+
+
+def attempt_output(output, attempt):
+    """ Returns the path written by an attempt of a partition, never read as
+    a photo-z output (see promote)
+
+    Args:
+        output (str): partition output path
+        attempt (int): attempt number (0 for the first submission)
+
+    Returns:
+        str: attempt path
+    """
+
+    return f'{output}.attempt{attempt}'
+
+
+def promote(path, output):
+    """ Moves the output of the first completed attempt to the partition
+    output path, atomically
+
+    Args:
+        path (str): path written by the attempt
+        output (str): partition output path
+    """
+
+    if path != output:
+        os.replace(path, output)
+
+
+def discard(path, output):
+    """ Removes the output of an attempt completed after the partition
+
+    Args:
+        path (str): path written by the attempt
+        output (str): partition output path
+    """
+
+    if path != output and os.path.isfile(path):
+        os.remove(path)
+
+
+def concurrency(records):
+    """ Computes the largest number of partitions computed at the same time
+
+    Args:
+        records (list): timing records (start and end)
+
+    Returns:
+        int: concurrent partitions
+    """
+
+    events = sorted(
+        [(record['start'], 1) for record in records] + [(record['end'], -1) for record in records],
+        key=lambda event: (event[0], event[1])
+    )
+
+    running, highest = 0, 0
+    for _, step in events:
+        running += step
+        highest = max(highest, running)
+
+    return highest
+
+
+def worker_capacity(executors):
+    """ Counts the workers of the executors: threads of the local executors
+    and workers connected to the HighThroughputExecutors
+
+    Args:
+        executors (list): Parsl executors (internal executor excluded)
+
+    Returns:
+        int: workers, 0 when they can not be counted
+    """
+
+    workers = 0
+
+    for executor in executors:
+        if hasattr(executor, 'max_threads'):
+            workers += executor.max_threads
+        elif hasattr(executor, 'connected_workers'):
+            try:
+                workers += int(executor.connected_workers)
+            except Exception:
+                # interchange not reachable (starting or shutting down)
+                pass
+
+    return workers
+
+
+def seconds_per_row(records):
+    """ Computes the median duration by row of the completed partitions
+
+    Args:
+        records (list): timing records (seconds and rows)
+
+    Returns:
+        float: seconds per row, None without records
+    """
+
+    rates = [record['seconds'] / record['rows'] for record in records if record.get('rows')]
+
+    return float(np.median(rates)) if rates else None
+
+
+def is_straggler(rows, elapsed, rate, factor=FACTOR):
+    """ Checks if a task runs longer than factor times the running median
+
+    Args:
+        rows (int): rows of the task
+        elapsed (float): seconds since the task started (or its lower bound)
+        rate (float): seconds per row (see seconds_per_row)
+        factor (float, optional): allowed slowdown. Defaults to FACTOR.
+
+    Returns:
+        bool: True when a copy of the task should be launched
+    """
+
+    return rate is not None and elapsed > factor * rate * rows
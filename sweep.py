@@ -0,0 +1,125 @@
+import os
+import re
+from utils import read_zphot_para
+import manifest
+
+
+# variants outputs, ignored by the readers of the output directory as a dataset
+SWEEP_DIR = '_sweep'
+
+# zphot.para keys shared by all the variants: the catalog is formatted and parsed once
+SHARED_KEYS = ('CAT_FMT', 'PARA_OUT', 'Z_STEP')
+
+
+def variant_root(output_dir, name):
+    """ Returns the output directory of a variant
+
+    Args:
+        output_dir (str): output directory of the run
+        name (str): variant name
+
+    Returns:
+        str: variant output directory
+    """
+
+    return os.path.join(output_dir, SWEEP_DIR, name)
+
+
+def variant_output(output, output_dir, name):
+    """ Returns the path of a variant output, with the layout of the run
+    outputs (partitions, halves, attempts and compacted files)
+
+    Args:
+        output (str): output path, in output_dir
+        output_dir (str): output directory of the run
+        name (str): variant name
+
+    Returns:
+        str: variant output path
+    """
+
+    return os.path.join(variant_root(output_dir, name), os.path.relpath(output, output_dir))
+
+
+def load_variants(sweep, zphot_para, zphot_dict, settings):
+    """ Reads the variants of a sweep, each one with the shifts and the
+    zphot.para of the run unless it sets its own
+
+    Args:
+        sweep (dict): sweep section of config.yml
+        zphot_para (str): zphot.para path of the run
+        zphot_dict (dict): zphot.para keys and values of the run
+        settings (dict): settings section of config.yml
+
+    Raises:
+        ValueError: invalid or duplicated name, or zphot.para not compatible
+            with the run
+
+    Returns:
+        list: variants, dicts with name, zphot (path and keys), shifts and
+        config (configuration hash, see manifest.config_hash)
+    """
+
+    variants, names = list(), set()
+
+    for variant in sweep.get('variants', []):
+        name = str(variant.get('name', ''))
+
+        if not re.fullmatch(r'[A-Za-z0-9][A-Za-z0-9_.-]*', name) or name in names:
+            raise ValueError(f'sweep variant name "{name}" is invalid or duplicated')
+        names.add(name)
+
+        para = variant.get('zphot', zphot_para)
+        dic = read_zphot_para(para) if para != zphot_para else zphot_dict
+        shifts = variant.get('shifts', settings.get('shifts', None))
+
+        different = [key for key in SHARED_KEYS if dic.get(key) != zphot_dict.get(key)]
+        if different:
+            raise ValueError(f'sweep variant "{name}" changes {different}, shared by all the variants')
+
+        variants.append({
+            'name': name, 'zphot': para, 'zphot_dict': dic, 'shifts': shifts,
+            'config': manifest.config_hash(dict(settings, shifts=shifts), dic)
+        })
+
+    return variants
+
+
+def partition_variants(variants, output, output_dir):
+    """ Lists the zphota runs of a partition in addition to the run one
+
+    Args:
+        variants (list): variants (see load_variants)
+        output (str): partition output path
+        output_dir (str): output directory of the run
+
+    Returns:
+        list: dicts with name, zphot, shifts and output
+    """
+
+    return [{
+        'name': variant['name'], 'zphot': variant['zphot'], 'shifts': variant['shifts'],
+        'output': variant_output(output, output_dir, variant['name'])
+    } for variant in variants]
+
+
+def variant_records(variants, filename, interval, output, output_dir):
+    """ Creates the manifest records of the variant outputs of a partition
+
+    Args:
+        variants (list): variants (see load_variants)
+        filename (str): input file path
+        interval (tuple): first and last (exclusive) rows
+        output (str): partition output path
+        output_dir (str): output directory of the run
+
+    Returns:
+        dict: manifest record by variant name
+    """
+
+    return {
+        variant['name']: manifest.partition_record(
+            filename, interval, variant['config'],
+            variant_output(output, output_dir, variant['name'])
+        ) for variant in variants
+    }
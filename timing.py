@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import socket
+from contextlib import contextmanager
+
+
+# stages timed for each partition (see lephare_run.run_partition)
+STAGES = ('read', 'format', 'zphota', 'parse', 'write', 'qa')
+
+# timing records written in the sandbox by pz-run.py
+TIMINGS_FILE = 'timings.jsonl'
+
+
+class StageTimer:
+    """ Measures the duration of the stages of a partition """
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = dict()
+
+    @contextmanager
+    def stage(self, name):
+        """ Adds the duration of the block to the stage
+
+        Args:
+            name (str): stage name
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + time.perf_counter() - start
+
+    def record(self, **fields):
+        """ Creates the timing record of the partition
+
+        Args:
+            fields: partition fields (key, input, interval, rows, bytes...)
+
+        Returns:
+            dict: timing record
+        """
+
+        end = time.time()
+        record = {
+            'host': socket.gethostname(), 'pid': os.getpid(),
+            'start': round(self.start, 3), 'end': round(end, 3),
+            'seconds': round(end - self.start, 4),
+            'stages': {name: round(value, 4) for name, value in self.stages.items()}
+        }
+        record.update(fields)
+
+        return record
+
+
+def append_timings(timings_path, records):
+    """ Appends timing records to the JSON-lines file
+
+    Args:
+        timings_path (str): timings file path
+        records (list): timing records
+    """
+
+    with open(timings_path, 'a') as _file:
+        for record in records:
+            _file.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def load_timings(timings_path):
+    """ Loads the timing records, truncated lines are ignored
+
+    Args:
+        timings_path (str): timings file path
+
+    Returns:
+        list: timing records
+    """
+
+    records = list()
+
+    with open(timings_path) as _file:
+        for line in _file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+
+    return records
+
+
+def throughput_by_host(records):
+    """ Aggregates the partitions processed by each node
+
+    The wall time of a node goes from its first start to its last end, so the
+    rate includes the idle time between its tasks.
+
+    Args:
+        records (list): timing records
+
+    Returns:
+        dict: partitions, rows, busy seconds, wall seconds, rows/s and peak task memory by host
+    """
+
+    hosts = dict()
+
+    for record in records:
+        host = hosts.setdefault(record.get('host'), {
+            'partitions': 0, 'rows': 0, 'busy_seconds': 0.,
+            'start': record.get('start'), 'end': record.get('end')
+        })
+        host['partitions'] += 1
+        host['rows'] += record.get('rows', 0)
+        host['busy_seconds'] += record.get('seconds', 0.)
+        host['max_memory_mb'] = max(
+            host.get('max_memory_mb', 0.), sum(record.get('memory_mb', {}).values())
+        )
+        host['start'] = min(host['start'], record.get('start'))
+        host['end'] = max(host['end'], record.get('end'))
+
+    for host in hosts.values():
+        wall = host.pop('end') - host.pop('start')
+        host['wall_seconds'] = round(wall, 3)
+        host['busy_seconds'] = round(host['busy_seconds'], 3)
+        host['rows_per_second'] = round(host['rows'] / wall, 1) if wall > 0 else None
+
+    return hosts
+
+
+def slowest_partitions(records, count=10):
+    """ Lists the partitions with the longest durations
+
+    Args:
+        records (list): timing records
+        count (int, optional): number of partitions. Defaults to 10.
+
+    Returns:
+        list: timing records, slowest first
+    """
+
+    return sorted(records, key=lambda record: record.get('seconds', 0.), reverse=True)[:count]
+
+
+def stage_breakdown(records):
+    """ Sums the duration of each stage over all partitions
+
+    Args:
+        records (list): timing records
+
+    Returns:
+        dict: total seconds, mean seconds and share of the task time by stage
+    """
+
+    totals = dict.fromkeys(STAGES, 0.)
+
+    for record in records:
+        for name, value in record.get('stages', {}).items():
+            totals[name] = totals.get(name, 0.) + value
+
+    total = sum(record.get('seconds', 0.) for record in records)
+    nrecords = max(len(records), 1)
+
+    breakdown = {
+        name: {
+            'seconds': round(value, 3), 'mean': round(value / nrecords, 4),
+            'share': round(value / total, 4) if total else None
+        } for name, value in totals.items()
+    }
+
+    # time spent outside the timed stages (directories, links, logging)
+    other = total - sum(totals.values())
+    breakdown['other'] = {
+        'seconds': round(other, 3), 'mean': round(other / nrecords, 4),
+        'share': round(other / total, 4) if total else None
+    }
+
+    return breakdown
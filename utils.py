@@ -1,9 +1,12 @@
 import os
 import tarfile
 import re
+import numpy as np
+import pyarrow as pa
 import pyarrow.parquet as pq
 import shutil
 import logging
+import hashlib
 
 
 def get_logger(name=None, stdout=True, debug=False):
@@ -38,6 +41,18 @@ def get_logger(name=None, stdout=True, debug=False):
     return logger
 
 
+def close_logger(logger):
+    """ Closes and removes the handlers of a logger
+
+    Args:
+        logger (logger): logger object
+    """
+
+    for handler in list(logger.handlers):
+        handler.close()
+        logger.removeHandler(handler)
+
+
 def create_dir(path, chdir=False, rmtree=False):
     """ Create directory 
 
@@ -56,6 +71,25 @@ def create_dir(path, chdir=False, rmtree=False):
         os.chdir(path)
 
 
+def file_checksum(path):
+    """ Computes the sha256 checksum of a file
+
+    Args:
+        path (string): file path
+
+    Returns:
+        string: hexadecimal digest
+    """
+
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as _file:
+        for block in iter(lambda: _file.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
 # def untar_file(filepath):
 #     """ Unzips tar files
 
@@ -85,6 +119,27 @@ def create_dir(path, chdir=False, rmtree=False):
 #         fin.write(data)
 
 
+def read_zphot_para(zphot_para):
+    """ Reads the zphot.para keys
+
+    Args:
+        zphot_para (string): zphot.para path
+
+    Returns:
+        dict: key and value (without spaces) of each parameter
+    """
+
+    dic = dict()
+
+    with open(zphot_para, "r") as conffile:
+        for line in conffile.read().splitlines():
+            fields = line.split()
+            if fields and not fields[0].startswith('#'):
+                dic[fields[0]] = "".join(fields[1:])
+
+    return dic
+
+
 def prepare_format_output(bands_list, zphot_output):
     """ Prepare the LePhare format output
 
@@ -129,52 +184,230 @@ def prepare_format_output(bands_list, zphot_output):
     return (idxs, namephotoz)
 
 
-def set_partitions(photo_files, num_chunks, idx):
-    """ Sets the partitions of each photometric file
+def get_row_group_offsets(metadata):
+    """ Returns the first row of each row group and the total number of rows
 
     Args:
-        photo_files (string): photometric file list
-        num_chunks (integer): number of partitions 
-        idx (string): index column name
+        metadata (FileMetaData): parquet footer metadata
 
     Returns:
-        list: partitions list
+        list: row offsets, the last item is the number of rows of the file
     """
 
-    run_list, min_size = list(), 200
+    offsets = [0]
 
-    for _file in photo_files:
-        chunk_list = list()
-        dic_item = {'path': _file, 'ranges': chunk_list}
+    for rg in range(metadata.num_row_groups):
+        offsets.append(offsets[-1] + metadata.row_group(rg).num_rows)
+
+    return offsets
+
+
+def snap_to_row_groups(bounds, offsets):
+    """ Moves the partition bounds to the nearest row group boundary, when
+    it is closer than an eighth of the partition size, so that partitions
+    read whole row groups whenever possible
+
+    Args:
+        bounds (list): partition bounds, starting with 0 and ending with num_rows
+        offsets (list): row group offsets (see get_row_group_offsets)
+
+    Returns:
+        list: snapped bounds, strictly increasing
+    """
+
+    if len(bounds) < 3:
+        return bounds
+
+    tolerance = (bounds[-1] - bounds[0]) / (len(bounds) - 1) / 8
+    snapped = [bounds[0]]
+
+    for bound in bounds[1:-1]:
+        nearest = min(offsets, key=lambda off: abs(off - bound))
+        if abs(nearest - bound) > tolerance:
+            nearest = bound
+        if snapped[-1] < nearest < bounds[-1]:
+            snapped.append(nearest)
+
+    if bounds[-1] > snapped[-1]:
+        snapped.append(bounds[-1])
+
+    return snapped
+
+
+def even_bounds(num_entries, num_chunks):
+    """ Splits a number of rows in num_chunks nearly equal parts
+
+    Args:
+        num_entries (integer): number of rows
+        num_chunks (integer): number of partitions
+
+    Returns:
+        list: partition bounds, starting with 0 and ending with num_entries
+    """
+
+    chunk_size, rest = divmod(num_entries, num_chunks)
+    bounds = [0]
+
+    for x in range(num_chunks):
+        bounds.append(bounds[-1] + chunk_size + (1 if x < rest else 0))
+
+    return bounds
+
+
+def rows_per_task(settings, total_rows, num_files):
+    """ Returns the target number of rows of each task
+
+    In order of priority: settings "rows_per_task", or "task_seconds" times
+    the observed zphota "throughput" (rows per second), or the average file
+    size divided by "partitions".
+
+    Args:
+        settings (dict): settings section of config.yml
+        total_rows (integer): number of rows of all files
+        num_files (integer): number of files
+
+    Returns:
+        integer: target rows per task
+    """
+
+    if settings.get('rows_per_task'):
+        return int(settings.get('rows_per_task'))
+
+    if settings.get('task_seconds') and settings.get('throughput'):
+        return int(float(settings.get('task_seconds')) * float(settings.get('throughput')))
+
+    npartition = int(settings.get('partitions', 50))
 
-        pf = pq.read_table(_file, columns=[idx])
-        num_entries = pf.num_rows
+    return int(total_rows / max(num_files, 1) / npartition)
 
-        if num_entries/num_chunks < min_size:
-            num_chunks = int(num_entries/min_size)
 
-        if num_chunks > num_entries or num_chunks == 0:
-            num_chunks = 1
+def plan_partitions(photo_files, settings, min_size=200):
+    """ Sets the partitions of all photometric files with the same target
+    size, independently of the files order
 
-        chunk_size = int(num_entries/num_chunks)
-        rest = num_entries%num_chunks
+    Args:
+        photo_files (list): photometric file list
+        settings (dict): settings section of config.yml (see rows_per_task)
+        min_size (integer, optional): minimum rows per task. Defaults to 200.
 
-        first = 0
-        last = chunk_size
+    Returns:
+        list: partitions list, dicts with path and ranges (first and last rows)
+    """
 
-        for x in range(int(num_chunks)):
-            if x < rest:
-                last += 1
+    offsets = {
+        _file: get_row_group_offsets(pq.ParquetFile(_file).metadata) for _file in photo_files
+    }
+    total_rows = sum(off[-1] for off in offsets.values())
+    target = max(rows_per_task(settings, total_rows, len(photo_files)), min_size)
 
-            chunk_list.append((first, last))
-            first = last
-            last += chunk_size
+    run_list = list()
 
-        run_list.append(dic_item)
+    for _file in photo_files:
+        num_entries = offsets[_file][-1]
+        num_chunks = max(int(round(num_entries / target)), 1)
+
+        bounds = snap_to_row_groups(even_bounds(num_entries, num_chunks), offsets[_file])
+        ranges = [(first, last) for first, last in zip(bounds[:-1], bounds[1:])]
+
+        run_list.append({'path': _file, 'ranges': ranges})
 
     return run_list
 
 
+def read_interval(filename, interval, columns, parquet_file=None, row_group_filter=None, index_column=None):
+    """ Reads a range of rows from a parquet file, loading only the row
+    groups that overlap the interval
+
+    Of the row groups rejected by row_group_filter, only the index column (and
+    the other kept columns) is read, the other columns are nulls.
+
+    Args:
+        filename (string): parquet file path
+        interval (tuple): first and last (exclusive) rows
+        columns (list): columns to read
+        parquet_file (ParquetFile, optional): file already opened. Defaults to None.
+        row_group_filter (function, optional): row group metadata -> True when
+            all its columns must be read. Defaults to None.
+        index_column (string or list, optional): column(s) read in the rejected row
+            groups (index and coordinates). Defaults to None.
+
+    Raises:
+        ValueError: row_group_filter without index_column
+
+    Returns:
+        pyarrow.Table: selected rows
+    """
+
+    if row_group_filter is not None and not index_column:
+        raise ValueError('row_group_filter requires index_column (the index column read in the rejected row groups)')
+
+    first, last = interval
+    parquet_file = parquet_file or pq.ParquetFile(filename)
+    offsets = get_row_group_offsets(parquet_file.metadata)
+
+    row_groups = [
+        rg for rg in range(len(offsets) - 1)
+        if offsets[rg] < last and offsets[rg + 1] > first
+    ]
+
+    if not row_groups:
+        return parquet_file.schema_arrow.empty_table().select(columns)
+
+    rejected = [
+        rg for rg in row_groups
+        if row_group_filter and not row_group_filter(parquet_file.metadata.row_group(rg))
+    ]
+
+    if not rejected:
+        table = parquet_file.read_row_groups(row_groups, columns=columns)
+    else:
+        schema = parquet_file.schema_arrow
+        tables = list()
+
+        for rg in row_groups:
+            if rg not in rejected:
+                tables.append(parquet_file.read_row_group(rg, columns=columns).select(columns))
+                continue
+
+            kept = [index_column] if isinstance(index_column, str) else list(index_column)
+            kept_values = parquet_file.read_row_group(rg, columns=kept)
+            tables.append(pa.Table.from_arrays([
+                kept_values.column(name) if name in kept
+                else pa.nulls(kept_values.num_rows, schema.field(name).type)
+                for name in columns
+            ], names=columns))
+
+        table = pa.concat_tables(tables)
+
+    return table.slice(first - offsets[row_groups[0]], last - first)
+
+
+def pushed_down_rows(parquet_file, interval, row_group_filter):
+    """ Flags the rows of an interval in the row groups rejected by
+    row_group_filter, of which read_interval reads only the kept columns
+
+    Args:
+        parquet_file (ParquetFile): opened parquet file
+        interval (tuple): first and last (exclusive) rows
+        row_group_filter (function): row group metadata -> True when all its
+            columns must be read
+
+    Returns:
+        ndarray: True for the rows whose other columns are nulls
+    """
+
+    first, last = interval
+    offsets = get_row_group_offsets(parquet_file.metadata)
+    pushed = np.zeros(last - first, dtype=bool)
+
+    for rg in range(len(offsets) - 1):
+        if offsets[rg] < last and offsets[rg + 1] > first \
+                and not row_group_filter(parquet_file.metadata.row_group(rg)):
+            pushed[max(offsets[rg], first) - first:min(offsets[rg + 1], last) - first] = True
+
+    return pushed
+
+
 def get_photometric_columns(bands, photo_type, err_type, idx, corr=None):
     """ Returns the photometric columns selected by Photoz Trainning
 
@@ -206,9 +439,11 @@ def get_photometric_columns(bands, photo_type, err_type, idx, corr=None):
 def format_input(idx, table, bands, photo_type, err_type, index_column, corr, cat_fmt="MEME"):
     """ Responsible for formatting the Lephare input
 
+    Kept for compatibility, the input is written by lephare_input.write_input.
+
     Args:
         idx (string): thread id
-        table (): [description]
+        table (DataFrame): photometric data
         bands (list): bands list
         photo_type (string): string containing magnitude with {} to concatenate the band.
         err_type (string): string containing magnitude erro with {} to concatenate the band.
@@ -224,90 +459,9 @@ def format_input(idx, table, bands, photo_type, err_type, index_column, corr, ca
         string: input name created
     """
 
-    import numpy as np
-
-    # magnitudes that requires correction
-    # TODO: has to be updated in case of dataset with more bands (deep)
-    CORR_SFD98 = {
-        "G": 3.185, "R": 2.140, "I": 1.571, "Z": 1.198, "Y": 1.052
-    } # SFD98 20th June 2017
-
-    ids = table.get(index_column).to_numpy()
-    n_gals = len(ids)
-    gal_number = range(1, n_gals + 1, 1)
-    _format = ['%10d']
-    mags, errs = {}, {}
-
-    for band in bands:
-        mag_values = table.get(photo_type.format(band)).to_numpy()
-
-        if err_type: #TODO: in simulation case: the value will be None
-            err_values = table.get(err_type.format(band)).to_numpy()
-        else:
-            err_values = np.ones_like(mag_values)
-
-        # Eliminating 99's from sample
-        mag_values[(mag_values < 0.) + (mag_values > 30.)] = -99.
-        err_values[(mag_values < 0.) + (mag_values > 30.)] = -99.
-        mag_values[np.isnan(mag_values)] = -99.
-        err_values[np.isnan(err_values)] = -99.
-
-        if corr:
-            if not band in CORR_SFD98.keys():
-                mag = photo_type.format(band)
-                print(f"\n\nFailed to correct column magnitude {mag}")
-                raise BaseException
-
-            corr_col = table.get(corr).to_numpy()
-            mag_values[mag_values != -99.] = mag_values[mag_values != -99.] - (CORR_SFD98.get(band) * corr_col[mag_values != -99.])
-
-        mags[band] = mag_values
-        errs[band] = err_values
-        _format.append('%.5f')
-        _format.append('%.5f')
-
-    # Calculating the context
-    acont = list()
-
-    for obj in range(n_gals):
-        m, context = -1, 0
-        for band in bands:
-            m = m + 1
-
-            if mags[band][obj] != -99.:
-                context = context + (2**m)
-
-        acont.append(context)
-
-    acont = np.array(acont)
-    _format.append('%.6d')
-
-    # "True" redshifts
-    z_true = np.ones(n_gals)*-99.
-    _format.append('%.5f')
-
-    columns = np.c_[gal_number]
-
-    if cat_fmt == "MEME":
-        for band in bands:
-            columns = np.c_[columns, mags[band], errs[band]]
-    elif cat_fmt == "MMEE":
-        for band in bands:
-            columns = np.c_[columns, mags[band]]
-        for band in bands:
-            columns = np.c_[columns, errs[band]]
-    else:
-        print(f"CAT_FMT: unexpected format - {cat_fmt}")
-        raise BaseException
-
-    _format.append('%10d')
-
-    columns = np.c_[columns, acont, z_true, ids]
-
-    input_file = f'lephare_{str(idx)}.input'
-    np.savetxt(input_file, columns, fmt=_format)
+    from lephare_input import write_input
 
-    return input_file
+    return write_input(idx, table, bands, photo_type, err_type, index_column, corr, cat_fmt)
 
 
 def create_inputs_symbolic_link(sandbox, thread_dir):